@@ -0,0 +1,74 @@
+# access.py - Ownership scope for client resources, folded into the endpoints' main queries
+#
+# Zamiast: wczytaj wiersz -> wczytaj klientkę -> porównaj cosmetologist_id/user_id w Pythonie,
+# warunek własności jest kolumną (EXISTS) w tym samym zapytaniu co wiersz. Jedno zapytanie odróżnia:
+# brak wiersza (404) od wiersza bez uprawnień (403).
+
+from fastapi import HTTPException
+from sqlalchemy import exists, select, true
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.beautyai import crud, models
+
+class ClientScope:
+    # Klientki dostępne dla użytkownika: kosmetolog - przypisane do niego, klientka - własny profil.
+    # allow_superadmin=True: superadmin widzi wszystko (domyślnie traktowany jak każdy inny użytkownik)
+    def __init__(self, user, allow_superadmin: bool = False):
+        self.user = user
+        self.allow_superadmin = allow_superadmin
+
+    def condition(self):
+        # Warunek na wierszu models.Client
+        if self.allow_superadmin and self.user.role == models.UserRole.SUPERADMIN:
+            return true()
+        if self.user.role == models.UserRole.ADMIN:
+            return models.Client.cosmetologist_id == self.user.id
+        return models.Client.user_id == self.user.id
+
+    def owns(self, client_id_column):
+        # Warunek dla wiersza z kolumną client_id (plan, analiza, wiadomość) - skorelowany EXISTS po kluczu głównym
+        if client_id_column is models.Client.id:
+            return self.condition()
+        return exists().where(models.Client.id == client_id_column, self.condition())
+
+    def client_ids(self):
+        # Podzapytanie do IN (...) - lista klientek liczona w bazie, nie w Pythonie
+        return select(models.Client.id).where(self.condition())
+
+    def scoped(self, statement, client_id_column):
+        # Zapytanie + kolumna uprawnień jako ostatnia kolumna wiersza
+        return statement.add_columns(self.owns(client_id_column).label("allowed"))
+
+    @staticmethod
+    def check(row, not_found: str, forbidden: str):
+        # Wiersz bez kolumny uprawnień: sam obiekt albo krotka, jeśli zapytanie miało więcej kolumn
+        if row is None:
+            raise HTTPException(status_code=404, detail=not_found)
+        if not row[-1]:
+            raise HTTPException(status_code=403, detail=forbidden)
+        return row[0] if len(row) == 2 else tuple(row[:-1])
+
+    async def fetch(
+        self,
+        db: AsyncSession,
+        statement,
+        client_id_column,
+        not_found: str,
+        forbidden: str,
+        unique: bool = False,
+    ):
+        # unique=True dla zapytań z joinedload kolekcji
+        result = await db.execute(self.scoped(statement, client_id_column))
+        if unique:
+            result = result.unique()
+        return self.check(result.first(), not_found, forbidden)
+
+    async def fetch_client(self, db: AsyncSession, client_id: int, forbidden: str = "No permission for this client") -> models.Client:
+        return await self.fetch(
+            db, crud.client_query(client_id), models.Client.id,
+            "Client not found", forbidden,
+        )
+
+def forbidden_for(user, admin_detail: str, client_detail: str) -> str:
+    # Komunikat 403 zależny od roli (kosmetolog / klientka)
+    return admin_detail if user.role == models.UserRole.ADMIN else client_detail
@@ -1,28 +1,53 @@
-# Dodatkowe endpointy do dodania w main.py
+# additional_endpoints.py - Care plan, analysis, product, chat and PDF export endpoints (rejestrowane w main.py)
+
+from fastapi import Depends, HTTPException, Query, Request, status, WebSocket, UploadFile, File, Form, Header
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from datetime import datetime
+import asyncio
+import json
+import os
+
+from backend.beautyai import models, schemas, crud, pdf, uploads, images, access, scoring
+from backend.beautyai.jobs import job_queue
+from backend.beautyai.cache import TTLCache
+from backend.beautyai.chat_broker import broker as chat_broker, chat_topic
+from backend.beautyai.database import AsyncSessionLocal
+from backend.beautyai.main import (
+    app,
+    get_async_db,
+    get_current_active_user,
+    get_admin_user,
+    resolve_principal,
+    logger,
+)
 
 # === CARE PLAN ENDPOINTS ===
 
 @app.post("/care-plans/", response_model=schemas.CarePlan)
 async def create_care_plan(
     care_plan: schemas.CarePlanCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_admin_user)
 ):
     # Sprawdź czy klient istnieje i czy kosmetolog ma do niego dostęp
-    db_client = db.query(models.Client).filter(models.Client.id == care_plan.client_id).first()
-    if not db_client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    if db_client.cosmetologist_id != current_user.id:
-        raise HTTPException(status_code=403, detail="No permission for this client")
+    await get_cosmetologist_client(db, care_plan.client_id, current_user)
     
     # Sprawdź czy analiza istnieje i należy do klienta
-    db_analysis = db.query(models.Analysis).filter(
-        models.Analysis.id == care_plan.analysis_id,
-        models.Analysis.client_id == care_plan.client_id
-    ).first()
+    db_analysis = (await db.execute(
+        crud.client_analysis_query(care_plan.analysis_id, care_plan.client_id)
+    )).scalars().first()
     if not db_analysis:
         raise HTTPException(status_code=404, detail="Analysis not found or doesn't belong to this client")
     
+    # Sprawdź wszystkie produkty jednym zapytaniem - przed jakimkolwiek zapisem
+    missing = await crud.find_missing_product_ids(db, (item.product_id for item in care_plan.items))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Product with id {missing[0]} not found")
+    
     # Utwórz nowy plan pielęgnacyjny
     db_care_plan = models.CarePlan(
         client_id=care_plan.client_id,
@@ -34,179 +59,353 @@ async def create_care_plan(
     )
     
     db.add(db_care_plan)
-    db.commit()
-    db.refresh(db_care_plan)
-    
-    # Dodaj produkty do planu
-    for i, item in enumerate(care_plan.items):
-        # Sprawdź czy produkt istnieje
-        db_product = db.query(models.Product).filter(models.Product.id == item.product_id).first()
-        if not db_product:
-            raise HTTPException(status_code=404, detail=f"Product with id {item.product_id} not found")
-        
-        # Dodaj element do planu
-        db_item = models.CarePlanItem(
-            care_plan_id=db_care_plan.id,
-            product_id=item.product_id,
-            usage_time=item.usage_time,
-            usage_frequency=item.usage_frequency,
-            usage_instructions=item.usage_instructions,
-            order=item.order or i  # Jeśli order nie podany, użyj indeksu
-        )
-        db.add(db_item)
+    await db.flush()  # nadaje id w tej samej transakcji
+    
+    # Dodaj produkty do planu jednym INSERT-em; plan i pozycje zapisywane w jednej transakcji
+    await crud.insert_care_plan_items(db, db_care_plan.id, care_plan.items)
     
-    db.commit()
-    db.refresh(db_care_plan)
+    await db.commit()
+    await db.refresh(db_care_plan)
     return db_care_plan
 
-@app.get("/care-plans/", response_model=List[schemas.CarePlan])
+@app.get("/care-plans/", response_model=schemas.CarePlanPage)
 async def read_care_plans(
     client_id: Optional[int] = None,
-    skip: int = 0, 
-    limit: int = 100, 
-    db: Session = Depends(get_db),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_current_active_user)
 ):
-    query = db.query(models.CarePlan)
-    
-    if current_user.role == models.UserRole.ADMIN:
-        # Dla kosmetologa - filtruj po klientach, których obsługuje
-        if client_id:
-            client = db.query(models.Client).filter(models.Client.id == client_id).first()
-            if not client or client.cosmetologist_id != current_user.id:
-                raise HTTPException(status_code=403, detail="No permission for this client")
-            query = query.filter(models.CarePlan.client_id == client_id)
-        else:
-            # Jeśli nie podano client_id, pobierz wszystkich klientów kosmetologa
-            clients = db.query(models.Client).filter(
-                models.Client.cosmetologist_id == current_user.id
-            ).all()
-            client_ids = [client.id for client in clients]
-            query = query.filter(models.CarePlan.client_id.in_(client_ids))
-    else:
-        # Dla klienta - pokaż tylko jego plany
-        client = db.query(models.Client).filter(models.Client.user_id == current_user.id).first()
-        if not client:
-            raise HTTPException(status_code=404, detail="Client profile not found")
-        query = query.filter(models.CarePlan.client_id == client.id)
-    
-    care_plans = query.order_by(models.CarePlan.created_at.desc()).offset(skip).limit(limit).all()
-    return care_plans
+    # Kosmetolog - plany jego klientów (opcjonalnie jednej), klientka - własne plany
+    scope = access.ClientScope(current_user)
+    is_admin = current_user.role == models.UserRole.ADMIN
+    query = crud.care_plans_query(scope, client_id if is_admin else None)
+    
+    try:
+        care_plans, before_cursor, after_cursor = await crud.paginate_keyset(
+            db, query, **crud.CARE_PLANS_KEYSET, limit=limit, before=before, after=after,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    
+    # Pusta strona - dopiero wtedy sprawdzamy, czy to brak uprawnień / profilu, czy po prostu brak planów
+    if not care_plans:
+        if is_admin and client_id:
+            await scope.fetch_client(db, client_id)
+        elif not is_admin:
+            # Dla klientki zakres to jej własny profil
+            if (await db.execute(scope.client_ids())).first() is None:
+                raise HTTPException(status_code=404, detail="Client profile not found")
+    return {"items": care_plans, "before": before_cursor, "after": after_cursor}
 
 @app.get("/care-plans/{care_plan_id}", response_model=schemas.CarePlanDetail)
-async def read_care_plan(care_plan_id: int, db: Session = Depends(get_db),
+async def read_care_plan(care_plan_id: int, db: AsyncSession = Depends(get_async_db),
                          current_user: schemas.User = Depends(get_current_active_user)):
-    db_care_plan = db.query(models.CarePlan).filter(models.CarePlan.id == care_plan_id).first()
-    if db_care_plan is None:
-        raise HTTPException(status_code=404, detail="Care plan not found")
-    
-    # Sprawdź uprawnienia
-    if current_user.role == models.UserRole.ADMIN:
-        # Kosmetolog musi być przypisany do klienta
-        client = db.query(models.Client).filter(models.Client.id == db_care_plan.client_id).first()
-        if not client or client.cosmetologist_id != current_user.id:
-            raise HTTPException(status_code=403, detail="No permission for this care plan")
-    else:
-        # Klient może zobaczyć tylko swoje plany
-        client = db.query(models.Client).filter(models.Client.user_id == current_user.id).first()
-        if not client or client.id != db_care_plan.client_id:
-            raise HTTPException(status_code=403, detail="No permission for this care plan")
-    
-    return db_care_plan
+    # Relacje ładowane z góry, stała liczba zapytań niezależnie od liczby pozycji
+    # (AsyncSession i tak nie pozwala na leniwe ładowanie przy serializacji);
+    # uprawnienia sprawdzane w tym samym zapytaniu co plan
+    return await access.ClientScope(current_user).fetch(
+        db, crud.care_plan_detail_query(care_plan_id), models.CarePlan.client_id,
+        "Care plan not found", "No permission for this care plan",
+    )
 
 @app.put("/care-plans/{care_plan_id}", response_model=schemas.CarePlan)
 async def update_care_plan(
     care_plan_id: int, 
     care_plan_update: schemas.CarePlanCreate,  # Używamy tego samego schematu, bo chcemy móc aktualizować również produkty
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_admin_user)
 ):
-    db_care_plan = db.query(models.CarePlan).filter(models.CarePlan.id == care_plan_id).first()
-    if db_care_plan is None:
-        raise HTTPException(status_code=404, detail="Care plan not found")
+    # Plan i uprawnienia kosmetologa jednym zapytaniem
+    db_care_plan = await access.ClientScope(current_user).fetch(
+        db, crud.care_plan_query(care_plan_id), models.CarePlan.client_id,
+        "Care plan not found", "No permission for this care plan",
+    )
     
-    # Sprawdź czy kosmetolog ma uprawnienia
-    client = db.query(models.Client).filter(models.Client.id == db_care_plan.client_id).first()
-    if not client or client.cosmetologist_id != current_user.id:
-        raise HTTPException(status_code=403, detail="No permission for this care plan")
+    # Sprawdź wszystkie produkty jednym zapytaniem - przed jakimkolwiek zapisem
+    missing = await crud.find_missing_product_ids(db, (item.product_id for item in care_plan_update.items))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Product with id {missing[0]} not found")
     
     # Zaktualizuj podstawowe dane
     db_care_plan.title = care_plan_update.title
     db_care_plan.description = care_plan_update.description
     db_care_plan.valid_until = care_plan_update.valid_until
     
-    # Usuń obecne produkty z planu
-    db.query(models.CarePlanItem).filter(models.CarePlanItem.care_plan_id == care_plan_id).delete()
+    # Zsynchronizuj produkty planu - tylko faktycznie zmienione wiersze
+    await crud.sync_care_plan_items(db, db_care_plan.id, care_plan_update.items)
     
-    # Dodaj nowe produkty
-    for i, item in enumerate(care_plan_update.items):
-        db_product = db.query(models.Product).filter(models.Product.id == item.product_id).first()
-        if not db_product:
-            raise HTTPException(status_code=404, detail=f"Product with id {item.product_id} not found")
-        
-        db_item = models.CarePlanItem(
-            care_plan_id=db_care_plan.id,
-            product_id=item.product_id,
-            usage_time=item.usage_time,
-            usage_frequency=item.usage_frequency,
-            usage_instructions=item.usage_instructions,
-            order=item.order or i
-        )
-        db.add(db_item)
-    
-    db.commit()
-    db.refresh(db_care_plan)
+    await db.commit()
+    await db.refresh(db_care_plan)
     return db_care_plan
 
 @app.delete("/care-plans/{care_plan_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_care_plan(
     care_plan_id: int, 
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_admin_user)
 ):
-    db_care_plan = db.query(models.CarePlan).filter(models.CarePlan.id == care_plan_id).first()
-    if db_care_plan is None:
-        raise HTTPException(status_code=404, detail="Care plan not found")
-    
-    # Sprawdź czy kosmetolog ma uprawnienia do tego planu
-    client = db.query(models.Client).filter(models.Client.id == db_care_plan.client_id).first()
-    if not client or client.cosmetologist_id != current_user.id:
-        raise HTTPException(status_code=403, detail="No permission for this care plan")
+    # Plan i uprawnienia kosmetologa jednym zapytaniem
+    await access.ClientScope(current_user).fetch(
+        db, select(models.CarePlan.id).where(models.CarePlan.id == care_plan_id), models.CarePlan.client_id,
+        "Care plan not found", "No permission for this care plan",
+    )
     
     # Usuń wszystkie elementy planu
-    db.query(models.CarePlanItem).filter(models.CarePlanItem.care_plan_id == care_plan_id).delete()
+    await db.execute(delete(models.CarePlanItem).where(models.CarePlanItem.care_plan_id == care_plan_id))
     
-    # Usuń plan
-    db.delete(db_care_plan)
-    db.commit()
+    # Usuń plan (zapytaniem - ORM-owe db.delete() próbowałoby leniwie ładować relację items)
+    await db.execute(delete(models.CarePlan).where(models.CarePlan.id == care_plan_id))
+    await db.commit()
     return {}
 
+# === IMAGE UPLOAD ENDPOINTS ===
+
+async def create_analysis_for_image(db: AsyncSession, client_id: int, current_user, stored: uploads.StoredImage):
+    db_analysis = models.Analysis(client_id=client_id, created_by=current_user.id, image_path=stored.path)
+    db.add(db_analysis)
+    await db.commit()
+    await db.refresh(db_analysis)
+    # Miniatury i wersje WebP/JPEG generowane w tle (pula procesów)
+    images.schedule_derivatives(stored.path, stored.sha256)
+    return db_analysis
+
+async def get_cosmetologist_client(db: AsyncSession, client_id: int, current_user) -> models.Client:
+    return await access.ClientScope(current_user).fetch_client(db, client_id)
+
+async def get_cosmetologist_analysis(db: AsyncSession, analysis_id: int, current_user) -> models.Analysis:
+    # Analiza i uprawnienia kosmetologa do jej klientki jednym zapytaniem
+    return await access.ClientScope(current_user).fetch(
+        db, crud.analysis_query(analysis_id), models.Analysis.client_id,
+        "Analysis not found", "No permission for this client",
+    )
+
+@app.post("/upload-image/", response_model=schemas.Analysis)
+async def upload_image(
+    client_id: int = Form(...),
+    file: UploadFile = File(...),
+    content_length: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    uploads.check_content_length(content_length)
+    await get_cosmetologist_client(db, client_id, current_user)
+    
+    # Zapis kawałkami na dysk z limitem rozmiaru i kontrolą nagłówka; duplikaty trafiają do tego samego pliku
+    stored = await uploads.store_upload(file)
+    return await create_analysis_for_image(db, client_id, current_user, stored)
+
+@app.post("/upload-image-base64/", response_model=schemas.Analysis)
+async def upload_image_base64(
+    image: schemas.ImageUpload,
+    content_length: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    # base64 zajmuje 4/3 rozmiaru pliku
+    uploads.check_content_length(content_length, overhead=uploads.UPLOAD_MAX_BYTES // 3 + uploads.MULTIPART_OVERHEAD_BYTES)
+    await get_cosmetologist_client(db, image.client_id, current_user)
+    
+    stored = await uploads.store_base64(image.image_data)
+    return await create_analysis_for_image(db, image.client_id, current_user, stored)
+
+@app.get("/analyses/{analysis_id}/image")
+async def read_analysis_image(
+    analysis_id: int,
+    request: Request,
+    variant: str = Query("medium", regex="^(thumb|medium|full|original)$"),
+    format: Optional[str] = Query(None, regex="^(webp|jpeg)$"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_active_user)
+):
+    db_analysis = await access.ClientScope(current_user, allow_superadmin=True).fetch(
+        db, crud.analysis_query(analysis_id), models.Analysis.client_id,
+        "Analysis not found", "No permission for this analysis",
+    )
+    if not db_analysis.image_path or not os.path.exists(db_analysis.image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    source_path = db_analysis.image_path
+    key = images.source_key(source_path)
+    if variant != "original":
+        # Format z parametru albo z nagłówka Accept (WebP, jeśli przeglądarka go obsługuje)
+        fmt = format or images.preferred_format(request.headers.get("accept"))
+        path = images.derivative_path(key, variant, fmt)
+        if not os.path.exists(path):
+            try:
+                # shield - rozłączenie klienta nie przerywa generowania współdzielonego z innymi żądaniami
+                await asyncio.shield(images.ensure_derivatives(source_path, key))
+            except Exception as e:
+                logger.error(f"❌ Błąd generowania miniatur analizy {analysis_id}: {e}")
+                raise HTTPException(status_code=415, detail="Image variant cannot be generated")
+        return images.file_response(
+            request, path, images.FORMATS[fmt], images.derivative_etag(key, variant, fmt), vary_accept=format is None,
+        )
+    
+    extension = os.path.splitext(source_path)[1].lstrip(".").lower()
+    media_type = images.ORIGINAL_MEDIA_TYPES.get(extension, "application/octet-stream")
+    return images.file_response(request, source_path, media_type, f'"{key}"')
+
+# === AI ANALYSIS ENDPOINTS ===
+
+async def analysis_job_response(db: AsyncSession, job) -> dict:
+    analysis = None
+    if job.status == models.JobStatus.SUCCEEDED:
+        analysis = await db.get(models.Analysis, job.analysis_id)
+    return {**vars(job), "analysis": analysis}
+
+@app.post("/analyze", response_model=schemas.AnalysisJob, status_code=status.HTTP_202_ACCEPTED)
+async def analyze_image(
+    client_id: int = Form(...),
+    image: UploadFile = File(...),
+    content_length: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    # Analiza AI w tle - odpowiedź od razu z id zadania, wynik przez GET /analyze/jobs/{job_id}
+    uploads.check_content_length(content_length)
+    await get_cosmetologist_client(db, client_id, current_user)
+    
+    stored = await uploads.store_upload(image)
+    db_analysis = await create_analysis_for_image(db, client_id, current_user, stored)
+    job = await job_queue.enqueue(db_analysis.id)
+    return await analysis_job_response(db, job)
+
+@app.post("/analyses/{analysis_id}/analyze", response_model=schemas.AnalysisJob, status_code=status.HTTP_202_ACCEPTED)
+async def analyze_existing_image(
+    analysis_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    # Analiza zdjęcia wgranego wcześniej przez /upload-image/ (lub ponowienie po błędzie)
+    db_analysis = await get_cosmetologist_analysis(db, analysis_id, current_user)
+    if not db_analysis.image_path:
+        raise HTTPException(status_code=400, detail="Analysis has no image")
+    
+    job = await job_queue.enqueue(db_analysis.id)
+    return await analysis_job_response(db, job)
+
+@app.get("/analyze/jobs/{job_id}", response_model=schemas.AnalysisJob)
+async def read_analysis_job(
+    job_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+    await get_cosmetologist_analysis(db, job.analysis_id, current_user)
+    return await analysis_job_response(db, job)
+
+@app.post("/analyses/{analysis_id}/recommend-products", response_model=List[schemas.Product])
+async def recommend_products(
+    analysis_id: int,
+    limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    db_analysis = await get_cosmetologist_analysis(db, analysis_id, current_user)
+    
+    # Ten sam ranking co w zadaniu analizy (jobs.run_job) - macierz katalogu w scoring.py
+    product_ids = (await scoring.scorer.recommend(db, [db_analysis], limit))[0]
+    products = await crud.get_products_in_order(db, product_ids)
+    await crud.set_recommended_products(db, analysis_id, product_ids)
+    await db.commit()
+    return products
+
+# === PRODUCT ENDPOINTS ===
+
+@app.get("/products/", response_model=schemas.ProductSearchPage)
+async def search_products(
+    q: Optional[str] = Query(None, max_length=200),
+    category: Optional[str] = None,
+    brand: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=10000),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_active_user)
+):
+    # Wyszukiwanie pełnotekstowe + literówki (pg_trgm) po stronie bazy, z facetami kategorii i marek
+    return await crud.search_products(db, q=q, category=category, brand=brand, limit=limit, offset=offset)
+
+@app.post("/products/", response_model=schemas.Product)
+async def create_product(
+    product: schemas.ProductCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    db_product = models.Product(**product.dict(exclude={"skin_types", "skin_concerns"}))
+    crud.set_product_traits(db_product, product.skin_types, product.skin_concerns)
+    db.add(db_product)
+    await db.commit()
+    return await crud.get_product(db, db_product.id, refresh=True)
+
+@app.put("/products/{product_id}", response_model=schemas.Product)
+async def update_product(
+    product_id: int,
+    product_update: schemas.ProductUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    db_product = await crud.get_product(db, product_id)
+    if db_product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    update_data = product_update.dict(exclude_unset=True)
+    skin_types = update_data.pop("skin_types", None)
+    skin_concerns = update_data.pop("skin_concerns", None)
+    for field, value in update_data.items():
+        setattr(db_product, field, value)
+    # Zmieniane tylko różnice w tabelach łączących
+    crud.set_product_traits(db_product, skin_types, skin_concerns)
+    
+    await db.commit()
+    return await crud.get_product(db, product_id, refresh=True)
+
+@app.get("/products/{product_id}", response_model=schemas.Product)
+async def read_product(
+    product_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_active_user)
+):
+    db_product = await crud.get_product(db, product_id)
+    if db_product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return db_product
+
 # === CHAT ENDPOINTS ===
 
+CHAT_WS_HEARTBEAT_SECONDS = float(os.getenv("CHAT_WS_HEARTBEAT_SECONDS", "25"))
+CHAT_WS_SEND_TIMEOUT_SECONDS = float(os.getenv("CHAT_WS_SEND_TIMEOUT_SECONDS", "10"))
+# Cache podsumowań rozmów per kosmetolog; 0 wyłącza. Unieważniany przy nowej wiadomości i odczycie.
+CHAT_SUMMARY_CACHE_TTL_SECONDS = float(os.getenv("CHAT_SUMMARY_CACHE_TTL_SECONDS", "15"))
+conversation_summary_cache = TTLCache(
+    maxsize=1024 if CHAT_SUMMARY_CACHE_TTL_SECONDS > 0 else 0, ttl=CHAT_SUMMARY_CACHE_TTL_SECONDS
+)
+
+async def publish_chat_event(client_id: int, event: dict):
+    # Wiadomość jest już zapisana - błąd brokera nie może zepsuć odpowiedzi HTTP
+    try:
+        await chat_broker.publish(chat_topic(client_id), event)
+    except Exception as e:
+        logger.error(f"❌ Błąd publikacji zdarzenia czatu: {e}")
+
 @app.post("/chat/messages/", response_model=schemas.ChatMessage)
 async def create_chat_message(
     message: schemas.ChatMessageCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_current_active_user)
 ):
-    # Znajdź klienta
-    db_client = db.query(models.Client).filter(models.Client.id == message.client_id).first()
-    if not db_client:
-        raise HTTPException(status_code=404, detail="Client not found")
+    # Klient i uprawnienia jednym zapytaniem: kosmetolog musi być przypisany do klienta,
+    # klient może pisać tylko we własnym imieniu
+    db_client = await access.ClientScope(current_user).fetch_client(db, message.client_id, access.forbidden_for(
+        current_user, "No permission for this client", "You can only send messages as yourself",
+    ))
     
-    # Sprawdź uprawnienia
-    if current_user.role == models.UserRole.ADMIN:
-        # Kosmetolog musi być przypisany do klienta
-        if db_client.cosmetologist_id != current_user.id:
-            raise HTTPException(status_code=403, detail="No permission for this client")
-    else:
-        # Klient może pisać tylko we własnym imieniu
-        if db_client.user_id != current_user.id:
-            raise HTTPException(status_code=403, detail="You can only send messages as yourself")
-        
-        # Dla klienta, is_from_client musi być True
-        if not message.is_from_client:
-            raise HTTPException(status_code=400, detail="Clients can only send messages from themselves")
+    # Dla klienta, is_from_client musi być True
+    if current_user.role != models.UserRole.ADMIN and not message.is_from_client:
+        raise HTTPException(status_code=400, detail="Clients can only send messages from themselves")
     
     # Utwórz wiadomość
     db_message = models.ChatMessage(
@@ -217,177 +416,280 @@ async def create_chat_message(
     )
     
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
+    await db.refresh(db_message)
+    conversation_summary_cache.pop(db_client.cosmetologist_id)
+    
+    # Powiadom otwarte połączenia WebSocket tej rozmowy
+    await publish_chat_event(message.client_id, {
+        "type": "message",
+        "id": db_message.id,
+        "client_id": message.client_id,
+        "message": json.loads(schemas.ChatMessage.from_orm(db_message).json()),
+    })
     return db_message
 
-@app.get("/chat/messages/{client_id}", response_model=List[schemas.ChatMessage])
+@app.get("/chat/messages/{client_id}", response_model=schemas.ChatMessagePage)
 async def read_chat_messages(
     client_id: int,
-    skip: int = 0,
-    limit: int = 50,
-    db: Session = Depends(get_db),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_current_active_user)
 ):
-    # Znajdź klienta
-    db_client = db.query(models.Client).filter(models.Client.id == client_id).first()
-    if not db_client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    
-    # Sprawdź uprawnienia
-    if current_user.role == models.UserRole.ADMIN:
-        # Kosmetolog musi być przypisany do klienta
-        if db_client.cosmetologist_id != current_user.id:
-            raise HTTPException(status_code=403, detail="No permission for this client")
-    else:
-        # Klient może czytać tylko swoje wiadomości
-        if db_client.user_id != current_user.id:
-            raise HTTPException(status_code=403, detail="You can only read your own messages")
-    
-    # Pobierz wiadomości
-    messages = db.query(models.ChatMessage).filter(
-        models.ChatMessage.client_id == client_id
-    ).order_by(models.ChatMessage.sent_at.desc()).offset(skip).limit(limit).all()
+    # Pobierz wiadomości - bez kursora najnowsze; `before` = starsze, `after` = nowsze od kursora.
+    # Na każdej stronie najstarsze wiadomości są pierwsze.
+    scope = access.ClientScope(current_user)
+    try:
+        messages, before_cursor, after_cursor = await crud.paginate_keyset(
+            db, crud.chat_messages_query(scope, client_id), **crud.CHAT_MESSAGES_KEYSET,
+            limit=limit, before=before, after=after,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
     
-    # Odwróć listę, aby najstarsze wiadomości były pierwsze
-    messages.reverse()
+    # Pusta strona - brak klienta (404), brak uprawnień (403) albo po prostu brak wiadomości
+    if not messages:
+        await scope.fetch_client(db, client_id, access.forbidden_for(
+            current_user, "No permission for this client", "You can only read your own messages",
+        ))
     
-    return messages
+    return {"items": messages, "before": before_cursor, "after": after_cursor}
 
 @app.put("/chat/messages/{message_id}/read", response_model=schemas.ChatMessage)
 async def mark_message_as_read(
     message_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_current_active_user)
 ):
-    # Znajdź wiadomość
-    db_message = db.query(models.ChatMessage).filter(models.ChatMessage.id == message_id).first()
-    if not db_message:
-        raise HTTPException(status_code=404, detail="Message not found")
-    
-    # Znajdź klienta
-    db_client = db.query(models.Client).filter(models.Client.id == db_message.client_id).first()
-    if not db_client:
-        raise HTTPException(status_code=404, detail="Client not found")
+    # Wiadomość, kosmetolog rozmowy (klucz cache podsumowań) i uprawnienia jednym zapytaniem
+    db_message, cosmetologist_id = await access.ClientScope(current_user).fetch(
+        db,
+        crud.chat_message_query(message_id),
+        models.Client.id,
+        "Message not found",
+        access.forbidden_for(current_user, "No permission for this message", "You can only read your own messages"),
+    )
     
-    # Sprawdź uprawnienia
     if current_user.role == models.UserRole.ADMIN:
-        # Kosmetolog musi być przypisany do klienta
-        if db_client.cosmetologist_id != current_user.id:
-            raise HTTPException(status_code=403, detail="No permission for this message")
-        
         # Kosmetolog może oznaczać jako przeczytane tylko wiadomości od klienta
         if not db_message.is_from_client:
             raise HTTPException(status_code=400, detail="Can only mark client messages as read")
     else:
-        # Klient może oznaczać jako przeczytane tylko wiadomości od kosmetologa
-        if db_client.user_id != current_user.id:
-            raise HTTPException(status_code=403, detail="You can only read your own messages")
-        
         # Klient może oznaczać jako przeczytane tylko wiadomości od kosmetologa
         if db_message.is_from_client:
             raise HTTPException(status_code=400, detail="Can only mark cosmetologist messages as read")
     
     # Oznacz jako przeczytane
     db_message.read_at = datetime.utcnow()
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
+    await db.refresh(db_message)
+    conversation_summary_cache.pop(cosmetologist_id)
+    
+    await publish_chat_event(db_message.client_id, {
+        "type": "read",
+        "client_id": db_message.client_id,
+        "message_ids": [db_message.id],
+        "read_at": db_message.read_at.isoformat(),
+    })
     
     return db_message
 
+@app.get("/chat/conversations/", response_model=List[schemas.ConversationSummary])
+async def read_conversation_summaries(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    # Liczniki nieprzeczytanych i ostatnia wiadomość dla wszystkich klientów kosmetologa - jedno zapytanie
+    summaries = conversation_summary_cache.get(current_user.id)
+    if summaries is None:
+        rows = (await db.execute(crud.conversation_summary_query(current_user.id))).mappings().all()
+        summaries = [dict(row) for row in rows]
+        conversation_summary_cache.set(current_user.id, summaries)
+    return summaries
+
+@app.post("/chat/conversations/{client_id}/read", response_model=schemas.ChatMarkReadResult)
+async def mark_conversation_as_read(
+    client_id: int,
+    mark: schemas.ChatMarkRead,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_active_user)
+):
+    # Klient i uprawnienia jednym zapytaniem; kierunek jak w mark_message_as_read:
+    # kosmetolog oznacza wiadomości od klienta, klient - wiadomości od kosmetologa
+    db_client = await access.ClientScope(current_user).fetch_client(db, client_id, access.forbidden_for(
+        current_user, "No permission for this client", "You can only read your own messages",
+    ))
+    from_client = current_user.role == models.UserRole.ADMIN
+    
+    read_at = datetime.utcnow()
+    stmt = crud.mark_conversation_read_statement(client_id, from_client, read_at, mark.up_to_id, mark.up_to)
+    message_ids = (await db.execute(stmt)).scalars().all()
+    await db.commit()
+    if message_ids:
+        conversation_summary_cache.pop(db_client.cosmetologist_id)
+    
+    if message_ids:
+        await publish_chat_event(client_id, {
+            "type": "read",
+            "client_id": client_id,
+            "message_ids": sorted(message_ids),
+            "read_at": read_at.isoformat(),
+        })
+    
+    return {"updated": len(message_ids)}
+
+@app.websocket("/ws/chat/{client_id}")
+async def chat_websocket(websocket: WebSocket, client_id: int, token: str = Query(...)):
+    # Przeglądarka nie ustawi nagłówka Authorization dla WebSocket - token w parametrze zapytania
+    async with AsyncSessionLocal() as db:
+        current_user = await resolve_principal(token, db)
+        allowed = False
+        if current_user is not None and current_user.is_active:
+            # Te same zasady co przy odczycie historii czatu
+            allowed = bool((await db.execute(select(access.ClientScope(current_user).owns(client_id)))).scalar())
+    
+    if not allowed:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    subscription = chat_broker.subscribe(chat_topic(client_id))
+    
+    async def send_events():
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), timeout=CHAT_WS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Heartbeat - utrzymuje połączenie przez proxy i wykrywa martwych odbiorców
+                event = {"type": "ping"}
+            if event is None:
+                # Broker zamknął subskrypcję (zdarzenia mogły przepaść) - zamknij od razu, klient dociąga historię
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            await asyncio.wait_for(websocket.send_json(event), timeout=CHAT_WS_SEND_TIMEOUT_SECONDS)
+            if subscription.overflowed and subscription.queue.empty():
+                # Odbiorca nie nadążał - zamknij, klient dociąga historię przez ?after=
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+    
+    async def receive_messages():
+        # Klient nic nie musi wysyłać; czytamy, żeby wykryć rozłączenie
+        while True:
+            await websocket.receive_text()
+    
+    tasks = [asyncio.create_task(send_events()), asyncio.create_task(receive_messages())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        chat_broker.unsubscribe(subscription)
+
 # === PDF EXPORT ENDPOINT ===
 
 @app.get("/care-plans/{care_plan_id}/pdf", response_class=StreamingResponse)
 async def export_care_plan_to_pdf(
     care_plan_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.User = Depends(get_current_active_user)
 ):
-    db_care_plan = db.query(models.CarePlan).filter(models.CarePlan.id == care_plan_id).first()
-    if db_care_plan is None:
-        raise HTTPException(status_code=404, detail="Care plan not found")
-    
-    # Sprawdź uprawnienia
-    if current_user.role == models.UserRole.ADMIN:
-        # Kosmetolog musi być przypisany do klienta
-        client = db.query(models.Client).filter(models.Client.id == db_care_plan.client_id).first()
-        if not client or client.cosmetologist_id != current_user.id:
-            raise HTTPException(status_code=403, detail="No permission for this care plan")
-    else:
-        # Klient może zobaczyć tylko swoje plany
-        client = db.query(models.Client).filter(models.Client.user_id == current_user.id).first()
-        if not client or client.id != db_care_plan.client_id:
-            raise HTTPException(status_code=403, detail="No permission for this care plan")
-    
-    # Załaduj dane potrzebne do generowania PDF
-    care_plan_items = db.query(models.CarePlanItem).filter(
-        models.CarePlanItem.care_plan_id == care_plan_id
-    ).order_by(models.CarePlanItem.order).all()
-    
-    products = []
-    for item in care_plan_items:
-        product = db.query(models.Product).filter(models.Product.id == item.product_id).first()
-        products.append({
-            "item": item,
-            "product": product
-        })
-    
-    client = db.query(models.Client).filter(models.Client.id == db_care_plan.client_id).first()
-    client_user = db.query(models.User).filter(models.User.id == client.user_id).first()
-    analysis = db.query(models.Analysis).filter(models.Analysis.id == db_care_plan.analysis_id).first()
-    
-    # Tutaj powinien być kod generujący PDF
-    # W rzeczywistej implementacji należy użyć biblioteki takiej jak ReportLab, WeasyPrint lub podobnej
-    # Zwracamy tutaj tylko symulowaną odpowiedź
-    
-    # Symulacja generowania PDF
-    content = f"""
-    Plan pielęgnacyjny: {db_care_plan.title}
-    
-    Klientka: {client_user.full_name}
-    Data utworzenia: {db_care_plan.created_at}
-    Ważny do: {db_care_plan.valid_until}
-    
-    Opis planu: 
-    {db_care_plan.description}
-    
-    Produkty:
-    """
-    
-    for p in products:
-        content += f"""
-        - {p['product'].name} ({p['product'].brand})
-          Czas stosowania: {p['item'].usage_time or 'Nie określono'}
-          Częstotliwość: {p['item'].usage_frequency or 'Nie określono'}
-          Instrukcje: {p['item'].usage_instructions or 'Brak szczegółowych instrukcji'}
-        """
-    
-    content += f"""
-    Analiza skóry:
-    Typ skóry: {analysis.skin_type.value if analysis.skin_type else 'Nie określono'}
-    Poziom nawilżenia: {analysis.hydration_level}%
-    Poziom sebum: {analysis.sebum_level}%
-    Przebarwienia: {analysis.pigmentation}%
-    Zmarszczki: {analysis.wrinkles}%
-    Pory: {analysis.pores}%
-    Wrażliwość: {analysis.sensitivity}%
+    # Wszystkie dane do PDF (plan, klient, analiza, produkty) i uprawnienia jednym zapytaniem
+    db_care_plan = await access.ClientScope(current_user).fetch(
+        db, crud.care_plan_export_query(care_plan_id), models.CarePlan.client_id,
+        "Care plan not found", "No permission for this care plan", unique=True,
+    )
     
-    Rekomendacje AI:
-    {analysis.ai_recommendations or 'Brak rekomendacji AI'}
+    snapshot = pdf.care_plan_snapshot(db_care_plan)
+    cache_key = (care_plan_id, pdf.snapshot_version(snapshot))
+    headers = {"Content-Disposition": f"attachment; filename=care_plan_{care_plan_id}.pdf"}
     
-    ---
-    BeautyAI - System wspierający kosmetologów w analizie skóry
-    """
+    # Niezmieniony plan - gotowy PDF z cache, bez renderowania
+    cached = pdf.pdf_cache.get(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/pdf", headers=headers)
     
-    # W rzeczywistej implementacji należałoby użyć biblioteki do generowania PDF
-    # Tutaj zwracamy tylko tekst jako symulację
+    async def pdf_streamer():
+        # Renderowanie w puli wątków, strony wysyłane w miarę powstawania
+        chunks = []
+        async for chunk in iterate_in_threadpool(pdf.render_care_plan_pdf(snapshot)):
+            chunks.append(chunk)
+            yield chunk
+        pdf.pdf_cache.set(cache_key, b"".join(chunks))
     
-    # Symulacja odpowiedzi ze streamingiem pliku
-    async def fake_pdf_streamer():
-        yield content.encode()
+    return StreamingResponse(pdf_streamer(), media_type="application/pdf", headers=headers)
+
+PDF_EXPORT_BATCH_SIZE = int(os.getenv("PDF_EXPORT_BATCH_SIZE", "50"))
+
+@app.post("/care-plans/export", response_class=StreamingResponse)
+async def export_care_plans_to_zip(
+    export_filter: schemas.CarePlanExportFilter,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_admin_user)
+):
+    # Kosmetolog eksportuje plany swoich klientów; superadmin musi wskazać kosmetologa -
+    # jego własne id nie ma klientów i dawałoby mylące 404
+    if current_user.role == models.UserRole.SUPERADMIN and export_filter.cosmetologist_id is None:
+        raise HTTPException(status_code=422, detail="cosmetologist_id is required for superadmin export")
+    cosmetologist_id = export_filter.cosmetologist_id or current_user.id
+    if cosmetologist_id != current_user.id and current_user.role != models.UserRole.SUPERADMIN:
+        raise HTTPException(status_code=403, detail="No permission for this cosmetologist")
+    
+    care_plan_ids = (await db.execute(crud.care_plan_export_ids_query(cosmetologist_id, export_filter))).scalars().all()
+    if not care_plan_ids:
+        raise HTTPException(status_code=404, detail="No care plans match the filter")
+    
+    async def snapshots():
+        # Dane ładowane paczkami we własnej sesji - w pamięci jest tylko bieżąca paczka
+        async with AsyncSessionLocal() as export_db:
+            for start in range(0, len(care_plan_ids), PDF_EXPORT_BATCH_SIZE):
+                batch = care_plan_ids[start:start + PDF_EXPORT_BATCH_SIZE]
+                plans = (await export_db.execute(crud.care_plans_export_query(batch))).scalars().all()
+                for db_care_plan in plans:
+                    yield db_care_plan.client_id, pdf.care_plan_snapshot(db_care_plan)
+                export_db.expunge_all()
+    
+    async def zip_streamer():
+        # PDF-y renderowane równolegle w puli procesów; w locie najwyżej 2 zadania na proces,
+        # każdy gotowy plik od razu trafia do archiwum i do klienta. Eksport korzysta z pdf_cache,
+        # ale go nie wypełnia - jednorazowe rendery wypychałyby pliki pobierane pojedynczo
+        loop = asyncio.get_running_loop()
+        pool = pdf.get_process_pool()
+        writer = pdf.ZipStreamWriter()
+        max_in_flight = 2 * pdf.PDF_RENDER_PROCESSES
+        pending = {}
+        
+        async def drain(return_when):
+            done, _ = await asyncio.wait(pending, return_when=return_when)
+            chunks = []
+            for future in done:
+                chunks.append(writer.add(pending.pop(future), future.result()))
+            return chunks
+        
+        try:
+            async for client_id, snapshot in snapshots():
+                name = f"client_{client_id}/care_plan_{snapshot['id']}.pdf"
+                cached = pdf.pdf_cache.get((snapshot["id"], pdf.snapshot_version(snapshot)))
+                if cached is not None:
+                    yield writer.add(name, cached)
+                    continue
+                future = loop.run_in_executor(pool, pdf.render_care_plan_pdf_bytes, snapshot)
+                pending[future] = name
+                if len(pending) >= max_in_flight:
+                    for chunk in await drain(asyncio.FIRST_COMPLETED):
+                        yield chunk
+            if pending:
+                for chunk in await drain(asyncio.ALL_COMPLETED):
+                    yield chunk
+            yield writer.close()
+        finally:
+            for future in pending:
+                future.cancel()
     
     return StreamingResponse(
-        fake_pdf_streamer(),
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename=care_plan_{care_plan_id}.pdf"}
+        zip_streamer(),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=care_plans.zip"},
     )
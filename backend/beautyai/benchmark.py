@@ -0,0 +1,435 @@
+# benchmark.py - Load test of the in-process API on seeded data, compared against a stored baseline
+#
+# Wypełnia bazę danymi (Postgres: generate_series jak w explain_check, SQLite: wsadowe INSERT-y),
+# uruchamia aplikację FastAPI w procesie (httpx, bez serwera HTTP) i mierzy scenariusze: logowanie,
+# CRUD planów pielęgnacji, historię czatu, eksport PDF i upload zdjęcia. Raport: p50/p95/p99, przepustowość
+# i liczba zapytań SQL na żądanie (histogram http_request_db_queries z metrics.py).
+# Wynik porównywany z zapisanym pomiarem bazowym - regresja = kod wyjścia 1.
+# Uruchamiać na osobnej bazie, nie produkcyjnej:
+#   DATABASE_URL=sqlite:///./benchmark.db python -m backend.beautyai.benchmark --save-baseline
+#   DATABASE_URL=postgresql://.../beautyai_bench python -m backend.beautyai.benchmark --scale 5
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
+
+from PIL import Image
+from sqlalchemy import func, insert, select, update
+
+from backend.beautyai import explain_check, inference, jobs, metrics, models
+from backend.beautyai.database import engine
+
+# Względem bieżącego katalogu - pomiar zależy od maszyny, nie należy do źródeł pakietu
+BASELINE_PATH = "benchmark_baseline.json"
+BENCHMARK_PASSWORD = "benchmark-password"
+# Plan z dużą liczbą pozycji - odczyt i eksport PDF
+LARGE_CARE_PLAN_TITLE = "Benchmark: duży plan"
+LARGE_CARE_PLAN_ITEMS = 60
+CREATED_CARE_PLAN_ITEMS = 10
+INSERT_BATCH_SIZE = 10_000
+# Dopuszczalne odchylenia bezwzględne - szum przy bardzo krótkich czasach i średnich liczbach zapytań
+LATENCY_SLACK_MS = 2.0
+QUERY_COUNT_SLACK = 0.5
+
+# === DATA GENERATOR ===
+
+def _insert_batches(conn, table, rows):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, INSERT_BATCH_SIZE))
+        if not batch:
+            return
+        conn.execute(insert(table), batch)
+
+def seed_batched(conn, scale: float):
+    # Te same liczności i rozkład co explain_check.seed, bez generate_series (SQLite); identyfikatory od 1
+    sizes = {name: max(1, int(value * scale)) for name, value in explain_check.SEED_SIZES.items()}
+    cosmetologists, clients, products = sizes["cosmetologists"], sizes["clients"], sizes["products"]
+    per_client = explain_check.ANALYSES_PER_CLIENT
+    start = explain_check.SEED_START
+
+    _insert_batches(conn, models.User.__table__, (
+        {
+            "id": n, "email": f"user{n}@example.com", "hashed_password": "x", "full_name": f"User {n}",
+            "role": models.UserRole.ADMIN if n <= cosmetologists else models.UserRole.CLIENT, "is_active": True,
+        }
+        for n in range(1, cosmetologists + clients + 1)
+    ))
+    _insert_batches(conn, models.Client.__table__, (
+        {"id": n, "user_id": cosmetologists + n, "cosmetologist_id": 1 + (cosmetologists + n) % cosmetologists,
+         "phone": "+48 600 000 000"}
+        for n in range(1, clients + 1)
+    ))
+
+    _insert_batches(conn, models.Product.__table__, (
+        {
+            "id": n, "name": f"Produkt {n}", "brand": f"Marka {n % 150}", "category": f"Kategoria {n % 12}",
+            "description": f"Opis produktu {n}", "price": 10 + n % 200,
+        }
+        for n in range(1, products + 1)
+    ))
+    skin_types, concerns = list(models.SkinType), list(models.SkinConcern)
+    _insert_batches(conn, models.ProductSkinType.__table__, (
+        {"product_id": n, "skin_type": skin_types[n % len(skin_types)]} for n in range(1, products + 1)
+    ))
+    _insert_batches(conn, models.ProductSkinConcern.__table__, (
+        {"product_id": n, "skin_concern": concerns[n % 7]} for n in range(1, products + 1) if n % 7 < len(concerns)
+    ))
+
+    def cosmetologist_of(client_id):
+        return 1 + (cosmetologists + client_id) % cosmetologists
+
+    _insert_batches(conn, models.Analysis.__table__, (
+        {
+            "id": (client_id - 1) * per_client + n, "client_id": client_id, "created_by": cosmetologist_of(client_id),
+            "performed_at": start + timedelta(days=7 * n), "image_path": f"uploads/{client_id}_{n}.jpg",
+            "hydration_level": (client_id * n) % 100, "sebum_level": (client_id + n) % 100,
+            "pigmentation": (client_id * 3 + n) % 100,
+        }
+        for client_id in range(1, clients + 1) for n in range(1, per_client + 1)
+    ))
+    care_plans = [
+        (analysis_id, 1 + (analysis_id - 1) // per_client, (analysis_id - 1) % per_client + 1)
+        for analysis_id in range(1, clients * per_client + 1)
+        if analysis_id % per_client < explain_check.CARE_PLANS_PER_CLIENT
+    ]
+    _insert_batches(conn, models.CarePlan.__table__, (
+        {
+            "id": plan_id, "client_id": client_id, "analysis_id": analysis_id, "created_by": cosmetologist_of(client_id),
+            "title": f"Plan {analysis_id}", "created_at": start + timedelta(days=7 * n),
+        }
+        for plan_id, (analysis_id, client_id, n) in enumerate(care_plans, start=1)
+    ))
+    _insert_batches(conn, models.CarePlanItem.__table__, (
+        {
+            "care_plan_id": plan_id, "product_id": 1 + (plan_id * 31 + n) % products,
+            "usage_time": "rano", "usage_frequency": "codziennie", "order": n,
+        }
+        for plan_id in range(1, len(care_plans) + 1) for n in range(1, explain_check.ITEMS_PER_CARE_PLAN + 1)
+    ))
+
+    messages = explain_check.MESSAGES_PER_CLIENT
+    def message(client_id, n):
+        sent_at = start + timedelta(hours=n)
+        from_client = n % 2 == 0
+        unread = n == messages and client_id % 4 == 0
+        return {
+            "client_id": client_id, "sender_id": cosmetologists + client_id if from_client else cosmetologist_of(client_id),
+            "is_from_client": from_client, "message": f"Wiadomość {n}", "sent_at": sent_at,
+            "read_at": None if unread else sent_at,
+        }
+    _insert_batches(conn, models.ChatMessage.__table__, (
+        message(client_id, n) for client_id in range(1, clients + 1) for n in range(1, messages + 1)
+    ))
+
+    _insert_batches(conn, models.AnalysisJob.__table__, (
+        {
+            "analysis_id": n, "status": models.JobStatus.QUEUED if n % 200 == 0 else models.JobStatus.SUCCEEDED,
+            "attempts": 1, "progress": 100, "run_after": start + timedelta(minutes=n),
+        }
+        for n in range(1, min(sizes["jobs"], clients * per_client) + 1)
+    ))
+
+def seed(conn, scale: float):
+    if conn.dialect.name == "postgresql":
+        explain_check.seed(conn, scale)
+    else:
+        seed_batched(conn, scale)
+
+@dataclass
+class Fixture:
+    # Konto kosmetologa z hasłem, jego klientka i duży plan pielęgnacji; created - plany z POST /care-plans/
+    email: str
+    client_id: int
+    analysis_id: int
+    care_plan_id: int
+    product_ids: list
+    created: list
+    headers: Optional[dict] = None
+
+def prepare_fixture(conn, password_hash: str) -> Fixture:
+    Client = models.Client
+    client = conn.execute(select(Client).where(Client.cosmetologist_id.is_not(None)).order_by(Client.id).limit(1)).first()
+    conn.execute(update(models.User).where(models.User.id == client.cosmetologist_id).values(hashed_password=password_hash))
+    email = conn.execute(select(models.User.email).where(models.User.id == client.cosmetologist_id)).scalar_one()
+    analysis_id = conn.execute(
+        select(models.Analysis.id).where(models.Analysis.client_id == client.id).order_by(models.Analysis.id).limit(1)
+    ).scalar_one()
+    product_ids = conn.execute(
+        select(models.Product.id).order_by(models.Product.id).limit(LARGE_CARE_PLAN_ITEMS)
+    ).scalars().all()
+
+    care_plan_id = conn.execute(
+        select(models.CarePlan.id).where(models.CarePlan.client_id == client.id, models.CarePlan.title == LARGE_CARE_PLAN_TITLE)
+    ).scalar()
+    if care_plan_id is None:
+        care_plan_id = conn.execute(
+            insert(models.CarePlan).values(
+                client_id=client.id, analysis_id=analysis_id, created_by=client.cosmetologist_id,
+                title=LARGE_CARE_PLAN_TITLE, description="Plan z wieloma produktami",
+            ).returning(models.CarePlan.id)
+        ).scalar_one()
+        conn.execute(insert(models.CarePlanItem), [
+            {
+                "care_plan_id": care_plan_id, "product_id": product_id, "usage_time": "wieczorem",
+                "usage_frequency": "codziennie", "usage_instructions": "Nałożyć cienką warstwę", "order": order,
+            }
+            for order, product_id in enumerate(product_ids)
+        ])
+    return Fixture(email, client.id, analysis_id, care_plan_id, list(product_ids), [])
+
+# === SCENARIOS ===
+
+def _care_plan_payload(fixture: Fixture, i: int) -> dict:
+    products = fixture.product_ids
+    return {
+        "client_id": fixture.client_id,
+        "analysis_id": fixture.analysis_id,
+        "title": f"Benchmark {i}",
+        "items": [
+            {"product_id": products[(i + n) % len(products)], "usage_time": "rano", "order": n}
+            for n in range(CREATED_CARE_PLAN_ITEMS)
+        ],
+    }
+
+def _image(i: int) -> bytes:
+    # Inne zdjęcie w każdym żądaniu - bez deduplikacji uploadów po sha256
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (i % 256, (i // 256) % 256, 128)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+async def _login(client, fixture, i):
+    return await client.post("/token", data={"username": fixture.email, "password": BENCHMARK_PASSWORD})
+
+async def _create_care_plan(client, fixture, i):
+    response = await client.post("/care-plans/", json=_care_plan_payload(fixture, i), headers=fixture.headers)
+    if response.status_code == 200:
+        fixture.created.append(response.json()["id"])
+    return response
+
+async def _list_care_plans(client, fixture, i):
+    return await client.get("/care-plans/", params={"client_id": fixture.client_id, "limit": 20}, headers=fixture.headers)
+
+async def _read_care_plan(client, fixture, i):
+    return await client.get(f"/care-plans/{fixture.care_plan_id}", headers=fixture.headers)
+
+async def _update_care_plan(client, fixture, i):
+    care_plan_id = fixture.created[i % len(fixture.created)]
+    return await client.put(f"/care-plans/{care_plan_id}", json=_care_plan_payload(fixture, i + 1), headers=fixture.headers)
+
+async def _delete_care_plan(client, fixture, i):
+    return await client.delete(f"/care-plans/{fixture.created.pop()}", headers=fixture.headers)
+
+async def _chat_history(client, fixture, i):
+    return await client.get(f"/chat/messages/{fixture.client_id}", params={"limit": 50}, headers=fixture.headers)
+
+async def _conversations(client, fixture, i):
+    return await client.get("/chat/conversations/", headers=fixture.headers)
+
+async def _care_plan_pdf(client, fixture, i):
+    return await client.get(f"/care-plans/{fixture.care_plan_id}/pdf", headers=fixture.headers)
+
+async def _upload_analysis(client, fixture, i):
+    return await client.post(
+        "/upload-image/", data={"client_id": str(fixture.client_id)},
+        files={"file": (f"benchmark_{i}.jpg", _image(i), "image/jpeg")}, headers=fixture.headers,
+    )
+
+@dataclass
+class Scenario:
+    name: str
+    call: Callable[..., Awaitable]
+    # Rozgrzewka (bez pomiaru) tylko dla scenariuszy, które nie zmieniają danych używanych przez kolejne
+    warmup: bool = True
+
+# Kolejność ma znaczenie: update/delete korzystają z planów utworzonych w care_plans:create
+SCENARIOS = [
+    Scenario("login", _login),
+    Scenario("care_plans:create", _create_care_plan, warmup=False),
+    Scenario("care_plans:list", _list_care_plans),
+    Scenario("care_plans:read", _read_care_plan),
+    Scenario("care_plans:update", _update_care_plan, warmup=False),
+    Scenario("care_plans:pdf", _care_plan_pdf),
+    Scenario("care_plans:delete", _delete_care_plan, warmup=False),
+    Scenario("chat:history", _chat_history),
+    Scenario("chat:conversations", _conversations),
+    Scenario("analyses:upload", _upload_analysis),
+]
+WARMUP_REQUESTS = 10
+
+# === MEASUREMENT ===
+
+def percentile(values, q: float) -> float:
+    # Percentyl metodą najbliższej rangi (dokładny, z próbek - nie z kubełków histogramu)
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+def _query_totals() -> tuple:
+    # (liczba żądań, suma zapytań SQL) ze wszystkich serii http_request_db_queries
+    count = total = 0
+    for _, cumulative, series_total in metrics.request_queries.samples():
+        count += cumulative[-1]
+        total += series_total
+    return count, total
+
+async def run_scenario(client, scenario: Scenario, fixture: Fixture, requests: int, concurrency: int) -> dict:
+    if scenario.warmup:
+        for i in range(min(WARMUP_REQUESTS, requests)):
+            await scenario.call(client, fixture, requests + i)
+
+    latencies, errors = [], []
+    pending = iter(range(requests))
+
+    async def worker():
+        for i in pending:
+            started = time.perf_counter()
+            response = await scenario.call(client, fixture, i)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors.append(f"{response.status_code} {response.text[:200]}")
+
+    count_before, queries_before = _query_totals()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    count_after, queries_after = _query_totals()
+
+    if errors:
+        print(f"❌ {scenario.name}: {len(errors)} błędów, np. {errors[0]}")
+    handled = count_after - count_before
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "throughput_rps": round(requests / elapsed, 2),
+        "queries_per_request": round((queries_after - queries_before) / handled, 2) if handled else 0.0,
+    }
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    # Regresje względem pomiaru bazowego: p95 i przepustowość (z tolerancją), liczba zapytań SQL na żądanie
+    regressions = []
+    for name, base in baseline["scenarios"].items():
+        current = result["scenarios"].get(name)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance) and current["p95_ms"] - base["p95_ms"] > LATENCY_SLACK_MS:
+            regressions.append(f"{name}: p95 {current['p95_ms']} ms > {base['p95_ms']} ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: przepustowość {current['throughput_rps']} < {base['throughput_rps']} req/s")
+        if current["queries_per_request"] > base["queries_per_request"] + QUERY_COUNT_SLACK:
+            regressions.append(
+                f"{name}: {current['queries_per_request']} zapytań SQL na żądanie > {base['queries_per_request']}"
+            )
+    return regressions
+
+def print_report(result: dict):
+    print(f"{'scenariusz':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'SQL/req':>9}{'błędy':>7}")
+    for name, row in result["scenarios"].items():
+        print(
+            f"{name:<22}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}"
+            f"{row['throughput_rps']:>10}{row['queries_per_request']:>9}{row['errors']:>7}"
+        )
+
+def disable_background_work():
+    # Bez workerów kolejki analiz i rozgrzewania modelu - inaczej przejmowałyby zadania z danych
+    # testowych i ładowały model w trakcie pomiaru. Ustawienia singletonów, nie zmienne środowiskowe:
+    # jobs i inference są już zaimportowane (przez explain_check), ich stałe są odczytane.
+    jobs.worker_pool.concurrency = 0
+    inference.server.warmup = False
+
+async def run(settings: dict, fixture: Fixture, scenarios: list) -> dict:
+    import httpx
+    from backend.beautyai import main as api
+
+    disable_background_work()
+    await api.app.router.startup()
+    try:
+        async with httpx.AsyncClient(app=api.app, base_url="http://benchmark") as client:
+            response = await _login(client, fixture, 0)
+            response.raise_for_status()
+            fixture.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            results = {}
+            for scenario in scenarios:
+                results[scenario.name] = await run_scenario(
+                    client, scenario, fixture, settings["requests"], settings["concurrency"],
+                )
+    finally:
+        await api.app.router.shutdown()
+    return {"settings": settings, "scenarios": results}
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", type=float, default=0.1, help="mnożnik liczności danych testowych (jak w explain_check)")
+    parser.add_argument("--requests", type=int, default=200, help="liczba żądań na scenariusz")
+    parser.add_argument("--concurrency", type=int, default=8, help="liczba równoległych klientów")
+    parser.add_argument("--only", action="append", help="uruchom tylko wybrane scenariusze (można powtarzać)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="plik z pomiarem bazowym (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="zapisz wynik jako nowy pomiar bazowy")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="dopuszczalne pogorszenie p95 / przepustowości")
+    parser.add_argument("--output", help="zapisz wynik do pliku JSON")
+    args = parser.parse_args(argv)
+
+    # Zdjęcia w katalogu tymczasowym - uploads (czytający UPLOAD_DIRECTORY) ładuje dopiero import main
+    os.environ.setdefault("UPLOAD_DIRECTORY", tempfile.mkdtemp(prefix="beautyai-benchmark-"))
+    from backend.beautyai.main import get_password_hash
+
+    scenarios = [scenario for scenario in SCENARIOS if not args.only or scenario.name in args.only]
+    settings = {
+        "dialect": engine.dialect.name,
+        "scale": args.scale,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+    }
+
+    explain_check.prepare_database()
+    with engine.begin() as conn:
+        if conn.execute(select(func.count()).select_from(models.Client)).scalar_one() == 0:
+            print(f"🔄 Wypełnianie bazy danymi testowymi (scale={args.scale})...")
+            seed(conn, args.scale)
+        fixture = prepare_fixture(conn, get_password_hash(BENCHMARK_PASSWORD))
+    explain_check.analyze_tables()
+
+    result = asyncio.run(run(settings, fixture, scenarios))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    failed = any(row["errors"] for row in result["scenarios"].values())
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"💾 Zapisano pomiar bazowy: {args.baseline}")
+        return 1 if failed else 0
+    if not os.path.exists(args.baseline):
+        print(f"Brak pomiaru bazowego ({args.baseline}) - uruchom z --save-baseline")
+        return 1 if failed else 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["settings"] != settings:
+        print(f"⚠️ Pomiar bazowy z innymi ustawieniami ({baseline['settings']}) - porównanie pominięte")
+        return 2
+    regressions = compare(result, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"❌ {regression}")
+    if not regressions:
+        print("✅ Brak regresji względem pomiaru bazowego")
+    return 1 if failed or regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
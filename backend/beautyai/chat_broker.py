@@ -0,0 +1,198 @@
+# chat_broker.py - Pub/sub fan-out for real-time chat delivery
+
+import asyncio
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Set
+
+from backend.beautyai.database import SQLALCHEMY_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+CHAT_BROKER = os.getenv("CHAT_BROKER", "memory")                      # memory | postgres
+CHAT_WS_QUEUE_SIZE = int(os.getenv("CHAT_WS_QUEUE_SIZE", "100"))       # zdarzenia w kolejce na połączenie
+CHAT_NOTIFY_CHANNEL = os.getenv("CHAT_NOTIFY_CHANNEL", "beautyai_chat")
+# Ponowne LISTEN po zerwaniu połączenia (restart bazy, failover): backoff od MIN do MAX sekund
+CHAT_BROKER_RECONNECT_MIN_SECONDS = float(os.getenv("CHAT_BROKER_RECONNECT_MIN_SECONDS", "0.5"))
+CHAT_BROKER_RECONNECT_MAX_SECONDS = float(os.getenv("CHAT_BROKER_RECONNECT_MAX_SECONDS", "30"))
+# NOTIFY ma limit 8000 bajtów - większe zdarzenia wysyłamy jako samą referencję
+PG_NOTIFY_MAX_PAYLOAD = 7900
+
+def chat_topic(client_id: int) -> str:
+    return f"chat:{client_id}"
+
+class Subscription:
+    # Kolejka zdarzeń jednego połączenia WebSocket. Wolny odbiorca nie blokuje nadawcy:
+    # po przepełnieniu kolejki subskrypcja jest zamykana, a klient ma się połączyć ponownie
+    # i dociągnąć brakujące wiadomości przez GET /chat/messages/{client_id}?after=...
+    def __init__(self, topic: str, maxsize: int = CHAT_WS_QUEUE_SIZE):
+        self.topic = topic
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def deliver(self, event: dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def close(self):
+        # Zamknięcie przez broker (np. utrata LISTEN): oczekujący get() od razu dostaje None,
+        # zamiast czekać na kolejne zdarzenie lub heartbeat
+        self.overflowed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass  # Pełna kolejka - nikt nie czeka, połączenie zostanie zamknięte po jej opróżnieniu
+
+    async def get(self) -> Optional[dict]:
+        # None = subskrypcja zamknięta (zdarzenia sprzed zamknięcia są zwracane wcześniej)
+        return await self.queue.get()
+
+class Broker(ABC):
+    def __init__(self):
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, topic: str) -> Subscription:
+        subscription = Subscription(topic)
+        self._subscriptions.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscriptions.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscriptions[subscription.topic]
+
+    @abstractmethod
+    async def publish(self, topic: str, event: dict):
+        ...
+
+    def _dispatch(self, topic: str, event: dict):
+        for subscription in list(self._subscriptions.get(topic, ())):
+            subscription.deliver(event)
+
+    def _drop_subscriptions(self):
+        # Zdarzenia mogły przepaść - połączenia są zamykane jak po przepełnieniu, klienci dociągają historię
+        for subscribers in self._subscriptions.values():
+            for subscription in subscribers:
+                subscription.close()
+
+class InMemoryBroker(Broker):
+    # Jeden proces (jeden worker uvicorna) i testy
+    async def publish(self, topic: str, event: dict):
+        self._dispatch(topic, event)
+
+class PostgresBroker(Broker):
+    # Wiele workerów: zdarzenia przechodzą przez LISTEN/NOTIFY, każdy worker rozsyła je lokalnie.
+    # Nadawca też dostaje własne NOTIFY, więc publish() nie rozsyła lokalnie.
+    def __init__(self, dsn: str, channel: str = CHAT_NOTIFY_CHANNEL):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel
+        self._listen_conn = None
+        self._publish_conn = None
+        self._publish_lock = asyncio.Lock()
+        self._reconnect_task = None
+        self._stopped = True
+
+    async def start(self):
+        self._stopped = False
+        try:
+            await self._listen()
+        except Exception as e:
+            logger.error(f"❌ Chat broker nie może nasłuchiwać na kanale {self.channel}: {e}")
+            self._schedule_reconnect()
+
+    async def stop(self):
+        self._stopped = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            await asyncio.gather(self._reconnect_task, return_exceptions=True)
+            self._reconnect_task = None
+        for conn in (self._listen_conn, self._publish_conn):
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        self._listen_conn = self._publish_conn = None
+
+    async def _listen(self):
+        import asyncpg
+
+        conn = await asyncpg.connect(self.dsn)
+        conn.add_termination_listener(self._on_terminate)
+        await conn.add_listener(self.channel, self._on_notify)
+        self._listen_conn = conn
+        logger.info(f"✅ Chat broker nasłuchuje na kanale {self.channel}")
+
+    def _on_terminate(self, connection):
+        # Wywoływane także przy zamknięciu w stop() - wtedy bez ponownego łączenia
+        if self._stopped or connection is not self._listen_conn:
+            return
+        logger.warning(f"⚠️ Utracono połączenie LISTEN brokera czatu ({self.channel}) - ponowne łączenie")
+        self._listen_conn = None
+        self._drop_subscriptions()
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = CHAT_BROKER_RECONNECT_MIN_SECONDS
+        while not self._stopped:
+            await asyncio.sleep(delay)
+            try:
+                await self._listen()
+            except Exception as e:
+                logger.error(f"❌ Ponowne LISTEN brokera czatu nie powiodło się: {e}")
+                delay = min(delay * 2, CHAT_BROKER_RECONNECT_MAX_SECONDS)
+            else:
+                # Zdarzenia z przerwy przepadły - subskrypcje założone w jej trakcie też dociągają historię
+                self._drop_subscriptions()
+                return
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+            self._dispatch(data["topic"], data["event"])
+        except (ValueError, KeyError) as e:
+            logger.error(f"❌ Nieprawidłowe powiadomienie czatu: {e}")
+
+    async def publish(self, topic: str, event: dict):
+        import asyncpg
+
+        payload = json.dumps({"topic": topic, "event": event}, default=str)
+        if len(payload.encode()) > PG_NOTIFY_MAX_PAYLOAD:
+            reference = {key: event[key] for key in ("type", "id", "client_id", "message_ids") if key in event}
+            payload = json.dumps({"topic": topic, "event": {**reference, "truncated": True}}, default=str)
+        async with self._publish_lock:
+            for attempt in (1, 2):
+                try:
+                    if self._publish_conn is None or self._publish_conn.is_closed():
+                        self._publish_conn = await asyncpg.connect(self.dsn)
+                    await self._publish_conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+                    return
+                except (OSError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError):
+                    self._publish_conn = None
+                    if attempt == 2:
+                        raise
+
+def create_broker() -> Broker:
+    backend = SQLALCHEMY_DATABASE_URL.split("://", 1)[0].split("+", 1)[0]
+    if CHAT_BROKER == "postgres" and backend == "postgresql":
+        # asyncpg przyjmuje DSN bez nazwy sterownika SQLAlchemy
+        return PostgresBroker("postgresql://" + SQLALCHEMY_DATABASE_URL.split("://", 1)[1])
+    return InMemoryBroker()
+
+broker: Broker = create_broker()
@@ -0,0 +1,31 @@
+# conftest.py - Shared fixtures: in-memory SQLite session with a cosmetologist and her client
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from backend.beautyai import models
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+@pytest.fixture
+def client_account(db) -> SimpleNamespace:
+    # Kosmetolog z jedną klientką (bez commit - testy dokładają własne wiersze); identyfikatory
+    cosmetologist = models.User(email="kosmetolog@example.com", hashed_password="x", role=models.UserRole.ADMIN)
+    client_user = models.User(email="klientka@example.com", hashed_password="x", role=models.UserRole.CLIENT)
+    db.add_all([cosmetologist, client_user])
+    db.flush()
+    client = models.Client(user_id=client_user.id, cosmetologist_id=cosmetologist.id)
+    db.add(client)
+    db.flush()
+    return SimpleNamespace(cosmetologist=cosmetologist.id, client_user=client_user.id, client=client.id)
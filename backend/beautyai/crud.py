@@ -0,0 +1,496 @@
+# crud.py - Reusable database operations for the endpoints
+
+import base64
+import json
+import re
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, insert, update, delete, tuple_, func, and_, or_, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, joinedload, selectinload
+
+from backend.beautyai import models, schemas
+
+# === KEYSET PAGINATION ===
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    raw = json.dumps([sort_value.isoformat(), row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    # ValueError dla uszkodzonego kursora - endpoint zamienia go na 400
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(sort_value), int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+def keyset_page_query(
+    query,
+    sort_column,
+    id_column,
+    *,
+    descending: bool,
+    limit: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    live_tail: bool = False,
+):
+    # Zapytanie jednej strony paginate_keyset: limit + 1 wierszy (ostatni tylko sygnalizuje kolejną stronę)
+    key = tuple_(sort_column, id_column)
+    forward = after is not None or (before is None and not live_tail)
+    cursor = after if after is not None else before
+    if cursor is not None:
+        # Krotka Pythona - parametry dostają typy kolumn (timestamptz, integer)
+        value = decode_cursor(cursor)
+        # W przód w liście rosnącej = większe klucze; w malejącej - odwrotnie
+        query = query.where(key > value if forward != descending else key < value)
+    # Przy przechodzeniu wstecz pobieramy w odwrotnej kolejności i odwracamy wynik
+    reverse_scan = forward == descending
+    order = (sort_column.desc(), id_column.desc()) if reverse_scan else (sort_column.asc(), id_column.asc())
+    return query.order_by(*order).limit(limit + 1)
+
+async def paginate_keyset(
+    db: AsyncSession,
+    query,
+    sort_column,
+    id_column,
+    *,
+    descending: bool,
+    limit: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    live_tail: bool = False,
+):
+    # Stronicowanie po (sort_column, id) zamiast OFFSET - koszt nie rośnie z głębokością.
+    # `after`/`before` odnoszą się do kolejności listy (descending=True: od najnowszych).
+    # live_tail=True: bez kursora zwracany jest koniec listy (np. najnowsze wiadomości czatu),
+    # a kursor `after` jest zawsze zwracany, bo nowe wiersze mogą jeszcze dojść.
+    # Zwraca (wiersze, kursor before, kursor after).
+    forward = after is not None or (before is None and not live_tail)
+    cursor = after if after is not None else before
+    page = keyset_page_query(
+        query, sort_column, id_column,
+        descending=descending, limit=limit, before=before, after=after, live_tail=live_tail,
+    )
+    rows = list((await db.execute(page)).scalars().all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+
+    def row_cursor(row) -> str:
+        return encode_cursor(getattr(row, sort_column.key), getattr(row, id_column.key))
+
+    first = row_cursor(rows[0]) if rows else None
+    last = row_cursor(rows[-1]) if rows else None
+    if forward:
+        before_cursor = first if cursor is not None else None
+        after_cursor = last if has_more or live_tail else None
+        if after_cursor is None and live_tail:
+            after_cursor = cursor
+    else:
+        before_cursor = first if has_more else None
+        after_cursor = last if rows else cursor
+    return rows, before_cursor, after_cursor
+
+# === USERS & CLIENTS ===
+# Zapytania endpointów jako funkcje - te same konstrukcje sprawdza explain_check
+
+def user_by_email_query(email: str):
+    return select(models.User).where(models.User.email == email)
+
+def client_query(client_id: int):
+    return select(models.Client).where(models.Client.id == client_id)
+
+def analysis_query(analysis_id: int):
+    return select(models.Analysis).where(models.Analysis.id == analysis_id)
+
+def client_analysis_query(analysis_id: int, client_id: int):
+    return analysis_query(analysis_id).where(models.Analysis.client_id == client_id)
+
+# === CARE PLANS ===
+
+def product_traits() -> list:
+    # Typy skóry i problemy produktów (dwa zapytania selectin) - tylko tam, gdzie są serializowane
+    return [selectinload(models.Product.skin_type_links), selectinload(models.Product.skin_concern_links)]
+
+async def get_product(db: AsyncSession, product_id: int, refresh: bool = False) -> Optional[models.Product]:
+    # refresh=True po zapisie - świeże kolumny i cechy zamiast leniwego odświeżenia
+    return await db.get(models.Product, product_id, options=product_traits(), populate_existing=refresh)
+
+# Szczegóły planu: plan + klient + analiza w jednym zapytaniu (JOIN), pozycje z produktami w drugim
+# (selectin), typy skóry i problemy wszystkich produktów w dwóch kolejnych (product_traits) -
+# liczba zapytań nie zależy od liczby pozycji
+CARE_PLAN_DETAIL_QUERY_COUNT = 4
+
+# Lista planów od najnowszych; kursor = (created_at, id)
+CARE_PLANS_KEYSET = dict(sort_column=models.CarePlan.created_at, id_column=models.CarePlan.id, descending=True)
+
+def care_plans_query(scope, client_id: Optional[int] = None):
+    # Zakres klientek (access.ClientScope) jako podzapytanie w tym samym SELECT-cie, bez listy id w Pythonie
+    query = select(models.CarePlan).where(models.CarePlan.client_id.in_(scope.client_ids()))
+    if client_id:
+        query = query.where(models.CarePlan.client_id == client_id)
+    return query
+
+def care_plan_query(care_plan_id: int):
+    return select(models.CarePlan).where(models.CarePlan.id == care_plan_id)
+
+def care_plan_detail_query(care_plan_id: int):
+    return (
+        select(models.CarePlan)
+        .where(models.CarePlan.id == care_plan_id)
+        .options(
+            joinedload(models.CarePlan.client),
+            joinedload(models.CarePlan.analysis),
+            selectinload(models.CarePlan.items).joinedload(models.CarePlanItem.product).options(*product_traits()),
+        )
+    )
+
+def care_plan_export_query(care_plan_id: int):
+    # Eksport PDF: plan, klient z kontem, analiza i pozycje z produktami - jedno zapytanie (JOIN-y);
+    # wynik wymaga .unique() z powodu joinedload kolekcji
+    return (
+        select(models.CarePlan)
+        .where(models.CarePlan.id == care_plan_id)
+        .options(
+            joinedload(models.CarePlan.client).joinedload(models.Client.user),
+            joinedload(models.CarePlan.analysis),
+            joinedload(models.CarePlan.items).joinedload(models.CarePlanItem.product),
+        )
+    )
+
+def care_plans_export_query(care_plan_ids: List[int]):
+    # Eksport zbiorczy: paczka planów; kolekcje przez selectin, żeby JOIN nie mnożył wierszy
+    return (
+        select(models.CarePlan)
+        .where(models.CarePlan.id.in_(care_plan_ids))
+        .options(
+            joinedload(models.CarePlan.client).joinedload(models.Client.user),
+            joinedload(models.CarePlan.analysis),
+            selectinload(models.CarePlan.items).joinedload(models.CarePlanItem.product),
+        )
+        .order_by(models.CarePlan.id)
+    )
+
+def care_plan_export_ids_query(cosmetologist_id: int, export_filter: schemas.CarePlanExportFilter):
+    # Identyfikatory planów do eksportu zbiorczego - same klucze, dane ładowane paczkami (care_plans_export_query)
+    query = (
+        select(models.CarePlan.id)
+        .join(models.Client, models.Client.id == models.CarePlan.client_id)
+        .where(models.Client.cosmetologist_id == cosmetologist_id)
+    )
+    if export_filter.client_ids:
+        query = query.where(models.CarePlan.client_id.in_(export_filter.client_ids))
+    if export_filter.created_from:
+        query = query.where(models.CarePlan.created_at >= export_filter.created_from)
+    if export_filter.created_to:
+        query = query.where(models.CarePlan.created_at <= export_filter.created_to)
+    if export_filter.active_only:
+        query = query.where(or_(models.CarePlan.valid_until.is_(None), models.CarePlan.valid_until >= datetime.utcnow()))
+    return query.order_by(models.CarePlan.id)
+
+CARE_PLAN_ITEM_FIELDS = ("product_id", "usage_time", "usage_frequency", "usage_instructions", "order")
+
+async def find_missing_product_ids(db: AsyncSession, product_ids: Iterable[int]) -> List[int]:
+    # Jedno zapytanie IN zamiast SELECT-a na każdy produkt
+    wanted = set(product_ids)
+    if not wanted:
+        return []
+    found = set((await db.execute(
+        select(models.Product.id).where(models.Product.id.in_(wanted))
+    )).scalars().all())
+    return sorted(wanted - found)
+
+def care_plan_item_rows(care_plan_id: int, items: List[schemas.CarePlanItemCreate]) -> List[dict]:
+    return [
+        {
+            "care_plan_id": care_plan_id,
+            "product_id": item.product_id,
+            "usage_time": item.usage_time,
+            "usage_frequency": item.usage_frequency,
+            "usage_instructions": item.usage_instructions,
+            "order": item.order or i,  # Jeśli order nie podany, użyj indeksu
+        }
+        for i, item in enumerate(items)
+    ]
+
+async def insert_care_plan_items(db: AsyncSession, care_plan_id: int, items: List[schemas.CarePlanItemCreate]):
+    rows = care_plan_item_rows(care_plan_id, items)
+    if rows:
+        # executemany / insertmanyvalues - jedna instrukcja dla całej listy
+        await db.execute(insert(models.CarePlanItem), rows)
+
+def care_plan_items_query(care_plan_id: int):
+    return (
+        select(models.CarePlanItem)
+        .where(models.CarePlanItem.care_plan_id == care_plan_id)
+        .order_by(models.CarePlanItem.order, models.CarePlanItem.id)
+    )
+
+async def sync_care_plan_items(db: AsyncSession, care_plan_id: int, items: List[schemas.CarePlanItemCreate]):
+    # Porównuje nową listę z istniejącymi wierszami: niezmienione zostają,
+    # pozostałe z tym samym produktem są aktualizowane, reszta dodawana/usuwana
+    existing = (await db.execute(care_plan_items_query(care_plan_id))).scalars().all()
+    desired = care_plan_item_rows(care_plan_id, items)
+
+    def key(row) -> tuple:
+        if isinstance(row, dict):
+            return tuple(row[field] for field in CARE_PLAN_ITEM_FIELDS)
+        return tuple(getattr(row, field) for field in CARE_PLAN_ITEM_FIELDS)
+
+    unmatched_existing = {}
+    for row in existing:
+        unmatched_existing.setdefault(key(row), []).append(row)
+
+    # 1. Wiersze identyczne - bez zmian
+    remaining = []
+    for row in desired:
+        same = unmatched_existing.get(key(row))
+        if same:
+            same.pop(0)
+        else:
+            remaining.append(row)
+
+    # 2. Ten sam produkt, inne parametry - UPDATE po kluczu głównym
+    by_product = {}
+    for rows in unmatched_existing.values():
+        for row in rows:
+            by_product.setdefault(row.product_id, []).append(row)
+    updates, inserts = [], []
+    for row in remaining:
+        candidates = by_product.get(row["product_id"])
+        if candidates:
+            updates.append({"id": candidates.pop(0).id, **row})
+        else:
+            inserts.append(row)
+    deleted_ids = [row.id for rows in by_product.values() for row in rows]
+
+    if deleted_ids:
+        await db.execute(delete(models.CarePlanItem).where(models.CarePlanItem.id.in_(deleted_ids)))
+    if updates:
+        await db.execute(update(models.CarePlanItem), updates)
+    if inserts:
+        await db.execute(insert(models.CarePlanItem), inserts)
+
+# === PRODUCT SEARCH ===
+
+PRODUCT_FACET_LIMIT = 20
+# Próg podobieństwa trigramowego dla literówek w nazwie i marce (pg_trgm word_similarity)
+PRODUCT_FUZZY_THRESHOLD = 0.4
+
+def search_terms(q: Optional[str]) -> List[str]:
+    return re.findall(r"\w+", (q or "").lower())
+
+def product_text_condition(dialect: str, q: str):
+    # Zwraca (warunek dopasowania, wyrażenie trafności) dla frazy wyszukiwania
+    terms = search_terms(q)
+    if not terms:
+        return None, None
+    if dialect == "postgresql":
+        # Prefiksy słów ("krem nawil" -> krem:* & nawil:*) po indeksie GIN na tsvector,
+        # plus literówki w nazwie/marce po indeksach trigramowych
+        tsquery = func.to_tsquery(models.SEARCH_CONFIG, " & ".join(f"{term}:*" for term in terms))
+        phrase = " ".join(terms)
+        matches = or_(
+            models.product_search_vector.op("@@")(tsquery),
+            models.Product.name.op("%>")(phrase),
+            models.Product.brand.op("%>")(phrase),
+        )
+        rank = func.ts_rank_cd(models.product_search_vector, tsquery) + func.greatest(
+            func.word_similarity(phrase, models.Product.name),
+            func.word_similarity(phrase, func.coalesce(models.Product.brand, "")),
+        )
+        return matches, rank
+    # SQLite (testy): każde słowo musi wystąpić w którymkolwiek polu
+    columns = (models.Product.name, models.Product.brand, models.Product.description, models.Product.ingredients)
+    matches = and_(*(or_(*(column.ilike(f"%{term}%") for column in columns)) for term in terms))
+    return matches, None
+
+def product_search_query(filters: list, rank, limit: int, offset: int = 0):
+    # Strona wyników: wg trafności, jeśli jest fraza; inaczej alfabetycznie
+    order = (rank.desc(), models.Product.id) if rank is not None else (models.Product.name, models.Product.id)
+    return select(models.Product).where(*filters).order_by(*order).limit(limit).offset(offset).options(*product_traits())
+
+async def search_products(
+    db: AsyncSession,
+    *,
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    brand: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> dict:
+    # Strona wyników + liczba wszystkich trafień + facety (kategoria, marka).
+    # Facet danego wymiaru liczony bez jego własnego filtra - widać, ile dałaby zmiana wyboru.
+    dialect = db.bind.dialect.name
+    text_match, rank = product_text_condition(dialect, q)
+    if text_match is not None and dialect == "postgresql":
+        # Próg dla operatora %> (domyślnie 0.6 - za ostry dla krótkich nazw)
+        await db.execute(text(f"SET LOCAL pg_trgm.word_similarity_threshold = {PRODUCT_FUZZY_THRESHOLD}"))
+    text_filters = [text_match] if text_match is not None else []
+    category_filter = [models.Product.category == category] if category else []
+    brand_filter = [models.Product.brand == brand] if brand else []
+    filters = text_filters + category_filter + brand_filter
+
+    items = (await db.execute(product_search_query(filters, rank, limit, offset))).scalars().all()
+    total = (await db.execute(select(func.count()).select_from(models.Product).where(*filters))).scalar_one()
+
+    async def facet(column, facet_filters):
+        rows = (await db.execute(
+            select(column, func.count())
+            .where(column.is_not(None), *facet_filters)
+            .group_by(column)
+            .order_by(func.count().desc(), column)
+            .limit(PRODUCT_FACET_LIMIT)
+        )).all()
+        return [{"value": value, "count": count} for value, count in rows]
+
+    return {
+        "items": items,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "facets": {
+            "category": await facet(models.Product.category, text_filters + brand_filter),
+            "brand": await facet(models.Product.brand, text_filters + category_filter),
+        },
+    }
+
+# === PRODUCT TRAITS & RECOMMENDATIONS ===
+
+def _sync_links(links, attribute: str, wanted, factory):
+    # Zmiana tylko różnicy - usunięcie i ponowne dodanie tej samej wartości w jednym flush
+    # dałoby konflikt klucza głównego (INSERT wykonywany jest przed DELETE)
+    wanted = list(dict.fromkeys(wanted))
+    for link in list(links):
+        if getattr(link, attribute) not in wanted:
+            links.remove(link)
+    present = {getattr(link, attribute) for link in links}
+    links.extend(factory(value) for value in wanted if value not in present)
+
+def set_product_traits(product: models.Product, skin_types=None, skin_concerns=None):
+    if skin_types is not None:
+        _sync_links(
+            product.skin_type_links, "skin_type", [models.SkinType(value) for value in skin_types],
+            lambda value: models.ProductSkinType(skin_type=value),
+        )
+    if skin_concerns is not None:
+        _sync_links(
+            product.skin_concern_links, "skin_concern", [models.SkinConcern(value) for value in skin_concerns],
+            lambda value: models.ProductSkinConcern(skin_concern=value),
+        )
+
+def products_query(product_ids: List[int]):
+    return select(models.Product).where(models.Product.id.in_(product_ids)).options(*product_traits())
+
+async def get_products_in_order(db: AsyncSession, product_ids: List[int]) -> List[models.Product]:
+    # Produkty w kolejności podanych id (np. rankingu scoring.py) - jedno zapytanie IN
+    if not product_ids:
+        return []
+    products = {product.id: product for product in (await db.execute(products_query(product_ids))).scalars()}
+    return [products[product_id] for product_id in product_ids if product_id in products]
+
+async def set_recommended_products(db: AsyncSession, analysis_id: int, product_ids: List[int]):
+    # Zastąpienie listy rekomendacji analizy: DELETE + jeden INSERT (executemany)
+    await db.execute(delete(models.analysis_product).where(models.analysis_product.c.analysis_id == analysis_id))
+    if product_ids:
+        await db.execute(
+            insert(models.analysis_product),
+            [{"analysis_id": analysis_id, "product_id": product_id} for product_id in product_ids],
+        )
+
+# === CHAT ===
+
+CONVERSATION_PREVIEW_LENGTH = 200
+
+def conversation_summary_query(cosmetologist_id: int):
+    # Wszystkie rozmowy kosmetologa w jednym zapytaniu:
+    # - liczba nieprzeczytanych wiadomości od klientów (grupowanie po częściowym indeksie read_at IS NULL)
+    # - ostatnia wiadomość (skorelowane podzapytanie po indeksie (client_id, sent_at, id))
+    client_ids = select(models.Client.id).where(models.Client.cosmetologist_id == cosmetologist_id)
+    unread = (
+        select(models.ChatMessage.client_id, func.count().label("unread_count"))
+        .where(
+            models.ChatMessage.read_at.is_(None),
+            models.ChatMessage.is_from_client.is_(True),
+            models.ChatMessage.client_id.in_(client_ids),
+        )
+        .group_by(models.ChatMessage.client_id)
+        .subquery()
+    )
+    latest_id = (
+        select(models.ChatMessage.id)
+        .where(models.ChatMessage.client_id == models.Client.id)
+        .order_by(models.ChatMessage.sent_at.desc(), models.ChatMessage.id.desc())
+        .limit(1)
+        .correlate(models.Client)
+        .scalar_subquery()
+    )
+    # Nazwa klientki po kluczu głównym users - JOIN z całą tabelą planner realizowałby jako Seq Scan + Hash
+    client_name = (
+        select(models.User.full_name)
+        .where(models.User.id == models.Client.user_id)
+        .correlate(models.Client)
+        .scalar_subquery()
+    )
+    last = aliased(models.ChatMessage)
+    return (
+        select(
+            models.Client.id.label("client_id"),
+            client_name.label("client_name"),
+            func.coalesce(unread.c.unread_count, 0).label("unread_count"),
+            func.substr(last.message, 1, CONVERSATION_PREVIEW_LENGTH).label("last_message"),
+            last.sent_at.label("last_message_at"),
+            last.is_from_client.label("last_message_from_client"),
+        )
+        .outerjoin(unread, unread.c.client_id == models.Client.id)
+        .outerjoin(last, last.id == latest_id)
+        .where(models.Client.cosmetologist_id == cosmetologist_id)
+        .order_by(last.sent_at.desc().nulls_last(), models.Client.id)
+    )
+
+# Wiadomości rozmowy, na każdej stronie od najstarszych; bez kursora - najnowsze (live_tail)
+CHAT_MESSAGES_KEYSET = dict(
+    sort_column=models.ChatMessage.sent_at, id_column=models.ChatMessage.id, descending=False, live_tail=True,
+)
+
+def chat_messages_query(scope, client_id: int):
+    # Uprawnienia (kosmetolog klienta / sama klientka) jako nieskorelowany EXISTS - liczony raz na zapytanie
+    return select(models.ChatMessage).where(models.ChatMessage.client_id == client_id, scope.owns(client_id))
+
+def chat_message_query(message_id: int):
+    # Wiadomość i kosmetolog rozmowy (klucz cache podsumowań); uprawnienia po models.Client.id
+    return (
+        select(models.ChatMessage, models.Client.cosmetologist_id)
+        .join(models.Client, models.Client.id == models.ChatMessage.client_id)
+        .where(models.ChatMessage.id == message_id)
+    )
+
+def mark_conversation_read_statement(
+    client_id: int,
+    from_client: bool,
+    read_at: datetime,
+    up_to_id: Optional[int] = None,
+    up_to: Optional[datetime] = None,
+):
+    # Jeden UPDATE ... WHERE zamiast żądania na każdą wiadomość; zwraca identyfikatory oznaczonych
+    stmt = (
+        update(models.ChatMessage)
+        .where(
+            models.ChatMessage.client_id == client_id,
+            models.ChatMessage.is_from_client == from_client,
+            models.ChatMessage.read_at.is_(None),
+        )
+        .values(read_at=read_at)
+        .returning(models.ChatMessage.id)
+        .execution_options(synchronize_session=False)
+    )
+    if up_to_id is not None:
+        stmt = stmt.where(models.ChatMessage.id <= up_to_id)
+    if up_to is not None:
+        stmt = stmt.where(models.ChatMessage.sent_at <= up_to)
+    return stmt
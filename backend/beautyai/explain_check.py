@@ -0,0 +1,313 @@
+# explain_check.py - EXPLAIN the endpoints' queries on seeded data and fail on sequential scans
+#
+# Tylko Postgres. Na pustej bazie najpierw wypełnia tabele danymi (generate_series), potem ANALYZE
+# i EXPLAIN (FORMAT JSON) dla zapytań endpointów (budowanych funkcjami z crud, jak w endpointach,
+# razem z zapytaniami selectin, które wysyła ORM); kod wyjścia 1, jeśli któryś plan zawiera Seq Scan.
+# Uruchamiać na osobnej bazie, nie produkcyjnej:
+#   DATABASE_URL=postgresql://.../beautyai_explain python -m backend.beautyai.explain_check [--scale 1.0]
+
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from sqlalchemy import case, cast, event, func, insert, literal, select, text, true
+from sqlalchemy.orm import Session
+
+from backend.beautyai import access, crud, jobs, models, schemas, scoring
+from backend.beautyai.database import create_extensions, engine
+from backend.beautyai.migrations import run_migrations
+
+# Liczności przy --scale 1.0 - na tyle duże, żeby planner nie wybierał Seq Scan dla małych tabel
+SEED_SIZES = {
+    "cosmetologists": 200,
+    "clients": 20_000,
+    "products": 5_000,
+    "jobs": 20_000,
+}
+# Na klientkę / plan - niezależne od --scale
+ANALYSES_PER_CLIENT = 5
+CARE_PLANS_PER_CLIENT = 3
+ITEMS_PER_CARE_PLAN = 5
+MESSAGES_PER_CLIENT = 25
+SEED_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def _series(n: int):
+    return func.generate_series(1, n).table_valued("n").render_derived(name="series")
+
+def _enum(value, column):
+    # Parametr z jawnym typem enuma - w INSERT ... SELECT nie ma kontekstu kolumny
+    return cast(literal(value, type_=column.type), column.type)
+
+def seed(conn, scale: float):
+    sizes = {name: max(1, int(value * scale)) for name, value in SEED_SIZES.items()}
+    cosmetologists, clients, products = sizes["cosmetologists"], sizes["clients"], sizes["products"]
+    User = models.User
+
+    n = _series(cosmetologists + clients).c.n
+    conn.execute(insert(User).from_select(
+        ["email", "hashed_password", "full_name", "role", "is_active"],
+        select(
+            func.concat("user", n, "@example.com"), literal("x"), func.concat("User ", n),
+            case((n <= cosmetologists, _enum(models.UserRole.ADMIN, User.role)), else_=_enum(models.UserRole.CLIENT, User.role)),
+            literal(True),
+        ),
+    ))
+    user = User.__table__
+    conn.execute(insert(models.Client).from_select(
+        ["user_id", "cosmetologist_id", "phone"],
+        select(user.c.id, 1 + user.c.id % cosmetologists, literal("+48 600 000 000")).where(user.c.id > cosmetologists),
+    ))
+
+    n = _series(products).c.n
+    conn.execute(insert(models.Product).from_select(
+        ["name", "brand", "category", "description", "price"],
+        select(
+            func.concat("Produkt ", n), func.concat("Marka ", n % 150), func.concat("Kategoria ", n % 12),
+            func.concat("Opis produktu ", n), 10 + n % 200,
+        ),
+    ))
+    product = models.Product.__table__
+    for offset, skin_type in enumerate(models.SkinType):
+        conn.execute(insert(models.ProductSkinType).from_select(
+            ["product_id", "skin_type"],
+            select(product.c.id, _enum(skin_type, models.ProductSkinType.skin_type))
+            .where(product.c.id % len(models.SkinType) == offset),
+        ))
+    for offset, concern in enumerate(models.SkinConcern):
+        conn.execute(insert(models.ProductSkinConcern).from_select(
+            ["product_id", "skin_concern"],
+            select(product.c.id, _enum(concern, models.ProductSkinConcern.skin_concern))
+            .where(product.c.id % 7 == offset),
+        ))
+
+    client = models.Client.__table__
+    series = _series(ANALYSES_PER_CLIENT)
+    n = series.c.n
+    conn.execute(insert(models.Analysis).from_select(
+        ["client_id", "created_by", "performed_at", "image_path", "hydration_level", "sebum_level", "pigmentation"],
+        select(
+            client.c.id, client.c.cosmetologist_id, SEED_START + literal(timedelta(days=7)) * n,
+            func.concat("uploads/", client.c.id, "_", n, ".jpg"),
+            (client.c.id * n) % 100, (client.c.id + n) % 100, (client.c.id * 3 + n) % 100,
+        ).select_from(client.join(series, true())),
+    ))
+
+    analysis = models.Analysis.__table__
+    conn.execute(insert(models.CarePlan).from_select(
+        ["client_id", "analysis_id", "created_by", "title", "created_at"],
+        select(
+            analysis.c.client_id, analysis.c.id, analysis.c.created_by,
+            func.concat("Plan ", analysis.c.id), analysis.c.performed_at,
+        ).where(analysis.c.id % ANALYSES_PER_CLIENT < CARE_PLANS_PER_CLIENT),
+    ))
+
+    care_plan = models.CarePlan.__table__
+    series = _series(ITEMS_PER_CARE_PLAN)
+    n = series.c.n
+    conn.execute(insert(models.CarePlanItem).from_select(
+        ["care_plan_id", "product_id", "usage_time", "usage_frequency", "order"],
+        select(care_plan.c.id, 1 + (care_plan.c.id * 31 + n) % products, literal("rano"), literal("codziennie"), n)
+        .select_from(care_plan.join(series, true())),
+    ))
+
+    # Co druga wiadomość od klientki; nieprzeczytana tylko ostatnia wiadomość co czwartej rozmowy
+    series = _series(MESSAGES_PER_CLIENT)
+    n = series.c.n
+    sent_at = SEED_START + literal(timedelta(hours=1)) * n
+    from_client = n % 2 == 0
+    unread = (n == MESSAGES_PER_CLIENT) & (client.c.id % 4 == 0)
+    conn.execute(insert(models.ChatMessage).from_select(
+        ["client_id", "sender_id", "is_from_client", "message", "sent_at", "read_at"],
+        select(
+            client.c.id, case((from_client, client.c.user_id), else_=client.c.cosmetologist_id), from_client,
+            func.concat("Wiadomość ", n), sent_at, case((unread, None), else_=sent_at),
+        ).select_from(client.join(series, true())),
+    ))
+
+    n = _series(sizes["jobs"]).c.n
+    conn.execute(insert(models.AnalysisJob).from_select(
+        ["analysis_id", "status", "attempts", "progress", "run_after"],
+        select(
+            n, case((n % 200 == 0, _enum(models.JobStatus.QUEUED, models.AnalysisJob.status)),
+                    else_=_enum(models.JobStatus.SUCCEEDED, models.AnalysisJob.status)),
+            literal(1), literal(100), SEED_START + literal(timedelta(minutes=1)) * n,
+        ),
+    ))
+
+def probe_ids(conn) -> dict:
+    # Przykładowe identyfikatory do parametrów zapytań - kosmetolog z klientkami, jej plan, wiadomość itd.
+    Client = models.Client
+    client = conn.execute(select(Client).where(Client.cosmetologist_id.is_not(None)).order_by(Client.id).limit(1)).first()
+    care_plan_id = conn.execute(
+        select(models.CarePlan.id).where(models.CarePlan.client_id == client.id).limit(1)
+    ).scalar_one()
+    analysis = conn.execute(
+        select(models.Analysis).where(models.Analysis.client_id == client.id).limit(1)
+    ).first()
+    message_id = conn.execute(
+        select(models.ChatMessage.id).where(models.ChatMessage.client_id == client.id).limit(1)
+    ).scalar_one()
+    user_email = conn.execute(select(models.User.email).where(models.User.id == client.user_id)).scalar_one()
+    # Lista rekomendacji (ranking z scoring.py) - produkty dociągane po kluczu głównym
+    product_ids = conn.execute(
+        select(models.Product.id).order_by(models.Product.id).limit(scoring.ANALYSIS_RECOMMENDED_PRODUCTS)
+    ).scalars().all()
+    return {
+        "client_id": client.id,
+        "client_user_id": client.user_id,
+        "cosmetologist_id": client.cosmetologist_id,
+        "care_plan_id": care_plan_id,
+        "analysis": analysis,
+        "message_id": message_id,
+        "email": user_email,
+        "product_ids": product_ids,
+    }
+
+def endpoint_queries(ids: dict, trigram: bool) -> list:
+    # (nazwa, zapytanie) - zbudowane tymi samymi funkcjami crud/jobs co w endpointach
+    CarePlan, Client, Analysis = models.CarePlan, models.Client, models.Analysis
+    client_id, cosmetologist_id, care_plan_id = ids["client_id"], ids["cosmetologist_id"], ids["care_plan_id"]
+    analysis = ids["analysis"]
+    # Zakresy uprawnień jak w endpointach (access.ClientScope) - kosmetolog i jego klientka
+    admin = access.ClientScope(SimpleNamespace(id=cosmetologist_id, role=models.UserRole.ADMIN))
+    owner = access.ClientScope(SimpleNamespace(id=ids["client_user_id"], role=models.UserRole.CLIENT))
+    page = 20
+    queries = [
+        ("POST /token: user by email", crud.user_by_email_query(ids["email"])),
+        ("scoped client", admin.scoped(crud.client_query(client_id), Client.id)),
+        ("POST /care-plans/: analysis of client", crud.client_analysis_query(analysis.id, client_id)),
+        ("GET /care-plans/ (client)",
+         crud.keyset_page_query(crud.care_plans_query(owner), **crud.CARE_PLANS_KEYSET, limit=page)),
+        ("GET /care-plans/ (cosmetologist)",
+         crud.keyset_page_query(crud.care_plans_query(admin, client_id), **crud.CARE_PLANS_KEYSET, limit=page)),
+        ("GET /care-plans/ (client profile)", owner.client_ids()),
+        ("GET /care-plans/{id}", admin.scoped(crud.care_plan_detail_query(care_plan_id), CarePlan.client_id)),
+        ("GET /care-plans/{id}/pdf", owner.scoped(crud.care_plan_export_query(care_plan_id), CarePlan.client_id)),
+        ("PUT /care-plans/{id}", admin.scoped(crud.care_plan_query(care_plan_id), CarePlan.client_id)),
+        ("PUT /care-plans/{id}: existing items", crud.care_plan_items_query(care_plan_id)),
+        ("POST /care-plans/export",
+         crud.care_plan_export_ids_query(cosmetologist_id, schemas.CarePlanExportFilter(active_only=False))),
+        ("POST /care-plans/export: batch", crud.care_plans_export_query([care_plan_id])),
+        ("scoped analysis", admin.scoped(crud.analysis_query(analysis.id), Analysis.client_id)),
+        ("GET /chat/messages/{client_id}",
+         crud.keyset_page_query(crud.chat_messages_query(owner, client_id), **crud.CHAT_MESSAGES_KEYSET, limit=page)),
+        ("PUT /chat/messages/{id}/read", admin.scoped(crud.chat_message_query(ids["message_id"]), Client.id)),
+        ("GET /chat/conversations/", crud.conversation_summary_query(cosmetologist_id)),
+        ("POST /chat/conversations/{client_id}/read",
+         crud.mark_conversation_read_statement(client_id, True, datetime.utcnow())),
+        ("analysis job claim", jobs.claim_statement("explain_check")),
+        ("POST /analyses/{id}/recommend-products", crud.products_query(ids["product_ids"])),
+    ]
+    if trigram:
+        # Wyszukiwanie łączy tsvector z operatorem %> z pg_trgm - bez rozszerzenia nie da się go wykonać
+        text_match, rank = crud.product_text_condition("postgresql", "produkt 42")
+        queries.append(("GET /products/?q=", crud.product_search_query([text_match], rank, page)))
+    else:
+        tsvector_match = models.product_search_vector.op("@@")(func.to_tsquery(models.SEARCH_CONFIG, "produkt & 42:*"))
+        queries.append(("GET /products/?q= (tsvector only, no pg_trgm)", crud.product_search_query([tsvector_match], None, page)))
+    return queries
+
+def explain(conn, statement) -> list:
+    # Zapytanie wykonywane przez ORM jak w endpoincie - razem z zapytaniami selectin/joinedload,
+    # które emituje. Każde polecenie wysłane do bazy jest potem poprzedzone EXPLAIN z tymi samymi
+    # parametrami. Listener tylko na tym połączeniu i tylko na czas wykonania - silnik aplikacji
+    # (także w benchmarku, który importuje ten moduł) pozostaje bez zmian.
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    event.listen(conn, "before_cursor_execute", capture)
+    try:
+        with Session(bind=conn) as session:
+            # Wszystkie zapytania zwracają wiersze (UPDATE-y z RETURNING); unique() dla joinedload kolekcji
+            session.execute(statement).unique().all()
+    finally:
+        event.remove(conn, "before_cursor_execute", capture)
+
+    plans = []
+    for sql, parameters in captured:
+        result = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql, parameters).scalar_one()
+        plan = result if isinstance(result, list) else json.loads(result)
+        plans.append(plan[0]["Plan"])
+    return plans
+
+def seq_scans(plan: dict) -> list:
+    # Tabele czytane sekwencyjnie w całym drzewie planu (łącznie z podplanami i InitPlan)
+    found = [plan["Relation Name"]] if plan.get("Node Type") == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        found += seq_scans(child)
+    return found
+
+def prepare_database() -> bool:
+    # Tabele i migracje jak przy starcie API; zwraca, czy jest pg_trgm (bez niego indeksy *_trgm są pomijane)
+    trigram = False
+    if engine.dialect.name == "postgresql":
+        try:
+            create_extensions(engine)
+        except Exception as e:
+            print(f"⚠️ Brak rozszerzeń Postgresa ({e}) - indeksy pg_trgm zostaną pominięte")
+        with engine.connect() as conn:
+            trigram = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+        if not trigram:
+            for table in models.Base.metadata.sorted_tables:
+                for index in list(table.indexes):
+                    if index.name.endswith("_trgm"):
+                        table.indexes.discard(index)
+    models.Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    return trigram
+
+def analyze_tables():
+    # Statystyki plannera po wypełnieniu bazy
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM ANALYZE"))
+    else:
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", type=float, default=1.0, help="mnożnik liczności danych testowych")
+    parser.add_argument("--verbose", action="store_true", help="wypisz plany zapytań")
+    args = parser.parse_args(argv)
+
+    if engine.dialect.name != "postgresql":
+        print("explain_check wymaga Postgresa (DATABASE_URL)")
+        return 2
+    trigram = prepare_database()
+    with engine.begin() as conn:
+        if conn.execute(select(func.count()).select_from(models.Client)).scalar_one() == 0:
+            print(f"🔄 Wypełnianie bazy danymi testowymi (scale={args.scale})...")
+            seed(conn, args.scale)
+    analyze_tables()
+
+    failures = 0
+    with engine.connect() as conn:
+        ids = probe_ids(conn)
+        if trigram:
+            # Próg %> jak w crud.search_products (ważny do końca transakcji)
+            conn.execute(text(f"SET LOCAL pg_trgm.word_similarity_threshold = {crud.PRODUCT_FUZZY_THRESHOLD}"))
+        for name, statement in endpoint_queries(ids, trigram):
+            plans = explain(conn, statement)
+            for number, plan in enumerate(plans, 1):
+                # Kolejne zapytania tego samego endpointu (selectin) - z numerem
+                label = name if len(plans) == 1 else f"{name} [{number}/{len(plans)}]"
+                scans = seq_scans(plan)
+                if scans:
+                    failures += 1
+                    print(f"❌ {label}: Seq Scan on {', '.join(sorted(set(scans)))}")
+                else:
+                    print(f"✅ {label}")
+                if args.verbose or scans:
+                    print(json.dumps(plan, indent=2))
+        # Polecenia UPDATE (oznaczanie wiadomości, przejęcie zadania) zostały wykonane - wycofujemy je
+        conn.rollback()
+    print(f"{failures} zapytań z Seq Scan" if failures else "Wszystkie zapytania korzystają z indeksów")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
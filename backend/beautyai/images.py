@@ -0,0 +1,180 @@
+# images.py - Analysis image derivatives (thumbnail / medium / full) and cached file serving
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import aiofiles
+from fastapi import HTTPException, Request, status
+from fastapi.responses import Response, StreamingResponse
+
+from backend.beautyai.uploads import UPLOAD_DIRECTORY
+
+logger = logging.getLogger(__name__)
+
+DERIVED_DIRECTORY = os.path.join(UPLOAD_DIRECTORY, "derived")
+IMAGE_DERIVATIVE_PROCESSES = int(os.getenv("IMAGE_DERIVATIVE_PROCESSES", str(min(2, os.cpu_count() or 1))))
+# Dłuższy bok w pikselach; zmiana rozmiarów/jakości = nowa wersja (inne nazwy plików i ETagi)
+VARIANTS = {"thumb": 256, "medium": 1024, "full": 2048}
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+DERIVATIVE_VERSION = "v1"
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+# Pliki pochodne i oryginały nie zmieniają się pod tą samą nazwą - klient może je trzymać bezterminowo
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+FILE_CHUNK_SIZE = 64 * 1024
+
+ORIGINAL_MEDIA_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp", "heic": "image/heic"}
+
+_SHA256_NAME = re.compile(r"^[0-9a-f]{64}$")
+_process_pool: Optional[ProcessPoolExecutor] = None
+_inflight: Dict[str, asyncio.Future] = {}
+
+def source_key(image_path: str) -> str:
+    # Zdjęcia z uploads.py mają w nazwie SHA-256 treści; starsze ścieżki - skrót ścieżki, rozmiaru i mtime
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    if _SHA256_NAME.match(stem):
+        return stem
+    stat = os.stat(image_path)
+    return hashlib.sha256(f"{image_path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+def derivative_path(key: str, variant: str, fmt: str) -> str:
+    return os.path.join(DERIVED_DIRECTORY, key[:2], key[2:4], f"{key}_{variant}_{DERIVATIVE_VERSION}.{fmt}")
+
+def derivative_etag(key: str, variant: str, fmt: str) -> str:
+    return f'"{key[:32]}-{variant}-{DERIVATIVE_VERSION}-{fmt}"'
+
+def generate_derivatives(source_path: str, key: str) -> int:
+    # Uruchamiane w puli procesów: jedno dekodowanie oryginału, kolejne warianty skalowane od największego
+    from PIL import Image, ImageOps
+
+    written = 0
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    for variant, size in sorted(VARIANTS.items(), key=lambda item: -item[1]):
+        image.thumbnail((size, size), Image.LANCZOS)
+        for fmt in FORMATS:
+            path = derivative_path(key, variant, fmt)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.part"
+            if fmt == "webp":
+                image.save(tmp_path, "WEBP", quality=WEBP_QUALITY, method=4)
+            else:
+                image.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            written += 1
+    return written
+
+def derivatives_exist(key: str) -> bool:
+    return all(os.path.exists(derivative_path(key, variant, fmt)) for variant in VARIANTS for fmt in FORMATS)
+
+def get_process_pool() -> ProcessPoolExecutor:
+    # Tworzona przy pierwszym zdjęciu - Pillow ładuje się tylko w procesach puli
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_DERIVATIVE_PROCESSES)
+    return _process_pool
+
+def shutdown():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+def ensure_derivatives(source_path: str, key: Optional[str] = None) -> asyncio.Future:
+    # Jedno generowanie na zdjęcie naraz - równoległe żądania czekają na to samo zadanie
+    key = key or source_key(source_path)
+    future = _inflight.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = asyncio.ensure_future(loop.run_in_executor(get_process_pool(), generate_derivatives, source_path, key))
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    return future
+
+def schedule_derivatives(source_path: str, key: str):
+    # Po uploadzie - w tle, bez czekania; błąd tylko w logu (plik i tak zostanie wygenerowany przy odczycie)
+    if derivatives_exist(key):
+        return
+
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"❌ Błąd generowania miniatur {key}: {future.exception()}")
+
+    ensure_derivatives(source_path, key).add_done_callback(_log_failure)
+
+def preferred_format(accept: Optional[str]) -> str:
+    return "webp" if accept and "image/webp" in accept else "jpeg"
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    # Tylko pojedynczy zakres bajtów; inne formy są ignorowane (odpowiedź 200 z całym plikiem)
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[6:].strip().partition("-")
+    try:
+        if not start_text:
+            length = int(end_text)
+            if length <= 0:
+                raise ValueError
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+async def _read_file(path: str, start: int, length: int):
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def file_response(request: Request, path: str, media_type: str, etag: str, vary_accept: bool = False) -> Response:
+    # Odpowiedź z pliku z ETag (304), Range (206/416) i nagłówkami cache
+    stat = os.stat(path)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if vary_accept:
+        headers["Vary"] = "Accept"
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    size = stat.st_size
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range z innym ETagiem = plik się zmienił, zwracamy całość
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_read_file(path, 0, size), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _read_file(path, start, end - start + 1), status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type, headers=headers,
+    )
@@ -0,0 +1,184 @@
+# inference.py - Micro-batching inference server for the skin analysis model
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from backend.beautyai import metrics
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "8"))
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "20"))
+# Ładowanie modelu w tle zaraz po starcie; bez tego model ładuje się przy pierwszej analizie
+INFERENCE_WARMUP = os.getenv("INFERENCE_WARMUP", "true").lower() in ("1", "true", "yes", "on")
+
+batch_seconds = metrics.histogram("inference_batch_seconds", "Czas przetwarzania paczki (preprocessing + model)")
+batch_size = metrics.histogram(
+    "inference_batch_size", "Liczba zdjęć w paczce", buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+batch_occupancy = metrics.histogram(
+    "inference_batch_occupancy", "Wypełnienie paczki (rozmiar / INFERENCE_MAX_BATCH_SIZE)",
+    buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 1.0),
+)
+queue_wait_seconds = metrics.histogram("inference_queue_wait_seconds", "Czas oczekiwania zdjęcia na paczkę")
+
+class ImageDecodeError(ValueError):
+    # Zdjęcie, którego nie da się odczytać (uszkodzone, nie-obraz) - ponowienie nic nie zmieni
+    pass
+
+# TensorFlow, NumPy i Pillow importowane dopiero tutaj (w wątku inferencji) - start workera
+# i endpointy niezwiązane z analizą ich nie potrzebują
+def default_load_model():
+    from backend.beautyai import skin_analysis
+
+    skin_analysis.get_model()
+
+def default_analyze_batch(image_paths: List[str]) -> list:
+    from backend.beautyai import skin_analysis
+
+    return skin_analysis.analyze_batch(image_paths)
+
+class ModelState:
+    NOT_LOADED = "not_loaded"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+class InferenceServer:
+    # Zbiera równoległe żądania analizy w paczki: paczka rusza, gdy osiągnie max_batch_size
+    # albo gdy od pierwszego żądania minie max_wait_ms. Model działa w jednym wątku -
+    # jedno predict na paczkę zamiast jednego na zdjęcie (TensorFlow sam zrównolegla obliczenia).
+    def __init__(self, max_batch_size: int = INFERENCE_MAX_BATCH_SIZE, max_wait_ms: float = INFERENCE_MAX_WAIT_MS,
+                 analyze_batch: Callable[[List[str]], list] = default_analyze_batch,
+                 load_model: Callable[[], None] = default_load_model, warmup: bool = INFERENCE_WARMUP):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.analyze_batch = analyze_batch
+        self.load_model = load_model
+        # Ładowanie modelu w tle po starcie aplikacji (main.startup_event)
+        self.warmup = warmup
+        self.model_state = ModelState.NOT_LOADED
+        self.model_error: Optional[str] = None
+        self.model_load_seconds: Optional[float] = None
+        self._model_lock = threading.Lock()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._batch_loop())
+
+    def _ensure_model(self):
+        # Wywoływane w wątku inferencji; po błędzie kolejna paczka próbuje ponownie
+        if self.model_state == ModelState.READY:
+            return
+        with self._model_lock:
+            if self.model_state == ModelState.READY:
+                return
+            self.model_state = ModelState.LOADING
+            started = time.perf_counter()
+            try:
+                self.load_model()
+            except Exception as e:
+                self.model_state = ModelState.FAILED
+                self.model_error = f"{type(e).__name__}: {e}"
+                raise
+            self.model_load_seconds = round(time.perf_counter() - started, 3)
+            self.model_state = ModelState.READY
+            self.model_error = None
+            logger.info(f"✅ Model analizy skóry załadowany w {self.model_load_seconds} s")
+
+    def _run_batch(self, image_paths: List[str]) -> list:
+        self._ensure_model()
+        return self.analyze_batch(image_paths)
+
+    def start_warm_up(self):
+        if self._warmup_task is None and self.model_state != ModelState.READY:
+            self._warmup_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        # Zadanie w tle po starcie - nie blokuje obsługi żądań
+        self._ensure_started()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._ensure_model)
+        except Exception as e:
+            logger.error(f"❌ Nie udało się załadować modelu analizy: {e}")
+
+    def status(self) -> dict:
+        return {"state": self.model_state, "error": self.model_error, "load_seconds": self.model_load_seconds}
+
+    async def predict(self, image_path: str) -> dict:
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image_path, future, time.perf_counter()))
+        return await future
+
+    async def stop(self):
+        if self._warmup_task is not None:
+            self._warmup_task.cancel()
+            await asyncio.gather(self._warmup_task, return_exceptions=True)
+            self._warmup_task = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("Inference server stopped"))
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _collect(self) -> List[Tuple[str, asyncio.Future, float]]:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Porzucone żądania (np. anulowany worker) nie zajmują miejsca w paczce
+        return [item for item in batch if not item[1].done()]
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                queue_wait_seconds.observe(started - enqueued)
+            paths = [path for path, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self._run_batch, paths)
+            except Exception as e:
+                logger.error(f"❌ Błąd inferencji paczki ({len(batch)} zdjęć): {e}")
+                results = [e] * len(batch)
+            batch_seconds.observe(time.perf_counter() - started)
+            batch_size.observe(len(batch))
+            batch_occupancy.observe(len(batch) / self.max_batch_size)
+            for (_, future, _), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+server = InferenceServer()
@@ -0,0 +1,426 @@
+# jobs.py - Background job queue and worker pool for AI skin analysis
+
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import case, select, update
+
+from backend.beautyai import crud, inference, metrics, models, scoring
+from backend.beautyai.database import AsyncSessionLocal, SQLALCHEMY_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_QUEUE = os.getenv("ANALYSIS_QUEUE", "postgres")                        # postgres | memory
+# Równoległe analizy na proces; zdjęcia z różnych workerów łączą się w paczki w inference.py
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "8"))
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3"))
+ANALYSIS_RETRY_BASE_SECONDS = float(os.getenv("ANALYSIS_RETRY_BASE_SECONDS", "5"))
+ANALYSIS_POLL_SECONDS = float(os.getenv("ANALYSIS_POLL_SECONDS", "1"))
+# Zadanie "running" bez postępu dłużej niż tyle sekund (np. worker padł) wraca do kolejki
+ANALYSIS_LOCK_TIMEOUT_SECONDS = float(os.getenv("ANALYSIS_LOCK_TIMEOUT_SECONDS", "300"))
+# Co tyle sekund żywy worker odświeża locked_at - także gdy zdjęcie czeka w kolejce inferencji
+ANALYSIS_HEARTBEAT_SECONDS = float(os.getenv("ANALYSIS_HEARTBEAT_SECONDS", str(ANALYSIS_LOCK_TIMEOUT_SECONDS / 5)))
+
+job_duration_seconds = metrics.histogram(
+    "analysis_job_seconds", "Czas wykonania zadania analizy", labelnames=("outcome",)
+)
+job_wait_seconds = metrics.histogram("analysis_job_wait_seconds", "Czas oczekiwania zadania w kolejce")
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+class PermanentJobError(Exception):
+    # Błąd, którego ponowienie nic nie zmieni (brak analizy, brak pliku) - od razu failed
+    pass
+
+@dataclass
+class Job:
+    id: int
+    analysis_id: int
+    status: models.JobStatus = models.JobStatus.QUEUED
+    attempts: int = 0
+    max_attempts: int = ANALYSIS_MAX_ATTEMPTS
+    progress: int = 0
+    error: Optional[str] = None
+    run_after: Optional[datetime] = None
+    locked_by: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    @classmethod
+    def from_row(cls, row: models.AnalysisJob) -> "Job":
+        return cls(
+            id=row.id,
+            analysis_id=row.analysis_id,
+            status=row.status,
+            attempts=row.attempts,
+            max_attempts=row.max_attempts,
+            progress=row.progress,
+            error=row.error,
+            run_after=row.run_after,
+            locked_by=row.locked_by,
+            created_at=row.created_at,
+            updated_at=row.updated_at,
+        )
+
+def retry_delay(attempts: int) -> float:
+    # Wykładniczy backoff: 5 s, 10 s, 20 s, ...
+    return ANALYSIS_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0))
+
+class JobQueue(ABC):
+    def __init__(self):
+        # Budzi lokalnych workerów po enqueue; inne procesy odpytują co ANALYSIS_POLL_SECONDS
+        self._wakeup = asyncio.Event()
+
+    @abstractmethod
+    async def enqueue(self, analysis_id: int, max_attempts: int = ANALYSIS_MAX_ATTEMPTS) -> Job:
+        ...
+
+    @abstractmethod
+    async def get(self, job_id: int) -> Optional[Job]:
+        ...
+
+    @abstractmethod
+    async def claim(self, worker_id: str) -> Optional[Job]:
+        ...
+
+    @abstractmethod
+    async def set_progress(self, job: Job, progress: int):
+        ...
+
+    @abstractmethod
+    async def heartbeat(self, job: Job) -> bool:
+        # Odświeża blokadę; False = zadanie przejął już ktoś inny
+        ...
+
+    @abstractmethod
+    async def complete(self, job: Job) -> bool:
+        # False = blokadę przejął inny worker (zadanie uznane za porzucone) - nic nie zapisano
+        ...
+
+    @abstractmethod
+    async def fail(self, job: Job, error: str, retry: bool = True):
+        ...
+
+    async def requeue_stale(self) -> int:
+        return 0
+
+    async def wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def _notify(self):
+        self._wakeup.set()
+
+class InMemoryJobQueue(JobQueue):
+    # Jeden proces i testy - zadania giną przy restarcie
+    def __init__(self):
+        super().__init__()
+        self._jobs: Dict[int, Job] = {}
+        self._next_id = 1
+
+    async def enqueue(self, analysis_id: int, max_attempts: int = ANALYSIS_MAX_ATTEMPTS) -> Job:
+        now = _now()
+        job = Job(id=self._next_id, analysis_id=analysis_id, max_attempts=max_attempts,
+                  run_after=now, created_at=now, updated_at=now)
+        self._jobs[job.id] = job
+        self._next_id += 1
+        self._notify()
+        return job
+
+    async def get(self, job_id: int) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def claim(self, worker_id: str) -> Optional[Job]:
+        # Bez await w środku - w obrębie pętli zdarzeń operacja jest atomowa
+        now = _now()
+        for job in self._jobs.values():
+            if job.status == models.JobStatus.QUEUED and job.run_after <= now:
+                job.status = models.JobStatus.RUNNING
+                job.attempts += 1
+                job.locked_by = worker_id
+                job.updated_at = now
+                return job
+        return None
+
+    async def set_progress(self, job: Job, progress: int):
+        job.progress = progress
+        job.updated_at = _now()
+
+    async def heartbeat(self, job: Job) -> bool:
+        # Jeden proces, bez requeue_stale - blokada nie wygasa
+        job.updated_at = _now()
+        return True
+
+    async def complete(self, job: Job) -> bool:
+        job.status = models.JobStatus.SUCCEEDED
+        job.progress = 100
+        job.error = None
+        job.locked_by = None
+        job.updated_at = _now()
+        return True
+
+    async def fail(self, job: Job, error: str, retry: bool = True):
+        job.error = error
+        job.locked_by = None
+        job.updated_at = _now()
+        if retry and job.attempts < job.max_attempts:
+            job.status = models.JobStatus.QUEUED
+            job.run_after = job.updated_at + timedelta(seconds=retry_delay(job.attempts))
+        else:
+            job.status = models.JobStatus.FAILED
+
+def claim_statement(worker_id: str):
+    # Najstarsze gotowe zadanie przejęte jednym UPDATE ... RETURNING; SKIP LOCKED - workery się nie blokują
+    AnalysisJob = models.AnalysisJob
+    next_job = (
+        select(AnalysisJob.id)
+        .where(AnalysisJob.status == models.JobStatus.QUEUED, AnalysisJob.run_after <= _now())
+        .order_by(AnalysisJob.run_after, AnalysisJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    return (
+        update(AnalysisJob)
+        .where(AnalysisJob.id == next_job)
+        .values(
+            status=models.JobStatus.RUNNING,
+            attempts=AnalysisJob.attempts + 1,
+            locked_at=_now(),
+            locked_by=worker_id,
+            updated_at=_now(),
+        )
+        .returning(AnalysisJob)
+        .execution_options(synchronize_session=False)
+    )
+
+class PostgresJobQueue(JobQueue):
+    # Kolejka w tabeli analysis_jobs - przeżywa restart, dzielona przez wszystkie workery.
+    # Pobranie zadania: UPDATE ... WHERE id = (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING
+    def __init__(self, session_factory=AsyncSessionLocal):
+        super().__init__()
+        self.session_factory = session_factory
+
+    async def enqueue(self, analysis_id: int, max_attempts: int = ANALYSIS_MAX_ATTEMPTS) -> Job:
+        async with self.session_factory() as db:
+            row = models.AnalysisJob(analysis_id=analysis_id, max_attempts=max_attempts)
+            db.add(row)
+            await db.commit()
+            await db.refresh(row)
+            job = Job.from_row(row)
+        self._notify()
+        return job
+
+    async def get(self, job_id: int) -> Optional[Job]:
+        async with self.session_factory() as db:
+            row = await db.get(models.AnalysisJob, job_id)
+            return Job.from_row(row) if row is not None else None
+
+    async def claim(self, worker_id: str) -> Optional[Job]:
+        async with self.session_factory() as db:
+            row = (await db.execute(claim_statement(worker_id))).scalars().first()
+            await db.commit()
+            return Job.from_row(row) if row is not None else None
+
+    async def _update(self, job: Job, **values) -> bool:
+        # Tylko dopóki zadanie należy do tego workera - po requeue_stale mogło trafić do innego
+        async with self.session_factory() as db:
+            result = await db.execute(
+                update(models.AnalysisJob)
+                .where(
+                    models.AnalysisJob.id == job.id,
+                    models.AnalysisJob.status == models.JobStatus.RUNNING,
+                    models.AnalysisJob.locked_by == job.locked_by,
+                )
+                .values(updated_at=_now(), **values)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            return bool(result.rowcount)
+
+    async def set_progress(self, job: Job, progress: int):
+        job.progress = progress
+        # Postęp odświeża też locked_at - żywy worker nie zostanie uznany za martwy
+        await self._update(job, progress=progress, locked_at=_now())
+
+    async def heartbeat(self, job: Job) -> bool:
+        return await self._update(job, locked_at=_now())
+
+    async def complete(self, job: Job) -> bool:
+        job.status = models.JobStatus.SUCCEEDED
+        return await self._update(job, status=job.status, progress=100, error=None, locked_at=None, locked_by=None)
+
+    async def fail(self, job: Job, error: str, retry: bool = True):
+        values = {"error": error[:2000], "locked_at": None, "locked_by": None}
+        if retry and job.attempts < job.max_attempts:
+            job.status = models.JobStatus.QUEUED
+            values["run_after"] = _now() + timedelta(seconds=retry_delay(job.attempts))
+        else:
+            job.status = models.JobStatus.FAILED
+        await self._update(job, status=job.status, **values)
+
+    async def requeue_stale(self) -> int:
+        AnalysisJob = models.AnalysisJob
+        exhausted = AnalysisJob.attempts >= AnalysisJob.max_attempts
+        statement = (
+            update(AnalysisJob)
+            .where(
+                AnalysisJob.status == models.JobStatus.RUNNING,
+                AnalysisJob.locked_at < _now() - timedelta(seconds=ANALYSIS_LOCK_TIMEOUT_SECONDS),
+            )
+            .values(
+                status=case((exhausted, models.JobStatus.FAILED), else_=models.JobStatus.QUEUED),
+                error=case((exhausted, "Worker stopped responding"), else_=AnalysisJob.error),
+                locked_at=None,
+                locked_by=None,
+                run_after=_now(),
+                updated_at=_now(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        async with self.session_factory() as db:
+            result = await db.execute(statement)
+            await db.commit()
+            return result.rowcount or 0
+
+def create_job_queue() -> JobQueue:
+    backend = SQLALCHEMY_DATABASE_URL.split("://", 1)[0].split("+", 1)[0]
+    if ANALYSIS_QUEUE == "postgres" and backend == "postgresql":
+        return PostgresJobQueue()
+    return InMemoryJobQueue()
+
+async def default_analyze(image_path: str) -> dict:
+    return await inference.server.predict(image_path)
+
+class AnalysisWorkerPool:
+    # ANALYSIS_WORKERS zadań asyncio na proces = limit równoległych analiz
+    def __init__(self, queue: JobQueue, concurrency: int = ANALYSIS_WORKERS,
+                 analyze: Callable[[str], Awaitable[dict]] = default_analyze, session_factory=AsyncSessionLocal):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.analyze = analyze
+        self.session_factory = session_factory
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._tasks = []
+
+    async def start(self):
+        if self._tasks or self.concurrency <= 0:
+            return
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._reaper()))
+        logger.info(f"✅ Kolejka analiz: {self.concurrency} worker(y), {type(self.queue).__name__}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await inference.server.stop()
+
+    async def _worker(self, n: int):
+        worker_id = f"{self.worker_id}/{n}"
+        while True:
+            try:
+                job = await self.queue.claim(worker_id)
+            except Exception as e:
+                logger.error(f"❌ Błąd pobierania zadania analizy: {e}")
+                job = None
+            if job is None:
+                await self.queue.wait(ANALYSIS_POLL_SECONDS)
+                continue
+            await self.run_job(job)
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(ANALYSIS_LOCK_TIMEOUT_SECONDS / 2)
+            try:
+                requeued = await self.queue.requeue_stale()
+                if requeued:
+                    logger.warning(f"⚠️ Przywrócono {requeued} porzuconych zadań analizy")
+            except Exception as e:
+                logger.error(f"❌ Błąd przywracania zadań analizy: {e}")
+
+    async def _heartbeat(self, job: Job):
+        # Przez cały czas zadania (kolejka inferencji i model mogą trwać dłużej niż ANALYSIS_LOCK_TIMEOUT_SECONDS)
+        while True:
+            await asyncio.sleep(ANALYSIS_HEARTBEAT_SECONDS)
+            try:
+                if not await self.queue.heartbeat(job):
+                    logger.warning(f"⚠️ Zadanie analizy {job.id} przejął inny worker")
+                    return
+            except Exception as e:
+                logger.error(f"❌ Błąd odświeżania blokady zadania {job.id}: {e}")
+
+    async def run_job(self, job: Job):
+        started = _now()
+        if job.created_at is not None and job.attempts == 1:
+            job_wait_seconds.observe((started - job.created_at).total_seconds())
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            # Sesje tylko na krótkie odczyty/zapisy - podczas inferencji żadne połączenie z puli nie jest zajęte
+            async with self.session_factory() as db:
+                analysis = await db.get(models.Analysis, job.analysis_id)
+                if analysis is None:
+                    raise PermanentJobError("Analysis not found")
+                image_path = analysis.image_path
+            if not image_path or not os.path.exists(image_path):
+                raise PermanentJobError("Analysis image not found")
+            await self.queue.set_progress(job, 10)
+
+            try:
+                result = await self.analyze(image_path)
+            except inference.ImageDecodeError as e:
+                raise PermanentJobError(f"Analysis image cannot be decoded: {e}") from e
+            await self.queue.set_progress(job, 90)
+
+            async with self.session_factory() as db:
+                analysis = await db.get(models.Analysis, job.analysis_id)
+                if analysis is None:
+                    raise PermanentJobError("Analysis not found")
+                for field in ("skin_type", "hydration_level", "sebum_level", "pigmentation",
+                              "wrinkles", "pores", "sensitivity", "ai_recommendations"):
+                    if field in result:
+                        setattr(analysis, field, result[field])
+                # Rekomendacje produktów z macierzy katalogu (scoring.py), w tej samej transakcji co wynik
+                product_ids = (await scoring.scorer.recommend(db, [analysis]))[0]
+                await crud.set_recommended_products(db, analysis.id, product_ids)
+                await db.commit()
+            if await self.queue.complete(job):
+                outcome = "succeeded"
+            else:
+                # Zadanie uznane za porzucone i przejęte - jego wynik zapisze nowy właściciel
+                logger.warning(f"⚠️ Zadanie analizy {job.id} zakończone po utracie blokady")
+                outcome = "lost"
+        except asyncio.CancelledError:
+            # Zamknięcie workera - zadanie wróci do kolejki po ANALYSIS_LOCK_TIMEOUT_SECONDS
+            raise
+        except PermanentJobError as e:
+            await self._fail(job, str(e), retry=False)
+            outcome = "failed"
+        except Exception as e:
+            logger.error(f"❌ Zadanie analizy {job.id} (próba {job.attempts}): {e}")
+            await self._fail(job, f"{type(e).__name__}: {e}", retry=True)
+            outcome = "retried" if job.status == models.JobStatus.QUEUED else "failed"
+        finally:
+            heartbeat.cancel()
+        job_duration_seconds.observe((_now() - started).total_seconds(), outcome)
+
+    async def _fail(self, job: Job, error: str, retry: bool):
+        try:
+            await self.queue.fail(job, error, retry=retry)
+        except Exception as e:
+            logger.error(f"❌ Nie udało się zapisać błędu zadania {job.id}: {e}")
+
+job_queue: JobQueue = create_job_queue()
+worker_pool = AnalysisWorkerPool(job_queue)
@@ -1,19 +1,18 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Body
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Body, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event, inspect
 from typing import List, Optional
+from dataclasses import dataclass
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 import os
-import shutil
-import base64
-import numpy as np
-import io
-from PIL import Image
 import logging
+import time
 
 # ✅ Konfiguracja loggera
 logging.basicConfig(level=logging.INFO)
@@ -23,17 +22,42 @@ logger = logging.getLogger(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # ✅ LOKALNE MODUŁY
-from backend.beautyai import models, schemas
+from backend.beautyai import models, schemas, crud
 from backend.beautyai.models import Base
-from backend.beautyai.database import SessionLocal, engine
+from backend.beautyai.database import SessionLocal, AsyncSessionLocal, engine, async_engine, get_pool_stats, create_extensions, slow_query_log
+from backend.beautyai.cache import TTLCache
+from backend.beautyai.migrations import run_migrations
+from backend.beautyai import metrics, passwords, pdf, images, scoring
+from backend.beautyai.chat_broker import broker as chat_broker
+from backend.beautyai.jobs import worker_pool as analysis_workers
+from backend.beautyai.inference import server as inference_server
 
-# ✅ Kryptografia haseł
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# ✅ Kryptografia haseł (bcrypt w puli wątków - patrz passwords.py)
+pwd_context = passwords.pwd_context
+login_latency_seconds = metrics.histogram(
+    "auth_login_seconds", "Czas obsługi logowania", labelnames=("outcome",)
+)
 
 # ✅ Konfiguracja JWT
 SECRET_KEY = "YOUR_SECRET_KEY_HERE"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
+# Tryb bezstanowy: rola, id i status konta z claimów JWT, bez zapytania do bazy.
+# Uwaga: dezaktywacja konta / zmiana roli działa wtedy dopiero po wygaśnięciu tokenu.
+AUTH_STATELESS_JWT = os.getenv("AUTH_STATELESS_JWT", "false").lower() in ("1", "true", "yes", "on")
+
+# ✅ Migracje schematu przy starcie (wyłącz, jeśli uruchamiane osobno: python -m backend.beautyai.migrations)
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes", "on")
+
+# ✅ Cache zalogowanych użytkowników (klucz: `sub` z tokenu)
+# TTL to zarazem okno odwołania przy kilku workerach: dezaktywacja konta / zmiana roli w jednym
+# procesie unieważnia tylko jego cache, pozostałe widzą ją najpóźniej po TTL - stąd górny limit.
+PRINCIPAL_CACHE_MAX_TTL_SECONDS = 300
+PRINCIPAL_CACHE_TTL_SECONDS = min(
+    float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30")), PRINCIPAL_CACHE_MAX_TTL_SECONDS,
+)
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "1024"))
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL_SECONDS)
 
 # ✅ Inicjalizacja FastAPI
 app = FastAPI(
@@ -51,8 +75,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ✅ Ścieżka na uploady
-UPLOAD_DIRECTORY = "uploads/"
+# ✅ Metryki żądań (czas, rozmiar odpowiedzi, liczba i czas zapytań SQL) - dodane jako ostatnie, więc najbardziej zewnętrzne
+app.add_middleware(metrics.RequestMetricsMiddleware)
+
+# ✅ Ścieżka na uploady (konfiguracja w uploads.py)
+from backend.beautyai.uploads import UPLOAD_DIRECTORY
 os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 
 # ✅ Dependency - baza danych
@@ -63,20 +90,88 @@ def get_db():
     finally:
         db.close()
 
+# ✅ Dependency - asynchroniczna sesja bazy danych (dla endpointów `async def`)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# ✅ Zalogowany użytkownik - niezależny od sesji, bezpieczny do trzymania w cache
+@dataclass(frozen=True)
+class Principal:
+    id: int
+    email: str
+    role: models.UserRole
+    is_active: bool
+    full_name: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+    @classmethod
+    def from_user(cls, user: models.User) -> "Principal":
+        return cls(
+            id=user.id,
+            email=user.email,
+            role=user.role,
+            is_active=user.is_active,
+            full_name=user.full_name,
+            created_at=user.created_at,
+        )
+
+# Zmiana statusu konta, roli lub e-maila unieważnia wpis w cache. Klucze zbierane przy flush,
+# usuwane dopiero po commit - wcześniej równoległe żądanie odczytałoby z bazy jeszcze stare dane
+# i zapisało je w cache na pełny TTL. Pozostałe workery (procesy) nie dostają tego sygnału:
+# tam zmiana działa dopiero po PRINCIPAL_CACHE_TTL_SECONDS.
+PRINCIPAL_FIELDS = ("is_active", "role", "email")
+_PRINCIPAL_CHANGES = "principal_cache_changes"
+
+@event.listens_for(Session, "after_flush")
+def _collect_principal_changes(session, flush_context):
+    emails = set()
+    for obj in session.deleted:
+        if isinstance(obj, models.User):
+            emails.add(inspect(obj).dict.get("email"))
+    for obj in session.dirty:
+        if not isinstance(obj, models.User):
+            continue
+        state = inspect(obj)
+        if any(state.attrs[field].history.has_changes() for field in PRINCIPAL_FIELDS):
+            emails.add(state.dict.get("email"))
+            emails.update(state.attrs.email.history.deleted)
+    emails = {email for email in emails if isinstance(email, str)}
+    if emails:
+        session.info.setdefault(_PRINCIPAL_CHANGES, set()).update(emails)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_principals(session):
+    for email in session.info.pop(_PRINCIPAL_CHANGES, ()):
+        principal_cache.pop(email)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_principal_changes(session):
+    session.info.pop(_PRINCIPAL_CHANGES, None)
+
 # ✅ Funkcje autoryzacji
+# Wersje synchroniczne - dla skryptów i startu aplikacji; endpointy używają passwords.*
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def get_user(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user(db: AsyncSession, email: str):
+    result = await db.execute(crud.user_by_email_query(email))
+    return result.scalars().first()
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = get_user(db, email)
-    if not user or not verify_password(password, user.hashed_password):
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user(db, email)
+    if not user:
         return False
+    valid, new_hash = await passwords.verify_and_update(password, user.hashed_password)
+    if not valid:
+        return False
+    if new_hash:
+        # Hash z przestarzałymi parametrami (np. niższy koszt bcrypt) - podmień przy okazji logowania
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -85,25 +180,52 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-# ✅ Dependency do tokenu i użytkownika
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def principal_from_claims(payload: dict) -> Optional[Principal]:
+    try:
+        return Principal(
+            id=int(payload["uid"]),
+            email=payload["sub"],
+            role=models.UserRole(payload["role"]),
+            is_active=bool(payload["active"]),
+        )
+    except (KeyError, TypeError, ValueError):
+        # Stary token bez claimów - ścieżka przez cache/bazę
+        return None
+
+# ✅ Rozwiązanie tokenu na użytkownika (wspólne dla HTTP i WebSocket); None = nieważny token
+async def resolve_principal(token: str, db: AsyncSession) -> Optional[Principal]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
-            raise credentials_exception
+            return None
         token_data = schemas.TokenData(email=email)
     except JWTError:
-        raise credentials_exception
-    user = get_user(db, email=token_data.email)
+        return None
+    if AUTH_STATELESS_JWT:
+        principal = principal_from_claims(payload)
+        if principal is not None:
+            return principal
+    principal = principal_cache.get(token_data.email)
+    if principal is not None:
+        return principal
+    user = await get_user(db, email=token_data.email)
     if user is None:
-        raise credentials_exception
-    return user
+        return None
+    principal = Principal.from_user(user)
+    principal_cache.set(token_data.email, principal)
+    return principal
+
+# ✅ Dependency do tokenu i użytkownika
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    principal = await resolve_principal(token, db)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
 
 async def get_current_active_user(current_user: schemas.User = Depends(get_current_user)):
     if not current_user.is_active:
@@ -145,19 +267,58 @@ def create_superadmin():
 
 # ✅ Endpoint logowania
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    started = time.perf_counter()
+    user = await authenticate_user(db, form_data.username, form_data.password)
+    login_latency_seconds.observe(time.perf_counter() - started, "success" if user else "failure")
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": user.email}, expires_delta=access_token_expires)
+    access_token = create_access_token(
+        data={"sub": user.email, "uid": user.id, "role": user.role.value if user.role else None, "active": user.is_active},
+        expires_delta=access_token_expires,
+    )
     return {"access_token": access_token, "token_type": "bearer"}
 
+# ✅ Statystyki wydajności (pula połączeń) - tylko superadmin
+@app.get("/admin/stats")
+async def read_runtime_stats(current_user: schemas.User = Depends(get_superadmin_user)):
+    return {
+        "db_pool": get_pool_stats(),
+        "principal_cache": principal_cache.stats(),
+        "metrics": metrics.snapshot(),
+        "product_scorer": scoring.scorer.stats(),
+    }
+
+# ✅ Dziennik wolnych zapytań (SQL, kształt parametrów, trasa, plan EXPLAIN) - tylko superadmin
+@app.get("/admin/slow-queries")
+async def read_slow_queries(limit: Optional[int] = None, current_user: schemas.User = Depends(get_superadmin_user)):
+    return slow_query_log.entries(limit)
+
+@app.delete("/admin/slow-queries", status_code=status.HTTP_204_NO_CONTENT)
+async def clear_slow_queries(current_user: schemas.User = Depends(get_superadmin_user)):
+    slow_query_log.clear()
+
+# ✅ Metryki w formacie Prometheus (histogramy żądań, zapytań SQL, logowania, analiz AI)
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
 # ✅ Endpoint testowy
 @app.get("/")
 def read_root():
     return {"message": "Welcome to BeautyAI API"}
 
+# ✅ Gotowość workera - API obsługuje ruch od razu, model analizy ładuje się w tle.
+# `?model=true` zwraca 503, dopóki model nie jest załadowany (np. dla workerów tylko do analiz).
+@app.get("/ready")
+def read_readiness(response: Response, model: bool = False):
+    model_status = inference_server.status()
+    ready = not model or model_status["state"] == "ready"
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ready" if ready else "starting", "model": model_status}
+
 # ✅ Procedura uruchomieniowa
 @app.on_event("startup")
 async def startup_event():
@@ -165,18 +326,57 @@ async def startup_event():
     # DEBUG: pokaż, jaką wartość widzi aplikacja w DATABASE_URL
     logger.info(f"DATABASE_URL = {os.getenv('DATABASE_URL')}")
 
+    try:
+        # Rozszerzenia Postgresa potrzebne indeksom (pg_trgm - wyszukiwanie z literówkami)
+        create_extensions(engine)
+    except Exception as e:
+        logger.error(f"❌ Błąd przy tworzeniu rozszerzeń bazy: {e}")
+
     try:
         Base.metadata.create_all(bind=engine)
         logger.info("✅ Tabele utworzone")
     except Exception as e:
         logger.error(f"❌ Błąd przy tworzeniu tabel: {e}")
 
+    if MIGRATE_ON_STARTUP:
+        try:
+            # Zmiany istniejących tabel (np. indeksy) - create_all ich nie wprowadza
+            run_migrations(engine)
+        except Exception as e:
+            logger.error(f"❌ Błąd przy migracji bazy: {e}")
+
     try:
         create_superadmin()
     except Exception as e:
         logger.error(f"❌ Błąd przy tworzeniu superadmina: {e}")
 
+    try:
+        await chat_broker.start()
+    except Exception as e:
+        logger.error(f"❌ Błąd przy uruchamianiu brokera czatu: {e}")
+
+    try:
+        await analysis_workers.start()
+    except Exception as e:
+        logger.error(f"❌ Błąd przy uruchamianiu kolejki analiz: {e}")
+
+    if inference_server.warmup:
+        inference_server.start_warm_up()
+
+# ✅ Shutdown - zamknięcie puli połączeń asynchronicznych
+@app.on_event("shutdown")
+async def shutdown_event():
+    await analysis_workers.stop()
+    await chat_broker.stop()
+    await async_engine.dispose()
+    passwords.shutdown()
+    pdf.shutdown()
+    images.shutdown()
+
+# ✅ Endpointy planów pielęgnacyjnych i czatu
+from backend.beautyai import additional_endpoints  # noqa: E402,F401
+
 # ✅ Uruchomienie ręczne (np. `python main.py`)
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("backend.beautyai.main:app", host="0.0.0.0", port=8000)
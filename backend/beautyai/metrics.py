@@ -0,0 +1,227 @@
+# metrics.py - In-process performance metrics (histograms), per-request SQL accounting and Prometheus export
+
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# Żądania z większą liczbą zapytań SQL dostają nagłówek X-Query-Count i wpis w logu (wykrywanie N+1); 0 wyłącza
+REQUEST_QUERY_COUNT_WARN = int(os.getenv("REQUEST_QUERY_COUNT_WARN", "20"))
+
+class Histogram:
+    # Histogram z kubełkami (jak w Prometheus); osobne serie dla każdej kombinacji etykiet
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # etykiety -> [liczniki kubełków..., +Inf], suma
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        key = tuple(str(v) for v in labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self) -> dict:
+        result = {}
+        with self._lock:
+            for key, (counts, total) in self._series.items():
+                count = sum(counts)
+                result[",".join(key) or "all"] = {
+                    "count": count,
+                    "sum": round(total, 6),
+                    "avg": round(total / count, 6) if count else 0.0,
+                    "p50": self._quantile(counts, count, 0.5),
+                    "p95": self._quantile(counts, count, 0.95),
+                    "p99": self._quantile(counts, count, 0.99),
+                }
+        return result
+
+    def samples(self) -> list:
+        # [(etykiety, skumulowane liczniki kubełków z +Inf, suma)] - do eksportu w formacie Prometheus
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        result = []
+        for key, counts, total in items:
+            cumulative, running = [], 0
+            for n in counts:
+                running += n
+                cumulative.append(running)
+            result.append((key, cumulative, total))
+        return result
+
+    def _quantile(self, counts, count, q):
+        # Szacunek z kubełków: górna granica kubełka, w którym wypada kwantyl
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+# Rejestr metryk procesu
+REGISTRY: Dict[str, Histogram] = {}
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    metric = REGISTRY.get(name)
+    if metric is None:
+        metric = REGISTRY[name] = Histogram(name, documentation, labelnames, buckets)
+    return metric
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in REGISTRY.items()}
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+def render_prometheus() -> str:
+    # Format tekstowy Prometheus 0.0.4 dla wszystkich histogramów z rejestru
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, cumulative, total in metric.samples():
+            for bound, value in zip(metric.buckets + (float("inf"),), cumulative):
+                lines.append(f"{name}_bucket{_labels(metric.labelnames, key, ('le', _number(bound)))} {value}")
+            lines.append(f"{name}_sum{_labels(metric.labelnames, key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(metric.labelnames, key)} {cumulative[-1]}")
+    return "\n".join(lines) + "\n"
+
+# === PER-REQUEST INSTRUMENTATION ===
+
+request_latency_seconds = histogram(
+    "http_request_duration_seconds", "Czas obsługi żądania HTTP", labelnames=("method", "route", "status"),
+)
+response_size_bytes = histogram(
+    "http_response_size_bytes", "Rozmiar treści odpowiedzi HTTP", labelnames=("method", "route"), buckets=SIZE_BUCKETS,
+)
+request_queries = histogram(
+    "http_request_db_queries", "Liczba zapytań SQL na żądanie", labelnames=("method", "route"),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+request_query_seconds = histogram(
+    "http_request_db_seconds", "Łączny czas zapytań SQL na żądanie", labelnames=("method", "route"),
+)
+
+class RequestStats:
+    __slots__ = ("scope", "queries", "query_seconds")
+
+    def __init__(self, scope=None):
+        self.scope = scope
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def route(self) -> Optional[str]:
+        # "GET /care-plans/{care_plan_id}" - trasa jest znana dopiero po dopasowaniu przez router
+        if self.scope is None:
+            return None
+        return f"{self.scope['method']} {route_label(self.scope)}"
+
+# Statystyki bieżącego żądania; obiekt jest współdzielony z kopiami kontekstu (pula wątków, greenlet SQLAlchemy)
+_current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _current_request.get()
+
+def instrument_engine(engine):
+    # Liczba i czas zapytań przypisywane do żądania HTTP, w którym zostały wykonane (poza żądaniem - pomijane)
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        stats = _current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += time.perf_counter() - started
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        # Nieudane zapytanie nie wywołuje after_cursor_execute - zdejmujemy jego znacznik czasu
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+
+def route_label(scope) -> str:
+    # Szablon ścieżki (/care-plans/{care_plan_id}) zamiast konkretnego URL - ograniczona liczba serii
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+class RequestMetricsMiddleware:
+    # Middleware ASGI (bez buforowania odpowiedzi - działa też dla StreamingResponse):
+    # czas, rozmiar odpowiedzi oraz liczba i czas zapytań SQL dla każdego żądania HTTP
+    def __init__(self, app, query_count_warn: int = REQUEST_QUERY_COUNT_WARN):
+        self.app = app
+        self.query_count_warn = query_count_warn
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _current_request.set(stats)
+        started = time.perf_counter()
+        status_code = 500
+        size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status_code, size
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.query_count_warn and stats.queries > self.query_count_warn:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-query-count", str(stats.queries).encode()),
+                    ]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _current_request.reset(token)
+            elapsed = time.perf_counter() - started
+            method, route = scope["method"], route_label(scope)
+            request_latency_seconds.observe(elapsed, method, route, status_code)
+            response_size_bytes.observe(size, method, route)
+            request_queries.observe(stats.queries, method, route)
+            request_query_seconds.observe(stats.query_seconds, method, route)
+            if self.query_count_warn and stats.queries > self.query_count_warn:
+                logger.warning(
+                    f"⚠️ {method} {route}: {stats.queries} zapytań SQL "
+                    f"({stats.query_seconds * 1000:.1f} ms SQL, {elapsed * 1000:.1f} ms łącznie)"
+                )
@@ -0,0 +1,72 @@
+# migrations - Versioned schema migrations applied on top of Base.metadata.create_all
+#
+# create_all tworzy tylko brakujące tabele - nie dodaje indeksów ani kolumn do istniejących.
+# Zmiany istniejących tabel trafiają tu jako kolejne moduły mNNNN_opis.py z funkcją upgrade(conn)
+# i atrybutem TRANSACTIONAL (False = autocommit, np. CREATE INDEX CONCURRENTLY).
+# Wykonane wersje są zapisywane w tabeli schema_migrations.
+#
+# Ręcznie: python -m backend.beautyai.migrations
+
+import importlib
+import logging
+import pkgutil
+import re
+from typing import List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, insert, select, text
+
+logger = logging.getLogger(__name__)
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+# Stały klucz blokady doradczej - równolegle startujące workery nie migrują naraz
+ADVISORY_LOCK_KEY = 7_020_321
+
+_MODULE_NAME = re.compile(r"^m(\d{4})_\w+$")
+
+def discover() -> List[Tuple[int, str]]:
+    found = []
+    for module in pkgutil.iter_modules(__path__):
+        match = _MODULE_NAME.match(module.name)
+        if match:
+            found.append((int(match.group(1)), module.name))
+    return sorted(found)
+
+def applied_versions(conn) -> set:
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+def run_migrations(engine) -> List[str]:
+    # Zwraca nazwy zastosowanych migracji
+    _metadata.create_all(engine)
+    applied = []
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        if postgres:
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+        try:
+            done = applied_versions(lock_conn)
+            for version, name in discover():
+                if version in done:
+                    continue
+                module = importlib.import_module(f"{__name__}.{name}")
+                logger.info(f"🔄 Migracja {name}...")
+                if getattr(module, "TRANSACTIONAL", True):
+                    with engine.begin() as conn:
+                        module.upgrade(conn)
+                        conn.execute(insert(schema_migrations).values(version=version, name=name))
+                else:
+                    module.upgrade(lock_conn)
+                    lock_conn.execute(insert(schema_migrations).values(version=version, name=name))
+                applied.append(name)
+                logger.info(f"✅ Migracja {name} zakończona")
+        finally:
+            if postgres:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+    return applied
@@ -0,0 +1,15 @@
+# Uruchomienie migracji poza startem API: python -m backend.beautyai.migrations
+
+import logging
+
+from backend.beautyai import models
+from backend.beautyai.database import create_extensions, engine
+from backend.beautyai.migrations import run_migrations
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    create_extensions(engine)
+    models.Base.metadata.create_all(bind=engine)
+    applied = run_migrations(engine)
+    print(f"Zastosowane migracje: {', '.join(applied) or 'brak'}")
@@ -0,0 +1,71 @@
+# m0001 - Foreign-key and composite access-path indexes on pre-existing tables
+#
+# Bazy utworzone przed tymi zmianami mają tabele bez indeksów zadeklarowanych później w models.py.
+# Na Postgresie indeksy powstają przez CREATE INDEX CONCURRENTLY (bez blokowania zapisów),
+# dlatego migracja działa poza transakcją. Istniejące indeksy są pomijane (nowa baza z create_all).
+#
+# DDL jest zapisany na stałe - migracja ma tworzyć dokładnie to, co istniało w chwili jej napisania,
+# niezależnie od późniejszych zmian w models.py.
+
+from sqlalchemy import bindparam, text
+
+TRANSACTIONAL = False
+
+# (nazwa, definicja po ON) - wspólne dla Postgresa i SQLite
+INDEXES = [
+    ("ix_clients_cosmetologist_id", "clients (cosmetologist_id)"),
+    ("ix_analyses_client_id_performed_at_id", "analyses (client_id, performed_at, id)"),
+    ("ix_analyses_created_by", "analyses (created_by)"),
+    ("ix_care_plans_client_id_created_at_id", "care_plans (client_id, created_at, id)"),
+    ("ix_care_plans_created_at_id", "care_plans (created_at, id)"),
+    ("ix_care_plans_analysis_id", "care_plans (analysis_id)"),
+    ("ix_care_plans_created_by", "care_plans (created_by)"),
+    ("ix_care_plan_items_care_plan_id_order_id", 'care_plan_items (care_plan_id, "order", id)'),
+    ("ix_care_plan_items_product_id", "care_plan_items (product_id)"),
+    ("ix_chat_messages_client_id_sent_at_id", "chat_messages (client_id, sent_at, id)"),
+    ("ix_chat_messages_unread_client_id", "chat_messages (client_id, is_from_client) WHERE read_at IS NULL"),
+    ("ix_chat_messages_sender_id", "chat_messages (sender_id)"),
+    ("ix_analysis_product_product_id", "analysis_product (product_id)"),
+    ("ix_products_category", "products (category)"),
+    ("ix_products_brand", "products (brand)"),
+]
+# Indeksy GIN (tsvector, pg_trgm) istnieją tylko na Postgresie
+POSTGRES_INDEXES = [
+    ("ix_products_search_vector",
+     "products USING gin (("
+     "setweight(to_tsvector('simple'::regconfig, coalesce(name, '')), 'A') || "
+     "setweight(to_tsvector('simple'::regconfig, coalesce(brand, '')), 'A') || "
+     "setweight(to_tsvector('simple'::regconfig, coalesce(description, '')), 'C') || "
+     "setweight(to_tsvector('simple'::regconfig, coalesce(ingredients, '')), 'D')))"),
+]
+# Wymagają rozszerzenia pg_trgm - bez niego pomijane (jak w create_all, patrz create_extensions)
+TRIGRAM_INDEXES = [
+    ("ix_products_name_trgm", "products USING gin (name gin_trgm_ops)"),
+    ("ix_products_brand_trgm", "products USING gin (brand gin_trgm_ops)"),
+]
+
+def invalid_indexes(conn, names) -> list:
+    # Przerwany CREATE INDEX CONCURRENTLY zostawia indeks z indisvalid = false: planner go nie używa,
+    # a IF NOT EXISTS by go pominął - trzeba go usunąć i zbudować od nowa
+    return list(conn.execute(
+        text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid) AND c.relname IN :names"
+        ).bindparams(bindparam("names", expanding=True)),
+        {"names": list(names)},
+    ).scalars())
+
+def upgrade(conn):
+    if conn.dialect.name != "postgresql":
+        for name, definition in INDEXES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+        return
+
+    indexes = INDEXES + POSTGRES_INDEXES
+    trigram = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+    if trigram:
+        indexes += TRIGRAM_INDEXES
+    for name in invalid_indexes(conn, [name for name, _ in indexes]):
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    for name, definition in indexes:
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
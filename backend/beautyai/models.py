@@ -1,8 +1,10 @@
 # models.py - SQLAlchemy models
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Float, Boolean, Table, Enum
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Float, Boolean, Table, Enum, Index, text, literal, cast
+from sqlalchemy.dialects.postgresql import REGCONFIG
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql import func
 import enum
 from typing import List
@@ -11,31 +13,39 @@ import datetime
 Base = declarative_base()
 
 # Enumeracje
-class UserRole(enum.Enum):
+class UserRole(str, enum.Enum):
     ADMIN = "admin"         # Kosmetolog (administrator)
     CLIENT = "client"       # Klientka
     SUPERADMIN = "superadmin"  # Właściciel systemu
 
-class SkinType(enum.Enum):
+class SkinType(str, enum.Enum):
     DRY = "dry"             # Sucha
     OILY = "oily"           # Tłusta
     COMBINATION = "combination"  # Mieszana
     NORMAL = "normal"       # Normalna
     SENSITIVE = "sensitive" # Wrażliwa
 
-class SkinConcern(enum.Enum):
+class SkinConcern(str, enum.Enum):
     ACNE = "acne"           # Trądzik
     AGING = "aging"         # Starzenie
     PIGMENTATION = "pigmentation"  # Przebarwienia
     REDNESS = "redness"     # Zaczerwienienia
     DEHYDRATION = "dehydration"    # Odwodnienie
 
+class JobStatus(str, enum.Enum):
+    QUEUED = "queued"       # Czeka w kolejce (także przed ponowną próbą)
+    RUNNING = "running"     # Przetwarzane przez workera
+    SUCCEEDED = "succeeded" # Wyniki zapisane w analizie
+    FAILED = "failed"       # Wyczerpane próby lub błąd trwały
+
 # Tabela łącząca dla relacji wiele-do-wielu między Analysis i Product
 analysis_product = Table(
     'analysis_product',
     Base.metadata,
     Column('analysis_id', Integer, ForeignKey('analyses.id'), primary_key=True),
-    Column('product_id', Integer, ForeignKey('products.id'), primary_key=True)
+    Column('product_id', Integer, ForeignKey('products.id'), primary_key=True),
+    # Klucz główny zaczyna się od analysis_id - osobny indeks dla wyszukiwania po produkcie
+    Index('ix_analysis_product_product_id', 'product_id'),
 )
 
 class User(Base):
@@ -58,7 +68,7 @@ class Client(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), unique=True)
-    cosmetologist_id = Column(Integer, ForeignKey("users.id"))
+    cosmetologist_id = Column(Integer, ForeignKey("users.id"), index=True)
     phone = Column(String)
     birth_date = Column(DateTime)
     address = Column(String)
@@ -76,7 +86,7 @@ class Analysis(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     client_id = Column(Integer, ForeignKey("clients.id"))
-    created_by = Column(Integer, ForeignKey("users.id"))
+    created_by = Column(Integer, ForeignKey("users.id"), index=True)
     performed_at = Column(DateTime(timezone=True), server_default=func.now())
     image_path = Column(String)
     skin_type = Column(Enum(SkinType))
@@ -92,12 +102,39 @@ class Analysis(Base):
     notes = Column(Text)
     ai_recommendations = Column(Text)
 
+    # Analizy klientki od najnowszych: WHERE client_id = ? ORDER BY performed_at, id
+    __table_args__ = (
+        Index("ix_analyses_client_id_performed_at_id", "client_id", "performed_at", "id"),
+    )
+
     # Relacje
     client = relationship("Client", back_populates="analyses")
     creator = relationship("User")
     recommended_products = relationship("Product", secondary=analysis_product, back_populates="analyses")
     care_plan = relationship("CarePlan", back_populates="analysis", uselist=False)
 
+# Typy skóry i problemy, do których przeznaczony jest produkt. Klucz główny (product_id, wartość)
+# obsługuje odczyt cech produktu, indeks (wartość, product_id) - wyszukiwanie produktów po cesze.
+class ProductSkinType(Base):
+    __tablename__ = "product_skin_types"
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    skin_type = Column(Enum(SkinType), primary_key=True)
+
+    __table_args__ = (
+        Index("ix_product_skin_types_skin_type_product_id", "skin_type", "product_id"),
+    )
+
+class ProductSkinConcern(Base):
+    __tablename__ = "product_skin_concerns"
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    skin_concern = Column(Enum(SkinConcern), primary_key=True)
+
+    __table_args__ = (
+        Index("ix_product_skin_concerns_skin_concern_product_id", "skin_concern", "product_id"),
+    )
+
 class Product(Base):
     __tablename__ = "products"
 
@@ -112,39 +149,102 @@ class Product(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    # Facety wyszukiwarki - liczniki po kategorii i marce
+    __table_args__ = (
+        Index("ix_products_category", "category"),
+        Index("ix_products_brand", "brand"),
+    )
+
     # Relacje
     analyses = relationship("Analysis", secondary=analysis_product, back_populates="recommended_products")
     care_plan_items = relationship("CarePlanItem", back_populates="product")
+    # Leniwe - zapytania, które serializują cechy produktu, dokładają crud.product_traits() (selectin);
+    # w AsyncSession nie wolno ich dociągać przy dostępie do atrybutu
+    skin_type_links = relationship(
+        "ProductSkinType", cascade="all, delete-orphan", passive_deletes=True,
+        order_by="ProductSkinType.skin_type",
+    )
+    skin_concern_links = relationship(
+        "ProductSkinConcern", cascade="all, delete-orphan", passive_deletes=True,
+        order_by="ProductSkinConcern.skin_concern",
+    )
+    skin_types = association_proxy(
+        "skin_type_links", "skin_type", creator=lambda skin_type: ProductSkinType(skin_type=skin_type)
+    )
+    skin_concerns = association_proxy(
+        "skin_concern_links", "skin_concern", creator=lambda skin_concern: ProductSkinConcern(skin_concern=skin_concern)
+    )
+
+# Wyszukiwanie pełnotekstowe produktów (Postgres): ważony tsvector - nazwa i marka ważniejsze od opisu i składu.
+# Zapytania muszą używać dokładnie tego wyrażenia, żeby planner wybrał indeks GIN.
+# Stałe wpisane w SQL (literal_execute), a nie jako parametry - inaczej wyrażenie w zapytaniu nie pasuje do indeksu
+SEARCH_CONFIG = cast(literal("simple", literal_execute=True), REGCONFIG)  # bez stemmingu - nazwy, marki i składy INCI
+
+def _weighted_tsvector(column, weight: str):
+    return func.setweight(
+        func.to_tsvector(SEARCH_CONFIG, func.coalesce(column, literal("", literal_execute=True))),
+        literal(weight, literal_execute=True),
+    )
+
+_products = Product.__table__
+product_search_vector = (
+    _weighted_tsvector(_products.c.name, "A")
+    .op("||")(_weighted_tsvector(_products.c.brand, "A"))
+    .op("||")(_weighted_tsvector(_products.c.description, "C"))
+    .op("||")(_weighted_tsvector(_products.c.ingredients, "D"))
+)
+
+# Indeksy tylko dla Postgresa (GIN, pg_trgm) - SQLite w testach ich nie tworzy
+Index("ix_products_search_vector", product_search_vector, postgresql_using="gin").ddl_if(dialect="postgresql")
+Index(
+    "ix_products_name_trgm", Product.name,
+    postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"},
+).ddl_if(dialect="postgresql")
+Index(
+    "ix_products_brand_trgm", Product.brand,
+    postgresql_using="gin", postgresql_ops={"brand": "gin_trgm_ops"},
+).ddl_if(dialect="postgresql")
 
 class CarePlan(Base):
     __tablename__ = "care_plans"
 
     id = Column(Integer, primary_key=True, index=True)
     client_id = Column(Integer, ForeignKey("clients.id"))
-    analysis_id = Column(Integer, ForeignKey("analyses.id"))
-    created_by = Column(Integer, ForeignKey("users.id"))
+    analysis_id = Column(Integer, ForeignKey("analyses.id"), index=True)
+    created_by = Column(Integer, ForeignKey("users.id"), index=True)
     title = Column(String, nullable=False)
     description = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     valid_until = Column(DateTime)
 
+    # Stronicowanie keyset: lista planów klienta / kosmetologa po (created_at, id)
+    __table_args__ = (
+        Index("ix_care_plans_client_id_created_at_id", "client_id", "created_at", "id"),
+        Index("ix_care_plans_created_at_id", "created_at", "id"),
+    )
+
     # Relacje
     client = relationship("Client", back_populates="care_plans")
     analysis = relationship("Analysis", back_populates="care_plan")
     creator = relationship("User")
-    items = relationship("CarePlanItem", back_populates="care_plan")
+    items = relationship("CarePlanItem", back_populates="care_plan", order_by="CarePlanItem.order")
 
 class CarePlanItem(Base):
     __tablename__ = "care_plan_items"
 
     id = Column(Integer, primary_key=True, index=True)
     care_plan_id = Column(Integer, ForeignKey("care_plans.id"))
-    product_id = Column(Integer, ForeignKey("products.id"))
+    product_id = Column(Integer, ForeignKey("products.id"), index=True)
     usage_time = Column(String)
     usage_frequency = Column(String)
     usage_instructions = Column(Text)
     order = Column(Integer)
 
+    # Pozycje planu w kolejności: WHERE care_plan_id IN (...) ORDER BY order
+    __table_args__ = (
+        Index("ix_care_plan_items_care_plan_id_order_id", "care_plan_id", "order", "id"),
+    )
+
     # Relacje
     care_plan = relationship("CarePlan", back_populates="items")
     product = relationship("Product", back_populates="care_plan_items")
@@ -154,12 +254,47 @@ class ChatMessage(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     client_id = Column(Integer, ForeignKey("clients.id"))
-    sender_id = Column(Integer, ForeignKey("users.id"))
+    sender_id = Column(Integer, ForeignKey("users.id"), index=True)
     is_from_client = Column(Boolean, default=True)
     message = Column(Text, nullable=False)
     sent_at = Column(DateTime(timezone=True), server_default=func.now())
     read_at = Column(DateTime(timezone=True))
 
+    # Stronicowanie keyset historii czatu po (sent_at, id) w obrębie klienta;
+    # częściowy indeks nieprzeczytanych dla liczników w podsumowaniu rozmów
+    __table_args__ = (
+        Index("ix_chat_messages_client_id_sent_at_id", "client_id", "sent_at", "id"),
+        Index(
+            "ix_chat_messages_unread_client_id", "client_id", "is_from_client",
+            postgresql_where=text("read_at IS NULL"),
+            sqlite_where=text("read_at IS NULL"),
+        ),
+    )
+
     # Relacje
     client = relationship("Client", back_populates="chat_messages")
     sender = relationship("User")
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    analysis_id = Column(Integer, ForeignKey("analyses.id"), nullable=False, index=True)
+    status = Column(Enum(JobStatus), nullable=False, default=JobStatus.QUEUED)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    progress = Column(Integer, nullable=False, default=0)  # 0-100
+    error = Column(Text)
+    run_after = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_at = Column(DateTime(timezone=True))
+    locked_by = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    # Pobieranie następnego zadania: status = queued AND run_after <= now() ORDER BY run_after
+    __table_args__ = (
+        Index("ix_analysis_jobs_status_run_after", "status", "run_after"),
+    )
+
+    # Relacje
+    analysis = relationship("Analysis")
@@ -0,0 +1,69 @@
+# passwords.py - Password hashing off the event loop
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+from backend.beautyai import metrics
+
+# Koszt bcrypt; hasła z niższym kosztem są przehashowywane przy logowaniu
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Maksymalna liczba równoległych operacji bcrypt na worker (pozostałe czekają w kolejce)
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(min(4, os.cpu_count() or 1))))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
+
+# bcrypt zwalnia GIL, więc pula wątków wystarcza i nie wymaga serializacji danych jak pula procesów
+_executor: Optional[ThreadPoolExecutor] = None
+
+password_hash_seconds = metrics.histogram(
+    "password_hash_seconds",
+    "Czas operacji bcrypt (bez oczekiwania w kolejce)",
+    labelnames=("operation",),
+)
+password_queue_seconds = metrics.histogram(
+    "password_queue_seconds",
+    "Czas oczekiwania operacji bcrypt na wolny wątek",
+    labelnames=("operation",),
+)
+
+def _timed(operation: str, submitted_at: float, fn, *args):
+    started = time.perf_counter()
+    password_queue_seconds.observe(started - submitted_at, operation)
+    try:
+        return fn(*args)
+    finally:
+        password_hash_seconds.observe(time.perf_counter() - started, operation)
+
+def get_executor() -> ThreadPoolExecutor:
+    # Tworzona przy pierwszym użyciu i od nowa po shutdown() (kolejny start aplikacji w tym samym procesie)
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="bcrypt")
+    return _executor
+
+async def _run(operation: str, fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), _timed, operation, time.perf_counter(), fn, *args)
+
+async def verify_and_update(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    # (czy hasło poprawne, nowy hash jeśli parametry hasha są przestarzałe)
+    return await _run("verify", pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", pwd_context.hash, password)
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
@@ -0,0 +1,272 @@
+# pdf.py - Streaming PDF rendering for care plan export
+
+import hashlib
+import io
+import json
+import os
+import textwrap
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from backend.beautyai import models
+from backend.beautyai.cache import TTLCache
+
+# Cache gotowych PDF-ów: klucz (id planu, wersja treści) - niezmieniony plan nie jest renderowany ponownie
+PDF_CACHE_SIZE = int(os.getenv("PDF_CACHE_SIZE", "256"))
+PDF_CACHE_TTL_SECONDS = float(os.getenv("PDF_CACHE_TTL_SECONDS", "3600"))
+pdf_cache = TTLCache(maxsize=PDF_CACHE_SIZE, ttl=PDF_CACHE_TTL_SECONDS)
+# Procesy renderujące przy eksporcie zbiorczym (ZIP)
+PDF_RENDER_PROCESSES = int(os.getenv("PDF_RENDER_PROCESSES", str(min(4, os.cpu_count() or 1))))
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+# Układ strony A4 (punkty)
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 50
+FONT_SIZE = 10
+LEADING = 14
+WRAP_WIDTH = 95  # znaków w linii przy Helvetica 10pt i szerokości 495pt
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * MARGIN) // LEADING
+
+# Standardowe czcionki PDF nie mają polskich liter w WinAnsiEncoding -
+# przypisujemy je do nieużywanych w polskim tekście kodów przez /Differences
+POLISH_GLYPHS = {
+    "ą": (0x81, "aogonek"), "ć": (0x8D, "cacute"), "ę": (0x8F, "eogonek"), "ł": (0x90, "lslash"),
+    "ń": (0x9D, "nacute"), "ś": (0xA4, "sacute"), "ź": (0xA6, "zacute"), "ż": (0xA8, "zdotaccent"),
+    "Ą": (0xAA, "Aogonek"), "Ć": (0xAF, "Cacute"), "Ę": (0xB2, "Eogonek"), "Ł": (0xB3, "Lslash"),
+    "Ń": (0xB9, "Nacute"), "Ś": (0xBA, "Sacute"), "Ź": (0xBC, "Zacute"), "Ż": (0xBD, "Zdotaccent"),
+}
+_REMAPPED_CODES = {code for code, _ in POLISH_GLYPHS.values()}
+
+def _encode_text(text: str) -> bytes:
+    out = bytearray()
+    for char in text:
+        if char in POLISH_GLYPHS:
+            out.append(POLISH_GLYPHS[char][0])
+            continue
+        try:
+            code = char.encode("cp1252")
+        except UnicodeEncodeError:
+            code = b"?"
+        out += b"?" if code[0] in _REMAPPED_CODES else code
+    return bytes(out).replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+class PdfStreamWriter:
+    # Minimalny zapis PDF 1.4 kawałkami: strony są wysyłane od razu po złożeniu,
+    # drzewo stron i tablica xref na końcu (offsety liczone na bieżąco).
+    CATALOG_ID, PAGES_ID, FONT_ID, BOLD_FONT_ID = 1, 2, 3, 4
+
+    def __init__(self):
+        self._offset = 0
+        self._offsets = {}
+        self._next_id = 5
+        self._page_ids: List[int] = []
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def _object(self, obj_id: int, body: bytes) -> bytes:
+        self._offsets[obj_id] = self._offset
+        return self._emit(b"%d 0 obj\n" % obj_id + body + b"\nendobj\n")
+
+    def header(self) -> bytes:
+        return self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def page(self, content: bytes) -> bytes:
+        content_id, page_id = self._next_id, self._next_id + 1
+        self._next_id += 2
+        self._page_ids.append(page_id)
+        compressed = zlib.compress(content)
+        stream = (b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(compressed)) + compressed + b"\nendstream"
+        page = (
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 %d 0 R /F2 %d 0 R >> >> /Contents %d 0 R >>"
+            % (self.PAGES_ID, PAGE_WIDTH, PAGE_HEIGHT, self.FONT_ID, self.BOLD_FONT_ID, content_id)
+        )
+        return self._object(content_id, stream) + self._object(page_id, page)
+
+    def trailer(self) -> bytes:
+        differences = b" ".join(b"%d /%s" % (code, name.encode()) for code, name in sorted(POLISH_GLYPHS.values()))
+        chunks = []
+        for font_id, base_font in ((self.FONT_ID, b"Helvetica"), (self.BOLD_FONT_ID, b"Helvetica-Bold")):
+            chunks.append(self._object(font_id, (
+                b"<< /Type /Font /Subtype /Type1 /BaseFont /" + base_font +
+                b" /Encoding << /Type /Encoding /BaseEncoding /WinAnsiEncoding /Differences [" + differences + b"] >> >>"
+            )))
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self._page_ids)
+        chunks.append(self._object(self.PAGES_ID, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._page_ids))))
+        chunks.append(self._object(self.CATALOG_ID, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES_ID))
+
+        xref_offset = self._offset
+        size = self._next_id
+        xref = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for obj_id in range(1, size):
+            xref.append(b"%010d 00000 n \n" % self._offsets[obj_id])
+        xref.append(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, self.CATALOG_ID, xref_offset))
+        chunks.append(self._emit(b"".join(xref)))
+        return b"".join(chunks)
+
+def _page_content(lines: List[Tuple[bool, str]]) -> bytes:
+    parts = [b"BT\n%d TL\n%d %d Td\n" % (LEADING, MARGIN, PAGE_HEIGHT - MARGIN)]
+    current_bold = None
+    for bold, text in lines:
+        if bold != current_bold:
+            parts.append(b"/F%d %d Tf\n" % (2 if bold else 1, FONT_SIZE))
+            current_bold = bold
+        parts.append(b"(" + _encode_text(text) + b") Tj T*\n")
+    parts.append(b"ET\n")
+    return b"".join(parts)
+
+def render_lines(lines: Iterable[Tuple[bool, str]]) -> Iterator[bytes]:
+    # Renderuje linie (pogrubienie, tekst) i oddaje PDF kawałkami - strona po stronie
+    writer = PdfStreamWriter()
+    yield writer.header()
+    page: List[Tuple[bool, str]] = []
+    for bold, text in lines:
+        for wrapped in textwrap.wrap(text, WRAP_WIDTH) or [""]:
+            page.append((bold, wrapped))
+            if len(page) == LINES_PER_PAGE:
+                yield writer.page(_page_content(page))
+                page = []
+    if page or not writer._page_ids:
+        yield writer.page(_page_content(page))
+    yield writer.trailer()
+
+# === CARE PLAN ===
+
+def _fmt(value, suffix: str = "") -> str:
+    return "Nie określono" if value is None else f"{value}{suffix}"
+
+def care_plan_snapshot(db_care_plan: models.CarePlan) -> dict:
+    # Zwykłe dane zamiast obiektów ORM - render działa w innym wątku/procesie, bez sesji
+    client_user = db_care_plan.client.user if db_care_plan.client else None
+    analysis = db_care_plan.analysis
+    return {
+        "id": db_care_plan.id,
+        "title": db_care_plan.title,
+        "description": db_care_plan.description,
+        "client_name": client_user.full_name if client_user else None,
+        "created_at": db_care_plan.created_at.isoformat() if db_care_plan.created_at else None,
+        "valid_until": db_care_plan.valid_until.isoformat() if db_care_plan.valid_until else None,
+        "items": [
+            {
+                "name": item.product.name if item.product else None,
+                "brand": item.product.brand if item.product else None,
+                "usage_time": item.usage_time,
+                "usage_frequency": item.usage_frequency,
+                "usage_instructions": item.usage_instructions,
+            }
+            for item in sorted(db_care_plan.items, key=lambda item: (item.order is None, item.order or 0, item.id))
+        ],
+        "analysis": None if analysis is None else {
+            "skin_type": analysis.skin_type.value if analysis.skin_type else None,
+            "hydration_level": analysis.hydration_level,
+            "sebum_level": analysis.sebum_level,
+            "pigmentation": analysis.pigmentation,
+            "wrinkles": analysis.wrinkles,
+            "pores": analysis.pores,
+            "sensitivity": analysis.sensitivity,
+            "ai_recommendations": analysis.ai_recommendations,
+        },
+    }
+
+def snapshot_version(snapshot: dict) -> str:
+    # Wersja treści - każda zmiana planu, pozycji, produktu czy analizy zmienia klucz cache
+    return hashlib.sha1(json.dumps(snapshot, sort_keys=True, default=str).encode()).hexdigest()
+
+def care_plan_lines(snapshot: dict) -> Iterator[Tuple[bool, str]]:
+    yield True, f"Plan pielęgnacyjny: {snapshot['title']}"
+    yield False, ""
+    yield False, f"Klientka: {_fmt(snapshot['client_name'])}"
+    yield False, f"Data utworzenia: {_fmt(snapshot['created_at'])}"
+    yield False, f"Ważny do: {_fmt(snapshot['valid_until'])}"
+    yield False, ""
+    yield True, "Opis planu:"
+    for paragraph in (snapshot["description"] or "").splitlines() or [""]:
+        yield False, paragraph
+    yield False, ""
+    yield True, "Produkty:"
+    for item in snapshot["items"]:
+        yield False, f"- {_fmt(item['name'])} ({_fmt(item['brand'])})"
+        yield False, f"   Czas stosowania: {item['usage_time'] or 'Nie określono'}"
+        yield False, f"   Częstotliwość: {item['usage_frequency'] or 'Nie określono'}"
+        yield False, f"   Instrukcje: {item['usage_instructions'] or 'Brak szczegółowych instrukcji'}"
+    analysis: Optional[dict] = snapshot["analysis"]
+    if analysis is not None:
+        yield False, ""
+        yield True, "Analiza skóry:"
+        yield False, f"Typ skóry: {_fmt(analysis['skin_type'])}"
+        yield False, f"Poziom nawilżenia: {_fmt(analysis['hydration_level'], '%')}"
+        yield False, f"Poziom sebum: {_fmt(analysis['sebum_level'], '%')}"
+        yield False, f"Przebarwienia: {_fmt(analysis['pigmentation'], '%')}"
+        yield False, f"Zmarszczki: {_fmt(analysis['wrinkles'], '%')}"
+        yield False, f"Pory: {_fmt(analysis['pores'], '%')}"
+        yield False, f"Wrażliwość: {_fmt(analysis['sensitivity'], '%')}"
+        yield False, ""
+        yield True, "Rekomendacje AI:"
+        for paragraph in (analysis["ai_recommendations"] or "Brak rekomendacji AI").splitlines():
+            yield False, paragraph
+    yield False, ""
+    yield False, "---"
+    yield False, "BeautyAI - System wspierający kosmetologów w analizie skóry"
+
+def render_care_plan_pdf(snapshot: dict) -> Iterator[bytes]:
+    return render_lines(care_plan_lines(snapshot))
+
+def render_care_plan_pdf_bytes(snapshot: dict) -> bytes:
+    return b"".join(render_care_plan_pdf(snapshot))
+
+def get_process_pool() -> ProcessPoolExecutor:
+    # Tworzona przy pierwszym eksporcie - zwykłe workery API nie uruchamiają procesów
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PDF_RENDER_PROCESSES)
+    return _process_pool
+
+def shutdown():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+# === ZIP ===
+
+class _ZipStream(io.RawIOBase):
+    # Strumień tylko do zapisu dla zipfile: bufor jest opróżniany po każdym pliku,
+    # więc archiwum nigdy nie jest trzymane w pamięci w całości
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+class ZipStreamWriter:
+    def __init__(self):
+        self._stream = _ZipStream()
+        # PDF-y mają już skompresowane strumienie - ZIP_STORED oszczędza CPU
+        self._zip = zipfile.ZipFile(self._stream, mode="w", compression=zipfile.ZIP_STORED)
+
+    def add(self, name: str, data: bytes) -> bytes:
+        self._zip.writestr(zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), data)
+        return self._stream.take()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._stream.take()
@@ -24,6 +24,12 @@ class SkinConcern(str, Enum):
     REDNESS = "redness"     # Zaczerwienienia
     DEHYDRATION = "dehydration"    # Odwodnienie
 
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
 # Token Authentication
 class Token(BaseModel):
     access_token: str
@@ -99,10 +105,16 @@ class ProductBase(BaseModel):
     image_url: Optional[str] = None
     price: Optional[float] = None
 
+def unique_values(values):
+    # Powtórzone typy skóry / problemy zapisywane raz (klucz główny tabel łączących)
+    return list(dict.fromkeys(values)) if values is not None else values
+
 class ProductCreate(ProductBase):
     skin_types: List[SkinType] = []
     skin_concerns: List[SkinConcern] = []
 
+    _unique_traits = validator("skin_types", "skin_concerns", allow_reuse=True)(unique_values)
+
 class ProductUpdate(BaseModel):
     name: Optional[str] = None
     brand: Optional[str] = None
@@ -114,16 +126,39 @@ class ProductUpdate(BaseModel):
     skin_types: Optional[List[SkinType]] = None
     skin_concerns: Optional[List[SkinConcern]] = None
 
+    _unique_traits = validator("skin_types", "skin_concerns", allow_reuse=True)(unique_values)
+
 class Product(ProductBase):
     id: int
     created_at: datetime
     updated_at: Optional[datetime] = None
     skin_types: List[SkinType] = []
     skin_concerns: List[SkinConcern] = []
+
+    # association_proxy z modelu to nie lista - pydantic v1 wymaga konwersji
+    _traits_as_list = validator("skin_types", "skin_concerns", pre=True, allow_reuse=True)(
+        lambda values: list(values) if values is not None else []
+    )
     
     class Config:
         orm_mode = True
 
+# Wyszukiwarka produktów: strona wyników, liczba trafień i facety
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+class ProductFacets(BaseModel):
+    category: List[FacetCount] = []
+    brand: List[FacetCount] = []
+
+class ProductSearchPage(BaseModel):
+    items: List[Product] = []
+    total: int
+    limit: int
+    offset: int
+    facets: ProductFacets
+
 # Analysis schemas
 class AnalysisBase(BaseModel):
     client_id: int
@@ -178,6 +213,22 @@ class AnalysisDetail(Analysis):
     class Config:
         orm_mode = True
 
+# Zadanie analizy AI (kolejka w tle)
+class AnalysisJob(BaseModel):
+    id: int
+    analysis_id: int
+    status: JobStatus
+    attempts: int
+    max_attempts: int
+    progress: int
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    analysis: Optional[Analysis] = None  # wyniki po zakończeniu (status = succeeded)
+
+    class Config:
+        orm_mode = True
+
 # CarePlan schemas
 class CarePlanItemBase(BaseModel):
     product_id: int
@@ -220,6 +271,20 @@ class CarePlan(CarePlanBase):
     class Config:
         orm_mode = True
 
+# Strona listy z kursorami (stronicowanie keyset); None = brak kolejnych elementów w tym kierunku
+class CarePlanPage(BaseModel):
+    items: List[CarePlan] = []
+    before: Optional[str] = None
+    after: Optional[str] = None
+
+# Filtr eksportu zbiorczego PDF (ZIP)
+class CarePlanExportFilter(BaseModel):
+    cosmetologist_id: Optional[int] = None   # domyślnie zalogowany kosmetolog; superadmin - wymagane
+    client_ids: Optional[List[int]] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    active_only: bool = True
+
 class CarePlanDetail(CarePlan):
     client: Client
     analysis: Analysis
@@ -246,6 +311,34 @@ class ChatMessage(ChatMessageBase):
     class Config:
         orm_mode = True
 
+class ChatMessagePage(BaseModel):
+    items: List[ChatMessage] = []
+    before: Optional[str] = None
+    after: Optional[str] = None
+
+# Oznaczenie rozmowy jako przeczytanej do wskazanej wiadomości (id) lub chwili (timestamp)
+class ChatMarkRead(BaseModel):
+    up_to_id: Optional[int] = None
+    up_to: Optional[datetime] = None
+
+    @validator("up_to", always=True)
+    def check_bound(cls, v, values):
+        if v is None and values.get("up_to_id") is None:
+            raise ValueError("up_to_id or up_to is required")
+        return v
+
+class ChatMarkReadResult(BaseModel):
+    updated: int
+
+# Podsumowanie rozmowy na liście czatów kosmetologa
+class ConversationSummary(BaseModel):
+    client_id: int
+    client_name: Optional[str] = None
+    unread_count: int = 0
+    last_message: Optional[str] = None
+    last_message_at: Optional[datetime] = None
+    last_message_from_client: Optional[bool] = None
+
 # File Upload schema
 class ImageUpload(BaseModel):
     client_id: int
@@ -0,0 +1,180 @@
+# scoring.py - Vectorized product-to-analysis scoring over an in-memory catalog matrix
+
+import asyncio
+import itertools
+import os
+import time
+from typing import List, Sequence
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from backend.beautyai import metrics, models
+
+# Katalog odświeżany po zatwierdzeniu zmian produktów w tym procesie, a w pozostałych workerach
+# dopiero po tym czasie - to górna granica nieaktualności rankingu we wdrożeniu z wieloma workerami
+PRODUCT_SCORER_REFRESH_SECONDS = float(os.getenv("PRODUCT_SCORER_REFRESH_SECONDS", "300"))
+ANALYSIS_RECOMMENDED_PRODUCTS = int(os.getenv("ANALYSIS_RECOMMENDED_PRODUCTS", "10"))
+
+METRICS = ("hydration_level", "sebum_level", "pigmentation", "wrinkles", "pores", "sensitivity")
+SKIN_TYPES = tuple(models.SkinType)
+SKIN_CONCERNS = tuple(models.SkinConcern)
+TRAITS = SKIN_TYPES + SKIN_CONCERNS
+# Na ile cecha produktu odpowiada na potrzebę wskazaną przez metrykę analizy
+METRIC_TRAIT_WEIGHTS = {
+    "hydration_level": {models.SkinConcern.DEHYDRATION: 1.0, models.SkinType.DRY: 0.5},
+    "sebum_level": {models.SkinType.OILY: 1.0, models.SkinType.COMBINATION: 0.5, models.SkinConcern.ACNE: 0.5},
+    "pigmentation": {models.SkinConcern.PIGMENTATION: 1.0},
+    "wrinkles": {models.SkinConcern.AGING: 1.0},
+    "pores": {models.SkinConcern.ACNE: 1.0, models.SkinType.OILY: 0.5, models.SkinType.COMBINATION: 0.5},
+    "sensitivity": {models.SkinConcern.REDNESS: 1.0, models.SkinType.SENSITIVE: 1.0},
+}
+# Premia za produkt przeznaczony dla typu skóry z analizy
+SKIN_TYPE_WEIGHT = 1.0
+
+scoring_seconds = metrics.histogram(
+    "product_scoring_seconds", "Czas rankingu produktów dla paczki analiz",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05),
+)
+catalog_refresh_seconds = metrics.histogram("product_catalog_refresh_seconds", "Czas przebudowy macierzy katalogu")
+
+def trait_weight_matrix():
+    # (liczba cech, liczba metryk): cechy produktu -> przydatność dla każdej metryki
+    import numpy as np
+
+    weights = np.zeros((len(TRAITS), len(METRICS)), dtype=np.float32)
+    for column, metric in enumerate(METRICS):
+        for trait, weight in METRIC_TRAIT_WEIGHTS[metric].items():
+            weights[TRAITS.index(trait), column] = weight
+    return weights
+
+def analysis_query_vector(analysis) -> list:
+    # Potrzeby skóry 0..1 (nawilżenie odwrócone: niskie = duża potrzeba) + typ skóry one-hot
+    needs = []
+    for metric in METRICS:
+        value = getattr(analysis, metric)
+        if value is None:
+            needs.append(0.0)
+        elif metric == "hydration_level":
+            needs.append(max(0.0, 100.0 - value) / 100.0)
+        else:
+            needs.append(max(0.0, value) / 100.0)
+    skin_type = getattr(analysis, "skin_type", None)
+    return needs + [SKIN_TYPE_WEIGHT if skin_type == value else 0.0 for value in SKIN_TYPES]
+
+class ProductScorer:
+    # Macierz cech katalogu (produkty x [6 metryk + 5 typów skóry]) w pamięci procesu.
+    # Ranking paczki analiz = jedno mnożenie macierzy + argpartition, bez pętli po obiektach ORM.
+    def __init__(self, refresh_seconds: float = PRODUCT_SCORER_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.product_ids = None
+        self.features = None
+        self.features_t = None
+        self._stale = True
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._stale = True
+
+    def is_fresh(self) -> bool:
+        return not self._stale and time.monotonic() - self._loaded_at < self.refresh_seconds
+
+    async def ensure_fresh(self, db: AsyncSession):
+        if self.is_fresh():
+            return
+        async with self._lock:
+            if not self.is_fresh():
+                await self.refresh(db)
+
+    async def refresh(self, db: AsyncSession):
+        import numpy as np
+
+        # Flaga zdejmowana przed odczytem - zmiana w trakcie przebudowy wymusi kolejną
+        self._stale = False
+        started = time.perf_counter()
+        product_ids = np.fromiter((await db.execute(select(models.Product.id))).scalars(), dtype=np.int64)
+        product_ids.sort()
+        type_rows = (await db.execute(
+            select(models.ProductSkinType.product_id, models.ProductSkinType.skin_type)
+        )).all()
+        concern_rows = (await db.execute(
+            select(models.ProductSkinConcern.product_id, models.ProductSkinConcern.skin_concern)
+        )).all()
+
+        # Macierz cech binarnych produkt x cecha, wypełniana wektorowo po indeksach
+        traits = np.zeros((len(product_ids), len(TRAITS)), dtype=np.float32)
+        rows = [(product_id, TRAITS.index(value)) for product_id, value in type_rows]
+        rows += [(product_id, TRAITS.index(value)) for product_id, value in concern_rows]
+        if rows:
+            pairs = np.asarray(rows, dtype=np.int64)
+            positions = np.searchsorted(product_ids, pairs[:, 0])
+            valid = (positions < len(product_ids)) & (product_ids[np.minimum(positions, len(product_ids) - 1)] == pairs[:, 0])
+            traits[positions[valid], pairs[valid, 1]] = 1.0
+
+        metric_features = traits @ trait_weight_matrix()
+        skin_type_features = traits[:, :len(SKIN_TYPES)]
+        self.features = np.hstack([metric_features, skin_type_features]).astype(np.float32)
+        # Transpozycja trzymana osobno - mnożenie (analizy x cechy) @ (cechy x produkty) po ciągłej pamięci
+        self.features_t = np.ascontiguousarray(self.features.T)
+        self.product_ids = product_ids
+        self._loaded_at = time.monotonic()
+        catalog_refresh_seconds.observe(time.perf_counter() - started)
+
+    def top_k(self, queries: Sequence[Sequence[float]], k: int) -> List[List[int]]:
+        # Dla każdej analizy k najlepszych produktów (score > 0), od najlepszego;
+        # przy równym wyniku wygrywa niższe id (product_ids są posortowane) - ranking jest powtarzalny
+        import numpy as np
+
+        if self.features is None or not len(self.product_ids) or not len(queries) or k <= 0:
+            return [[] for _ in queries]
+        started = time.perf_counter()
+        query_matrix = np.asarray(queries, dtype=np.float32)           # (analizy, cechy)
+        scores = query_matrix @ self.features_t                          # (analizy, produkty), wiersze ciągłe
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]             # k najlepszych, nieposortowane
+        # argpartition wybiera dowolne z produktów remisujących z k-tym wynikiem - granica wyznaczana wprost
+        kth = np.take_along_axis(scores, top, axis=1).min(axis=1)
+        result = []
+        for row, threshold in zip(scores, kth):
+            above = np.flatnonzero(row > threshold)
+            tied = np.flatnonzero(row == threshold)[:k - len(above)]
+            chosen = np.concatenate([above, tied])
+            chosen = chosen[np.lexsort((chosen, -row[chosen]))]
+            result.append(self.product_ids[chosen[row[chosen] > 0]].tolist())
+        scoring_seconds.observe(time.perf_counter() - started)
+        return result
+
+    async def recommend(self, db: AsyncSession, analyses: Sequence, k: int = ANALYSIS_RECOMMENDED_PRODUCTS) -> List[List[int]]:
+        await self.ensure_fresh(db)
+        return self.top_k([analysis_query_vector(analysis) for analysis in analyses], k)
+
+    def stats(self) -> dict:
+        return {
+            "products": 0 if self.product_ids is None else int(len(self.product_ids)),
+            "fresh": self.is_fresh(),
+        }
+
+scorer = ProductScorer()
+
+# Zmiana produktu lub jego cech w tym procesie = przebudowa macierzy przy następnym rankingu.
+# Zmiana zapamiętywana przy flush, unieważnienie dopiero po commit - przebudowa między flush
+# a commit czytałaby jeszcze stary katalog. Inne workery (procesy) nie dostają tego sygnału:
+# widzą zmiany katalogu dopiero po PRODUCT_SCORER_REFRESH_SECONDS.
+CATALOG_CLASSES = (models.Product, models.ProductSkinType, models.ProductSkinConcern)
+_CATALOG_CHANGED = "product_catalog_changed"
+
+@event.listens_for(Session, "after_flush")
+def _collect_catalog_changes(session, flush_context):
+    if any(isinstance(obj, CATALOG_CLASSES) for obj in itertools.chain(session.new, session.deleted)):
+        session.info[_CATALOG_CHANGED] = True
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_catalog(session):
+    if session.info.pop(_CATALOG_CHANGED, False):
+        scorer.invalidate()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_catalog_changes(session):
+    session.info.pop(_CATALOG_CHANGED, None)
@@ -0,0 +1,91 @@
+# skin_analysis.py - AI skin analysis model
+
+import os
+import threading
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from backend.beautyai import models
+from backend.beautyai.inference import ImageDecodeError
+
+# Model Keras (TensorFlow) z obrazu RGB 224x224 (wartości 0..1) zwraca wektor 11 liczb:
+# 6 metryk w skali 0..1 (kolejność METRICS) i 5 prawdopodobieństw typu skóry (kolejność SKIN_TYPES)
+SKIN_MODEL_PATH = os.getenv("SKIN_MODEL_PATH", "models/skin_analysis.keras")
+IMAGE_SIZE = (224, 224)
+METRICS = ["hydration_level", "sebum_level", "pigmentation", "wrinkles", "pores", "sensitivity"]
+SKIN_TYPES = [
+    models.SkinType.DRY, models.SkinType.OILY, models.SkinType.COMBINATION,
+    models.SkinType.NORMAL, models.SkinType.SENSITIVE,
+]
+
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    # Model ładowany raz na proces
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                import tensorflow as tf
+
+                _model = tf.keras.models.load_model(SKIN_MODEL_PATH)
+    return _model
+
+def load_image(image_path: str, out: np.ndarray):
+    # Dekodowanie i skalowanie pojedynczego zdjęcia (rozmiary wejściowe są różne) prosto do bufora paczki;
+    # draft() pozwala dekoderowi JPEG od razu zmniejszyć duże zdjęcie
+    with Image.open(image_path) as image:
+        image.draft("RGB", IMAGE_SIZE)
+        out[...] = np.asarray(image.convert("RGB").resize(IMAGE_SIZE, Image.BILINEAR), dtype=np.uint8)
+
+def preprocess_batch(image_paths: List[str]) -> Tuple[np.ndarray, List[Optional[Exception]]]:
+    # Jedna tablica uint8 (N, H, W, 3) dla całej paczki, normalizacja wektorowo na całości.
+    # Błędne zdjęcie nie psuje paczki - zostaje wyzerowane, a błąd zwracany na jego pozycji.
+    raw = np.zeros((len(image_paths), IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.uint8)
+    errors: List[Optional[Exception]] = [None] * len(image_paths)
+    for i, path in enumerate(image_paths):
+        try:
+            load_image(path, raw[i])
+        except Exception as e:
+            errors[i] = ImageDecodeError(f"{type(e).__name__}: {e}")
+    batch = raw.astype(np.float32)
+    batch *= 1.0 / 255.0
+    return batch, errors
+
+def recommendations_for(metrics: dict) -> str:
+    advice: List[str] = []
+    if metrics["hydration_level"] < 40:
+        advice.append("Skóra odwodniona - zalecane kosmetyki nawilżające z kwasem hialuronowym.")
+    if metrics["sebum_level"] > 60:
+        advice.append("Podwyższony poziom sebum - zalecane lekkie, nie komedogenne formuły.")
+    if metrics["pigmentation"] > 50:
+        advice.append("Widoczne przebarwienia - zalecana witamina C i codzienna ochrona SPF.")
+    if metrics["wrinkles"] > 50:
+        advice.append("Oznaki starzenia - zalecany retinol lub peptydy.")
+    if metrics["pores"] > 60:
+        advice.append("Rozszerzone pory - zalecane kwasy BHA i niacynamid.")
+    if metrics["sensitivity"] > 60:
+        advice.append("Skóra wrażliwa - zalecane łagodne formuły bez substancji zapachowych.")
+    return " ".join(advice) or "Skóra w dobrej kondycji - zalecana pielęgnacja podtrzymująca."
+
+def result_from_output(output: np.ndarray) -> dict:
+    metrics = {name: round(float(value) * 100, 1) for name, value in zip(METRICS, output[:len(METRICS)])}
+    skin_type = SKIN_TYPES[int(np.argmax(output[len(METRICS):len(METRICS) + len(SKIN_TYPES)]))]
+    return {**metrics, "skin_type": skin_type, "ai_recommendations": recommendations_for(metrics)}
+
+def analyze_batch(image_paths: List[str]) -> List[Union[dict, Exception]]:
+    # Jedno wywołanie modelu na całą paczkę; wynik albo wyjątek na pozycji każdego zdjęcia
+    batch, errors = preprocess_batch(image_paths)
+    outputs = get_model().predict_on_batch(batch)
+    outputs = np.asarray(outputs)
+    return [error if error is not None else result_from_output(output) for output, error in zip(outputs, errors)]
+
+def analyze_image(image_path: str) -> dict:
+    # Wynik w kształcie schemas.AnalysisResult (bez rekomendowanych produktów)
+    result = analyze_batch([image_path])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
@@ -0,0 +1,69 @@
+# test_access.py - Ownership scope: one query per permission check, 404 vs 403
+
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from backend.beautyai import access, models
+
+
+def seed(db: Session, account) -> dict:
+    other = models.User(email="inny@example.com", hashed_password="x", role=models.UserRole.ADMIN)
+    db.add(other)
+    care_plan = models.CarePlan(client_id=account.client, created_by=account.cosmetologist, title="Plan")
+    db.add(care_plan)
+    db.flush()
+    ids = {
+        "cosmetologist": account.cosmetologist,
+        "other": other.id,
+        "client_user": account.client_user,
+        "care_plan": care_plan.id,
+    }
+    db.commit()
+    return ids
+
+
+def fetch_care_plan(db: Session, user, care_plan_id: int):
+    scope = access.ClientScope(user)
+    statement = scope.scoped(select(models.CarePlan).where(models.CarePlan.id == care_plan_id), models.CarePlan.client_id)
+    return scope.check(db.execute(statement).first(), "Care plan not found", "No permission for this care plan")
+
+
+@pytest.mark.parametrize("user_key, role", [
+    ("cosmetologist", models.UserRole.ADMIN),
+    ("client_user", models.UserRole.CLIENT),
+])
+def test_owner_gets_row_in_single_query(db, client_account, user_key, role):
+    ids = seed(db, client_account)
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    care_plan = fetch_care_plan(db, SimpleNamespace(id=ids[user_key], role=role), ids["care_plan"])
+
+    assert care_plan.id == ids["care_plan"]
+    assert len(statements) == 1, statements
+
+
+def test_foreign_row_is_forbidden_and_missing_row_not_found(db, client_account):
+    ids = seed(db, client_account)
+    other = SimpleNamespace(id=ids["other"], role=models.UserRole.ADMIN)
+
+    with pytest.raises(HTTPException) as forbidden:
+        fetch_care_plan(db, other, ids["care_plan"])
+    with pytest.raises(HTTPException) as missing:
+        fetch_care_plan(db, other, ids["care_plan"] + 1)
+
+    assert forbidden.value.status_code == 403
+    assert missing.value.status_code == 404
+
+
+def test_superadmin_only_when_allowed(db, client_account):
+    ids = seed(db, client_account)
+    superadmin = SimpleNamespace(id=ids["other"], role=models.UserRole.SUPERADMIN)
+    condition = select(models.Client.id).where(models.Client.id.is_not(None))
+
+    assert db.execute(condition.where(access.ClientScope(superadmin).condition())).first() is None
+    assert db.execute(condition.where(access.ClientScope(superadmin, allow_superadmin=True).condition())).first() is not None
@@ -0,0 +1,48 @@
+# test_benchmark.py - Benchmark percentiles and baseline regression checks
+
+import asyncio
+
+from backend.beautyai import benchmark, inference, jobs
+
+
+def row(p95_ms: float, throughput_rps: float, queries_per_request: float) -> dict:
+    return {"p95_ms": p95_ms, "throughput_rps": throughput_rps, "queries_per_request": queries_per_request}
+
+
+def test_percentile_nearest_rank():
+    values = [0.01 * n for n in range(1, 101)]
+
+    assert benchmark.percentile(values, 0.50) == 0.50
+    assert benchmark.percentile(values, 0.99) == 0.99
+    assert benchmark.percentile([0.2], 0.95) == 0.2
+    assert benchmark.percentile([], 0.95) == 0.0
+
+
+def test_compare_flags_latency_throughput_and_query_count_regressions():
+    baseline = {"scenarios": {
+        "care_plans:read": row(100.0, 50.0, 4.0),
+        "chat:history": row(1.0, 500.0, 1.0),
+        "login": row(40.0, 200.0, 1.0),
+    }}
+    result = {"scenarios": {
+        "care_plans:read": row(140.0, 30.0, 12.0),
+        # +100% przy 1 ms - poniżej LATENCY_SLACK_MS, w granicach szumu
+        "chat:history": row(2.0, 480.0, 1.0),
+        "login": row(45.0, 190.0, 1.0),
+    }}
+
+    regressions = benchmark.compare(result, baseline, tolerance=0.25)
+
+    assert len(regressions) == 3
+    assert all(regression.startswith("care_plans:read") for regression in regressions)
+
+
+def test_benchmark_app_starts_no_analysis_workers_or_model_warmup(monkeypatch):
+    monkeypatch.setattr(jobs.worker_pool, "concurrency", 8)
+    monkeypatch.setattr(inference.server, "warmup", True)
+
+    benchmark.disable_background_work()
+    asyncio.run(jobs.worker_pool.start())
+
+    assert jobs.worker_pool._tasks == []
+    assert inference.server.warmup is False
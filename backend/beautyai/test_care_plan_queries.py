@@ -0,0 +1,173 @@
+# test_care_plan_queries.py - Query count guards for the care plan detail, PDF export and item sync queries
+
+import asyncio
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from backend.beautyai import crud, models, schemas
+
+
+def seed_care_plan(db: Session, account, item_count: int) -> int:
+    analysis = models.Analysis(client_id=account.client, created_by=account.cosmetologist, skin_type=models.SkinType.DRY)
+    products = [models.Product(name=f"Produkt {i}", brand="Marka") for i in range(item_count)]
+    db.add(analysis)
+    db.add_all(products)
+    db.flush()
+
+    care_plan = models.CarePlan(client_id=account.client, analysis_id=analysis.id, created_by=account.cosmetologist, title="Plan")
+    db.add(care_plan)
+    db.flush()
+    db.add_all([
+        models.CarePlanItem(care_plan_id=care_plan.id, product_id=product.id, usage_time="rano", order=i)
+        for i, product in enumerate(products)
+    ])
+    care_plan_id = care_plan.id
+    db.commit()
+    db.expunge_all()
+    return care_plan_id
+
+
+@pytest.mark.parametrize("item_count", [1, 5, 40])
+def test_care_plan_detail_query_count_does_not_grow_with_items(db, client_account, item_count):
+    care_plan_id = seed_care_plan(db, client_account, item_count)
+
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    db_care_plan = db.execute(crud.care_plan_detail_query(care_plan_id)).scalars().first()
+    # Serializacja jak w endpoincie - nie może dociągać relacji
+    detail = schemas.CarePlanDetail.from_orm(db_care_plan)
+
+    assert len(detail.items) == item_count
+    assert all(item.product.name for item in detail.items)
+    assert [item.order for item in detail.items] == list(range(item_count))
+    assert len(statements) == crud.CARE_PLAN_DETAIL_QUERY_COUNT, statements
+
+
+def test_care_plan_export_query_is_single_statement(db, client_account):
+    care_plan_id = seed_care_plan(db, client_account, 5)
+
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    db_care_plan = db.execute(crud.care_plan_export_query(care_plan_id)).unique().scalars().first()
+
+    assert [item.product.name for item in db_care_plan.items]
+    assert len(statements) == 1, statements
+
+
+def item(product: int, order: int, usage_time: str = "rano", usage_instructions=None) -> schemas.CarePlanItemCreate:
+    # product - indeks produktu z sync_items (nie id)
+    return schemas.CarePlanItemCreate(
+        product_id=product, usage_time=usage_time, usage_instructions=usage_instructions, order=order,
+    )
+
+
+def sync_items(initial, desired):
+    # Plan z pozycjami `initial`, potem sync_care_plan_items(desired); zwraca wiersze przed i po oraz liczbę zapytań
+    async def scenario():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+        async with sessionmaker() as db:
+            user = models.User(email="k@example.com", hashed_password="x", role=models.UserRole.ADMIN)
+            products = [models.Product(name=f"Produkt {i}", brand="Marka") for i in range(3)]
+            db.add(user)
+            db.add_all(products)
+            await db.flush()
+            client = models.Client(cosmetologist_id=user.id)
+            db.add(client)
+            await db.flush()
+            care_plan = models.CarePlan(client_id=client.id, created_by=user.id, title="Plan")
+            db.add(care_plan)
+            await db.flush()
+            product_ids = [product.id for product in products]
+
+            def with_ids(items):
+                return [item.copy(update={"product_id": product_ids[item.product_id]}) for item in items]
+
+            def rows(items):
+                return [
+                    (row.id, product_ids.index(row.product_id), row.usage_time, row.usage_instructions, row.order)
+                    for row in items
+                ]
+
+            db.add_all(models.CarePlanItem(care_plan_id=care_plan.id, **row.dict()) for row in with_ids(initial))
+            await db.commit()
+            before = rows((await db.execute(crud.care_plan_items_query(care_plan.id))).scalars().all())
+
+            statements = []
+            count = lambda *args: statements.append(args[2])
+            event.listen(engine.sync_engine, "before_cursor_execute", count)
+            await crud.sync_care_plan_items(db, care_plan.id, with_ids(desired))
+            event.remove(engine.sync_engine, "before_cursor_execute", count)
+            await db.commit()
+
+            db.expunge_all()
+            after = rows((await db.execute(crud.care_plan_items_query(care_plan.id))).scalars().all())
+        await engine.dispose()
+        return before, after, statements
+
+    return asyncio.run(scenario())
+
+
+def test_sync_items_reorder_updates_rows_in_place():
+    before, after, statements = sync_items(
+        [item(0, 0), item(1, 1), item(2, 2)],
+        [item(2, 0), item(0, 1), item(1, 2)],
+    )
+    ids = [row[0] for row in before]
+
+    assert after == [(ids[2], 2, "rano", None, 0), (ids[0], 0, "rano", None, 1), (ids[1], 1, "rano", None, 2)]
+    # SELECT istniejących + jeden UPDATE (executemany) dla wszystkich pozycji
+    assert len(statements) == 2, statements
+
+
+def test_sync_items_same_product_twice():
+    before, after, statements = sync_items(
+        [item(0, 0)],
+        [item(0, 0), item(0, 1, "wieczór")],
+    )
+
+    assert after[0] == before[0]
+    assert after[1][1:] == (0, "wieczór", None, 1) and after[1][0] != before[0][0]
+    assert len(statements) == 2, statements
+
+    before, after, statements = sync_items(
+        [item(0, 0), item(0, 1, "wieczór")],
+        [item(0, 0, "wieczór")],
+    )
+
+    # Pierwszy wiersz produktu przejmuje nowe parametry, drugi jest usuwany
+    assert after == [(before[0][0], 0, "wieczór", None, 0)]
+    assert len(statements) == 3, statements
+
+
+def test_sync_items_only_usage_instructions_changed():
+    before, after, statements = sync_items(
+        [item(0, 0), item(1, 1)],
+        [item(0, 0), item(1, 1, usage_instructions="Cienka warstwa na noc")],
+    )
+
+    assert after == [before[0], (before[1][0], 1, "rano", "Cienka warstwa na noc", 1)]
+    assert len(statements) == 2, statements
+
+
+def test_sync_items_unchanged_list_only_reads():
+    before, after, statements = sync_items([item(0, 0), item(1, 1)], [item(0, 0), item(1, 1)])
+
+    assert after == before
+    assert len(statements) == 1, statements
+
+
+def test_sync_items_remove_all():
+    _, after, statements = sync_items([item(0, 0), item(1, 1), item(2, 2)], [])
+
+    assert after == []
+    # SELECT + jeden DELETE ... WHERE id IN (...)
+    assert len(statements) == 2, statements
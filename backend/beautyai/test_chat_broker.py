@@ -0,0 +1,68 @@
+# test_chat_broker.py - Postgres broker re-listens after losing its LISTEN connection; dropped subscribers wake up
+
+import asyncio
+
+from backend.beautyai import chat_broker
+
+
+def test_listen_connection_loss_reconnects_and_drops_subscriptions(monkeypatch):
+    monkeypatch.setattr(chat_broker, "CHAT_BROKER_RECONNECT_MIN_SECONDS", 0)
+
+    async def scenario():
+        broker = chat_broker.PostgresBroker("postgresql://unused")
+        attempts = []
+
+        async def listen():
+            attempts.append(len(attempts) + 1)
+            if len(attempts) == 2:
+                raise OSError("connection refused")
+            broker._listen_conn = object()
+
+        broker._listen = listen
+        await broker.start()
+        subscription = broker.subscribe(chat_broker.chat_topic(1))
+
+        broker._on_terminate(broker._listen_conn)
+        assert broker._listen_conn is None
+        await asyncio.wait_for(broker._reconnect_task, 1)
+
+        broker._stopped = True
+        return attempts, subscription, broker._listen_conn
+
+    attempts, subscription, listen_conn = asyncio.run(scenario())
+
+    assert attempts == [1, 2, 3]
+    assert listen_conn is not None
+    # Zdarzenia z przerwy przepadły - WebSocket zostanie zamknięty i klient dociągnie historię
+    assert subscription.overflowed
+
+
+def test_dropped_subscription_wakes_waiting_reader():
+    async def scenario():
+        broker = chat_broker.InMemoryBroker()
+        subscription = broker.subscribe(chat_broker.chat_topic(1))
+        await broker.publish(chat_broker.chat_topic(1), {"type": "message"})
+        assert await subscription.get() == {"type": "message"}
+
+        reader = asyncio.create_task(subscription.get())
+        await asyncio.sleep(0)
+        broker._drop_subscriptions()
+        # Bez czekania na heartbeat: get() zwraca None zaraz po zamknięciu
+        return await asyncio.wait_for(reader, 1), subscription
+
+    event, subscription = asyncio.run(scenario())
+
+    assert event is None
+    assert subscription.overflowed
+
+
+def test_dropped_subscription_delivers_queued_events_first():
+    async def scenario():
+        broker = chat_broker.InMemoryBroker()
+        subscription = broker.subscribe(chat_broker.chat_topic(1))
+        await broker.publish(chat_broker.chat_topic(1), {"type": "message"})
+        broker._drop_subscriptions()
+        await broker.publish(chat_broker.chat_topic(1), {"type": "late"})
+        return [await subscription.get(), await subscription.get()], subscription.queue.empty()
+
+    assert asyncio.run(scenario()) == ([{"type": "message"}, None], True)
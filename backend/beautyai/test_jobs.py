@@ -0,0 +1,189 @@
+# test_jobs.py - Analysis job queue lifecycle and worker session handling
+
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.beautyai import jobs, models
+
+
+def test_abstract_queue_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        jobs.JobQueue()
+
+
+def test_in_memory_queue_retries_with_backoff_then_completes():
+    async def scenario():
+        queue = jobs.InMemoryJobQueue()
+        job = await queue.enqueue(analysis_id=7, max_attempts=2)
+        assert await queue.get(job.id) is job
+
+        claimed = await queue.claim("worker-1")
+        assert claimed is job and job.status == models.JobStatus.RUNNING and job.attempts == 1
+        assert await queue.claim("worker-2") is None
+
+        await queue.fail(job, "timeout")
+        assert job.status == models.JobStatus.QUEUED and job.locked_by is None
+        # Ponowienie dopiero po backoffie
+        assert await queue.claim("worker-2") is None
+        job.run_after -= timedelta(seconds=jobs.retry_delay(1))
+
+        assert await queue.claim("worker-2") is job and job.attempts == 2
+        await queue.set_progress(job, 50)
+        await queue.complete(job)
+        assert (job.status, job.progress, job.error) == (models.JobStatus.SUCCEEDED, 100, None)
+
+        failed = await queue.enqueue(analysis_id=8, max_attempts=1)
+        await queue.claim("worker-1")
+        await queue.fail(failed, "broken image")
+        assert failed.status == models.JobStatus.FAILED
+
+    asyncio.run(scenario())
+
+
+async def create_analysis(image_path: str):
+    # Baza w pamięci (StaticPool - jedno połączenie dla wszystkich sesji) z jedną analizą
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessionmaker() as db:
+        user = models.User(email="k@example.com", hashed_password="x", role=models.UserRole.ADMIN)
+        db.add(user)
+        await db.flush()
+        client = models.Client(cosmetologist_id=user.id)
+        db.add(client)
+        await db.flush()
+        analysis = models.Analysis(client_id=client.id, created_by=user.id, image_path=image_path)
+        db.add(analysis)
+        await db.commit()
+    return engine, sessionmaker, analysis.id
+
+
+def test_run_job_holds_no_session_during_inference(tmp_path):
+    image = tmp_path / "face.jpg"
+    image.write_bytes(b"jpeg")
+    open_sessions = []
+
+    async def scenario():
+        engine, sessionmaker, analysis_id = await create_analysis(str(image))
+
+        class TrackedSession:
+            def __init__(self):
+                self.session = sessionmaker()
+
+            async def __aenter__(self):
+                open_sessions.append(self)
+                return await self.session.__aenter__()
+
+            async def __aexit__(self, *exc_info):
+                open_sessions.remove(self)
+                return await self.session.__aexit__(*exc_info)
+
+        sessions_during_inference = []
+
+        async def analyze(image_path):
+            sessions_during_inference.append(len(open_sessions))
+            return {"hydration_level": 42}
+
+        queue = jobs.InMemoryJobQueue()
+        pool = jobs.AnalysisWorkerPool(queue, concurrency=1, analyze=analyze, session_factory=TrackedSession)
+        job = await queue.enqueue(analysis_id)
+        await pool.run_job(await queue.claim("test"))
+
+        async with sessionmaker() as db:
+            hydration = (await db.get(models.Analysis, analysis_id)).hydration_level
+        await engine.dispose()
+        return job, sessions_during_inference, hydration
+
+    job, sessions_during_inference, hydration = asyncio.run(scenario())
+
+    assert job.status == models.JobStatus.SUCCEEDED, job.error
+    assert sessions_during_inference == [0]
+    assert hydration == 42
+
+
+def test_run_job_heartbeats_while_inference_is_slow(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "ANALYSIS_HEARTBEAT_SECONDS", 0.01)
+    image = tmp_path / "face.jpg"
+    image.write_bytes(b"jpeg")
+    heartbeats = []
+
+    class CountingQueue(jobs.InMemoryJobQueue):
+        async def heartbeat(self, job):
+            heartbeats.append(job.id)
+            return await super().heartbeat(job)
+
+    async def analyze(image_path):
+        # Dłużej niż kilka okresów heartbeatu (np. zdjęcie czeka w kolejce inferencji)
+        await asyncio.sleep(0.1)
+        return {}
+
+    async def scenario():
+        engine, sessionmaker, analysis_id = await create_analysis(str(image))
+        queue = CountingQueue()
+        pool = jobs.AnalysisWorkerPool(queue, concurrency=1, analyze=analyze, session_factory=sessionmaker)
+        job = await queue.enqueue(analysis_id)
+        await pool.run_job(await queue.claim("test"))
+        after_job = len(heartbeats)
+        await asyncio.sleep(0.05)
+        await engine.dispose()
+        return job, after_job
+
+    job, after_job = asyncio.run(scenario())
+
+    assert job.status == models.JobStatus.SUCCEEDED, job.error
+    assert after_job >= 3
+    # Po zakończeniu zadania heartbeat nie działa dalej
+    assert len(heartbeats) == after_job
+
+
+def test_undecodable_image_fails_without_retry(tmp_path):
+    image = tmp_path / "face.jpg"
+    image.write_bytes(b"not an image")
+
+    async def analyze(image_path):
+        from backend.beautyai import skin_analysis
+
+        _, errors = skin_analysis.preprocess_batch([image_path])
+        raise errors[0]
+
+    async def scenario():
+        engine, sessionmaker, analysis_id = await create_analysis(str(image))
+        queue = jobs.InMemoryJobQueue()
+        pool = jobs.AnalysisWorkerPool(queue, concurrency=1, analyze=analyze, session_factory=sessionmaker)
+        job = await queue.enqueue(analysis_id, max_attempts=3)
+        await pool.run_job(await queue.claim("test"))
+        await engine.dispose()
+        return job
+
+    job = asyncio.run(scenario())
+
+    assert (job.status, job.attempts) == (models.JobStatus.FAILED, 1)
+    assert "cannot be decoded" in job.error
+
+
+def test_postgres_queue_ignores_updates_after_lock_is_taken_over(tmp_path):
+    async def scenario():
+        engine, sessionmaker, analysis_id = await create_analysis(str(tmp_path / "face.jpg"))
+        queue = jobs.PostgresJobQueue(session_factory=sessionmaker)
+        await queue.enqueue(analysis_id)
+        first = await queue.claim("worker-1")
+        # Reaper uznał zadanie za porzucone, przejął je inny worker
+        async with sessionmaker() as db:
+            row = await db.get(models.AnalysisJob, first.id)
+            row.locked_by = "worker-2"
+            await db.commit()
+
+        assert not await queue.heartbeat(first)
+        assert not await queue.complete(first)
+        async with sessionmaker() as db:
+            row = await db.get(models.AnalysisJob, first.id)
+            state = (row.status, row.locked_by)
+        await engine.dispose()
+        return state
+
+    assert asyncio.run(scenario()) == (models.JobStatus.RUNNING, "worker-2")
@@ -0,0 +1,57 @@
+# test_metrics.py - Per-request SQL accounting, X-Query-Count header and Prometheus export
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from backend.beautyai import metrics
+
+
+def make_app(query_count: int) -> FastAPI:
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    app = FastAPI()
+    app.add_middleware(metrics.RequestMetricsMiddleware, query_count_warn=2)
+
+    @app.get("/items/{item_id}")
+    def read_item(item_id: int):
+        with engine.connect() as conn:
+            for _ in range(query_count):
+                conn.execute(text("SELECT 1"))
+        return {"id": item_id}
+
+    return app
+
+
+def series_count(name: str, labels: str) -> int:
+    prefix = f"{name}_count{{{labels}}} "
+    lines = [line for line in metrics.render_prometheus().splitlines() if line.startswith(prefix)]
+    return int(lines[0][len(prefix):]) if lines else 0
+
+
+def test_query_count_header_only_above_threshold():
+    client = TestClient(make_app(query_count=3))
+    before = series_count("http_request_db_queries", 'method="GET",route="/items/{item_id}"')
+
+    response = client.get("/items/7")
+
+    assert response.headers["x-query-count"] == "3"
+    assert series_count("http_request_db_queries", 'method="GET",route="/items/{item_id}"') == before + 1
+
+    assert "x-query-count" not in TestClient(make_app(query_count=1)).get("/items/7").headers
+
+
+def test_prometheus_histogram_is_cumulative():
+    histogram = metrics.histogram("test_metric_seconds", "Test", labelnames=("kind",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, 'a"b')
+
+    lines = [line for line in metrics.render_prometheus().splitlines() if line.startswith("test_metric_seconds")]
+
+    assert lines == [
+        'test_metric_seconds_bucket{kind="a\\"b",le="0.1"} 1',
+        'test_metric_seconds_bucket{kind="a\\"b",le="1.0"} 2',
+        'test_metric_seconds_bucket{kind="a\\"b",le="+Inf"} 3',
+        'test_metric_seconds_sum{kind="a\\"b"} 5.55',
+        'test_metric_seconds_count{kind="a\\"b"} 3',
+    ]
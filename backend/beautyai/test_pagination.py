@@ -0,0 +1,167 @@
+# test_pagination.py - Keyset pagination: full walks over duplicate timestamps, live tail, bad cursors
+
+import asyncio
+import base64
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.beautyai import access, additional_endpoints, crud, models
+
+START = datetime(2024, 1, 1, 12, 0)
+# Po dwa-trzy wiersze z tym samym czasem - kolejność między nimi rozstrzyga dopiero id
+OFFSETS = [0, 0, 1, 1, 1, 2, 3, 3]
+
+
+async def seed(model, **columns):
+    # Baza w pamięci z kosmetologiem, jego klientką i wierszami `model` o czasach START + OFFSETS minut
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessionmaker() as db:
+        user = models.User(email="k@example.com", hashed_password="x", role=models.UserRole.ADMIN)
+        db.add(user)
+        await db.flush()
+        client = models.Client(cosmetologist_id=user.id)
+        db.add(client)
+        await db.flush()
+        for minutes in OFFSETS:
+            db.add(model(client_id=client.id, **{key: value(user, minutes) for key, value in columns.items()}))
+        await db.commit()
+    owner = SimpleNamespace(id=user.id, role=models.UserRole.ADMIN)
+    return engine, sessionmaker, owner, client.id
+
+
+def seed_care_plans():
+    return seed(
+        models.CarePlan,
+        created_by=lambda user, minutes: user.id,
+        title=lambda user, minutes: "Plan",
+        created_at=lambda user, minutes: START + timedelta(minutes=minutes),
+    )
+
+
+def seed_chat_messages():
+    return seed(
+        models.ChatMessage,
+        sender_id=lambda user, minutes: user.id,
+        message=lambda user, minutes: "Wiadomość",
+        sent_at=lambda user, minutes: START + timedelta(minutes=minutes),
+    )
+
+
+def keys(rows, sort_key: str) -> list:
+    return [(getattr(row, sort_key), row.id) for row in rows]
+
+
+def test_care_plans_walk_forward_and_back_over_duplicate_timestamps():
+    async def scenario():
+        engine, sessionmaker, owner, _ = await seed_care_plans()
+        query = crud.care_plans_query(access.ClientScope(owner))
+        forward, backward = [], []
+        async with sessionmaker() as db:
+            page = lambda **cursors: crud.paginate_keyset(db, query, **crud.CARE_PLANS_KEYSET, limit=3, **cursors)
+
+            rows, before, after = await page()
+            assert before is None
+            forward.append(keys(rows, "created_at"))
+            while after is not None:
+                rows, before, after = await page(after=after)
+                assert before is not None
+                forward.append(keys(rows, "created_at"))
+
+            # Z ostatniej strony wstecz - te same strony w odwrotnej kolejności
+            while before is not None:
+                rows, before, after = await page(before=before)
+                assert after is not None
+                backward.append(keys(rows, "created_at"))
+        await engine.dispose()
+        return forward, backward
+
+    forward, backward = asyncio.run(scenario())
+
+    walked = [key for rows in forward for key in rows]
+    assert walked == sorted(walked, reverse=True)
+    assert len(set(walked)) == len(OFFSETS)
+    assert [len(rows) for rows in forward] == [3, 3, 2]
+    assert backward == forward[-2::-1]
+
+
+def test_chat_messages_live_tail_pages_back_then_follows_new_messages():
+    async def scenario():
+        engine, sessionmaker, owner, client_id = await seed_chat_messages()
+        query = crud.chat_messages_query(access.ClientScope(owner), client_id)
+        async with sessionmaker() as db:
+            page = lambda **cursors: crud.paginate_keyset(db, query, **crud.CHAT_MESSAGES_KEYSET, limit=3, **cursors)
+
+            # Bez kursora - najnowsze wiadomości, od najstarszej na stronie
+            rows, before, tail = await page()
+            pages = [keys(rows, "sent_at")]
+            while before is not None:
+                rows, before, after = await page(before=before)
+                assert after is not None
+                pages.insert(0, keys(rows, "sent_at"))
+
+            # Za najnowszą wiadomością - pusta strona, kursor `after` zostaje ten sam
+            empty, empty_before, empty_after = await page(after=tail)
+
+            db.add(models.ChatMessage(
+                client_id=client_id, sender_id=owner.id, message="Nowa", sent_at=START + timedelta(minutes=3),
+            ))
+            await db.commit()
+            new_rows, _, new_after = await page(after=tail)
+        await engine.dispose()
+        return pages, tail, (empty, empty_before, empty_after), keys(new_rows, "sent_at"), new_after
+
+    pages, tail, empty_page, new_rows, new_after = asyncio.run(scenario())
+
+    walked = [key for rows in pages for key in rows]
+    assert walked == sorted(walked)
+    assert len(set(walked)) == len(OFFSETS)
+    assert [len(rows) for rows in pages] == [2, 3, 3]
+    assert empty_page == ([], None, tail)
+    # Ten sam sent_at co ostatnia wiadomość, ale większe id - nie ginie na granicy kursora
+    assert new_rows == [(START + timedelta(minutes=3), len(OFFSETS) + 1)]
+    assert new_after != tail
+
+
+def test_empty_list_has_no_cursors():
+    async def scenario():
+        engine, sessionmaker, owner, client_id = await seed_chat_messages()
+        other = SimpleNamespace(id=owner.id + 100, role=models.UserRole.ADMIN)
+        async with sessionmaker() as db:
+            care_plans = await crud.paginate_keyset(
+                db, crud.care_plans_query(access.ClientScope(other)), **crud.CARE_PLANS_KEYSET, limit=3,
+            )
+        await engine.dispose()
+        return care_plans
+
+    assert asyncio.run(scenario()) == ([], None, None)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not-a-cursor",
+    "",
+    base64.urlsafe_b64encode(b"[1]").decode(),
+    base64.urlsafe_b64encode(b'["yesterday", 1]').decode(),
+])
+def test_malformed_cursor_is_bad_request(cursor):
+    with pytest.raises(ValueError):
+        crud.decode_cursor(cursor)
+
+    owner = SimpleNamespace(id=1, role=models.UserRole.ADMIN)
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(additional_endpoints.read_care_plans(
+            client_id=None, before=cursor, after=None, limit=10, db=None, current_user=owner,
+        ))
+    assert exc_info.value.status_code == 400
+
+
+def test_cursor_round_trip():
+    sort_value = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    assert crud.decode_cursor(crud.encode_cursor(sort_value, 42)) == (sort_value, 42)
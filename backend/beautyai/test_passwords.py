@@ -0,0 +1,14 @@
+# test_passwords.py - bcrypt thread pool survives an application restart in the same process
+
+import asyncio
+
+from backend.beautyai import passwords
+
+
+def test_hashing_works_after_shutdown():
+    hashed = asyncio.run(passwords.hash_password("secret"))
+    passwords.shutdown()
+
+    valid, _ = asyncio.run(passwords.verify_and_update("secret", hashed))
+
+    assert valid
@@ -0,0 +1,45 @@
+# test_principal_cache.py - Logged-in user cache is invalidated on commit, not on attribute change
+
+from backend.beautyai import main, models
+
+
+def cache_principal(db, user_id: int) -> models.User:
+    user = db.get(models.User, user_id)
+    main.principal_cache.set(user.email, main.Principal.from_user(user))
+    return user
+
+
+def test_deactivation_invalidates_only_after_commit(db, client_account):
+    db.commit()
+    user = cache_principal(db, client_account.client_user)
+
+    user.is_active = False
+    db.flush()
+    # Przed commit inne żądania nadal widzą w bazie aktywne konto - wpis zostaje
+    assert main.principal_cache.get(user.email) is not None
+
+    db.commit()
+    assert main.principal_cache.get(user.email) is None
+
+
+def test_rollback_keeps_cached_principal(db, client_account):
+    db.commit()
+    user = cache_principal(db, client_account.client_user)
+
+    user.role = models.UserRole.ADMIN
+    db.flush()
+    db.rollback()
+
+    assert main.principal_cache.get(user.email) is not None
+    main.principal_cache.pop(user.email)
+
+
+def test_email_change_invalidates_old_key(db, client_account):
+    db.commit()
+    user = cache_principal(db, client_account.client_user)
+    old_email = user.email
+
+    user.email = "nowy@example.com"
+    db.commit()
+
+    assert main.principal_cache.get(old_email) is None
@@ -0,0 +1,80 @@
+# test_scoring.py - Product ranking from the catalog matrix and its invalidation on commit
+
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.beautyai import models, scoring
+
+
+def scorer_for(product_ids, features) -> scoring.ProductScorer:
+    import numpy as np
+
+    scorer = scoring.ProductScorer()
+    scorer.product_ids = np.asarray(product_ids, dtype=np.int64)
+    scorer.features = np.asarray(features, dtype=np.float32)
+    scorer.features_t = np.ascontiguousarray(scorer.features.T)
+    return scorer
+
+
+def test_top_k_orders_by_score_and_breaks_ties_by_product_id():
+    # Jedna cecha; id 10, 20, 40 remisują z wynikiem 1.0, id 50 nie pasuje wcale
+    scorer = scorer_for([10, 20, 30, 40, 50], [[1.0], [1.0], [3.0], [1.0], [0.0]])
+
+    assert scorer.top_k([[1.0]], 3) == [[30, 10, 20]]
+    assert scorer.top_k([[1.0]], 10) == [[30, 10, 20, 40]]
+    assert scorer.top_k([[1.0], [0.0]], 2) == [[30, 10], []]
+    assert scorer.top_k([], 2) == []
+
+
+@pytest.fixture
+def sessionmaker(monkeypatch):
+    monkeypatch.setattr(scoring, "scorer", scoring.ProductScorer())
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    asyncio.run(_create_tables(engine))
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+async def _create_tables(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+
+
+def test_recommend_ranks_catalog_products_for_analysis(sessionmaker):
+    async def scenario():
+        async with sessionmaker() as db:
+            dry = models.Product(name="Krem", skin_type_links=[models.ProductSkinType(skin_type=models.SkinType.DRY)])
+            oily = models.Product(name="Żel", skin_type_links=[models.ProductSkinType(skin_type=models.SkinType.OILY)])
+            db.add_all([dry, oily])
+            await db.commit()
+            analysis = models.Analysis(skin_type=models.SkinType.DRY, hydration_level=20)
+            return dry.id, await scoring.scorer.recommend(db, [analysis], 5)
+
+    dry_id, ranking = asyncio.run(scenario())
+    assert ranking == [[dry_id]]
+
+
+def test_catalog_is_invalidated_on_commit_not_on_flush(sessionmaker):
+    async def scenario():
+        scorer = scoring.scorer
+        async with sessionmaker() as db:
+            await scorer.refresh(db)
+            assert scorer.is_fresh()
+
+            db.add(models.Product(name="Serum"))
+            await db.flush()
+            # Flush bez commit - przebudowa teraz widziałaby stary katalog
+            assert scorer.is_fresh()
+            await db.commit()
+            assert not scorer.is_fresh()
+
+            await scorer.refresh(db)
+            db.add(models.Product(name="Tonik"))
+            await db.flush()
+            await db.rollback()
+            assert scorer.is_fresh()
+
+    asyncio.run(scenario())
@@ -0,0 +1,48 @@
+# test_slow_queries.py - Slow-query log: normalized SQL, parameter shapes, bounded buffer
+
+import time
+
+from sqlalchemy import create_engine, text
+
+from backend.beautyai import database
+
+
+def test_normalize_sql_drops_literals_and_collapses_in_lists():
+    sql = database.normalize_sql(
+        "SELECT *  FROM users\n WHERE email = 'a@b.pl' AND id IN (%(id_1)s, %(id_2)s, %(id_3)s) LIMIT 10"
+    )
+
+    assert sql == "SELECT * FROM users WHERE email = ? AND id IN (...) LIMIT ?"
+    assert database.normalize_sql("SELECT $1::INTEGER, t1.col2 FROM t1") == "SELECT $1::INTEGER, t1.col2 FROM t1"
+
+
+def test_parameter_shape_has_types_only():
+    assert database.parameter_shape({"email": "a@b.pl", "id": 7}) == {"email": "str", "id": "int"}
+    assert database.parameter_shape([(1, "x"), (2, "y")], executemany=True) == {"rows": 2, "row": ["int", "str"]}
+
+
+def slow(value):
+    time.sleep(0.005)
+    return value
+
+
+def test_slow_statements_are_recorded_in_bounded_buffer(monkeypatch):
+    log = database.SlowQueryLog(maxlen=2)
+    monkeypatch.setattr(database, "slow_query_log", log)
+    monkeypatch.setattr(database, "SLOW_QUERY_THRESHOLD_MS", 1)
+    engine = create_engine("sqlite://")
+    engine.raw_connection().driver_connection.create_function("slow", 1, slow)
+    database._attach_slow_query_log(engine, "test")
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        for value in range(3):
+            conn.execute(text("SELECT slow(:value)"), {"value": value})
+        conn.execution_options(slow_query_log=False).execute(text("SELECT slow(9)"))
+
+    entries = log.entries()
+    assert [entry["id"] for entry in entries] == [3, 2]
+    assert entries[0]["sql"] == "SELECT slow(?)"
+    assert entries[0]["parameters"] == ["int"]
+    assert entries[0]["route"] is None
+    assert entries[0]["plan_status"] == "skipped"
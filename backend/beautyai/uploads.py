@@ -0,0 +1,146 @@
+# uploads.py - Streaming, size-bounded image uploads with content-addressed storage
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+import aiofiles
+import aiofiles.os
+from fastapi import HTTPException, UploadFile, status
+
+UPLOAD_DIRECTORY = os.getenv("UPLOAD_DIRECTORY", "uploads/")
+IMAGE_DIRECTORY = os.path.join(UPLOAD_DIRECTORY, "images")
+TMP_DIRECTORY = os.path.join(UPLOAD_DIRECTORY, "tmp")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Kawałek base64 - wielokrotność 4 znaków, dekodowany osobno
+BASE64_CHUNK_CHARS = 4 * 256 * 1024
+# Narzut multipart ponad sam plik przy wstępnej kontroli Content-Length
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+_DATA_URL_PREFIX = re.compile(r"^data:image/[\w.+-]+;base64,")
+_WHITESPACE = re.compile(r"\s+")
+
+@dataclass
+class StoredImage:
+    path: str
+    sha256: str
+    size: int
+    extension: str
+    deduplicated: bool
+
+def detect_image_type(header: bytes) -> Optional[str]:
+    # Rozpoznanie formatu po sygnaturze pliku - odrzucamy nie-obrazy po pierwszym kawałku
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "heic"
+    return None
+
+HEADER_BYTES = 12
+
+def check_content_length(content_length: Optional[str], overhead: int = MULTIPART_OVERHEAD_BYTES):
+    # Odrzuć za duże żądanie zanim zostanie odebrane (jeśli klient podał Content-Length)
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_BYTES + overhead:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large")
+
+def image_path_for(sha256: str, extension: str) -> str:
+    # uploads/images/ab/cd/<sha256>.<ext> - ten sam plik trafia zawsze w to samo miejsce
+    return os.path.join(IMAGE_DIRECTORY, sha256[:2], sha256[2:4], f"{sha256}.{extension}")
+
+class IncomingImage:
+    # Zapis przychodzącego obrazu kawałkami do pliku tymczasowego z liczeniem SHA-256 w locie
+    def __init__(self):
+        self.tmp_path = os.path.join(TMP_DIRECTORY, f"{uuid.uuid4().hex}.part")
+        self.size = 0
+        self.extension: Optional[str] = None
+        self._header = b""
+        self._sha256 = hashlib.sha256()
+        self._file = None
+
+    async def __aenter__(self):
+        await aiofiles.os.makedirs(TMP_DIRECTORY, exist_ok=True)
+        self._file = await aiofiles.open(self.tmp_path, "wb")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._file is not None:
+            await self._file.close()
+        if await aiofiles.os.path.exists(self.tmp_path):
+            await aiofiles.os.remove(self.tmp_path)
+
+    async def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > UPLOAD_MAX_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large")
+        if self.extension is None:
+            self._header += chunk[:HEADER_BYTES]
+            if len(self._header) >= HEADER_BYTES:
+                self._check_header()
+        self._sha256.update(chunk)
+        await self._file.write(chunk)
+
+    def _check_header(self):
+        self.extension = detect_image_type(self._header)
+        if self.extension is None:
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Unsupported image format")
+
+    async def finish(self) -> StoredImage:
+        if self.extension is None:
+            self._check_header()  # plik krótszy niż nagłówek
+        await self._file.close()
+        self._file = None
+        sha256 = self._sha256.hexdigest()
+        path = image_path_for(sha256, self.extension)
+        deduplicated = await aiofiles.os.path.exists(path)
+        if not deduplicated:
+            await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Atomowe przeniesienie - równoległy upload tego samego pliku nadpisze identyczną treść
+            await aiofiles.os.replace(self.tmp_path, path)
+        return StoredImage(path=path, sha256=sha256, size=self.size, extension=self.extension, deduplicated=deduplicated)
+
+async def store_upload(file: UploadFile) -> StoredImage:
+    async with IncomingImage() as incoming:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await incoming.write(chunk)
+        return await incoming.finish()
+
+async def store_base64(image_data: str) -> StoredImage:
+    # Dekodowanie kawałkami zamiast jednego b64decode na całym zdjęciu
+    start = 0
+    prefix = _DATA_URL_PREFIX.match(image_data[:128])
+    if prefix:
+        start = prefix.end()
+    # 4 znaki base64 = 3 bajty; przybliżona kontrola rozmiaru przed dekodowaniem
+    if (len(image_data) - start) * 3 // 4 > UPLOAD_MAX_BYTES + 3:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large")
+    async with IncomingImage() as incoming:
+        pending = ""
+        for offset in range(start, len(image_data), BASE64_CHUNK_CHARS):
+            pending += _WHITESPACE.sub("", image_data[offset:offset + BASE64_CHUNK_CHARS])
+            usable = len(pending) - len(pending) % 4
+            await incoming.write(_decode_base64(pending[:usable]))
+            pending = pending[usable:]
+        if pending:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid base64 image data")
+        return await incoming.finish()
+
+def _decode_base64(data: str) -> bytes:
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid base64 image data")